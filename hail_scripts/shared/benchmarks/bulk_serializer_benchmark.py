@@ -0,0 +1,33 @@
+"""Compares the docs/sec of the bulk request serializers when building bulk bodies from SV-like documents.
+
+Run from the repository root:
+
+    python -m hail_scripts.shared.benchmarks.bulk_serializer_benchmark --num-docs 20000
+"""
+import argparse
+import time
+
+from hail_scripts.shared.elasticsearch_client_v7 import BULK_SERIALIZERS, ElasticsearchClient, orjson
+from hail_scripts.shared.elasticsearch_client_v7_tests import get_sv_test_actions
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--num-docs', type=int, default=20000)
+    p.add_argument('--chunk-size', type=int, default=1000)
+    p.add_argument('--serializer', choices=sorted(BULK_SERIALIZERS), action='append',
+                   help='serializers to compare. Defaults to all installed serializers')
+    args = p.parse_args()
+
+    serializers = args.serializer or ['json'] + (['orjson'] if orjson is not None else [])
+    actions = list(get_sv_test_actions(args.num_docs))
+    for serializer in serializers:
+        client = ElasticsearchClient(serializer=serializer, lazy_connection_check=True)
+        start = time.time()
+        num_chunks = sum(1 for _ in client._chunk_bulk_actions(actions, args.chunk_size, 10 * 1024 * 1024))
+        print('{} serializer: {:.0f} docs/sec ({} chunks)'.format(
+            serializer, args.num_docs / (time.time() - start), num_chunks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Measures the rows/sec of the python bulk export backend, from collected variant rows to documents indexed by a
+local fake elasticsearch server that waits a fixed time on every bulk request to simulate indexing.
+
+Run from the repository root:
+
+    python -m hail_scripts.shared.benchmarks.bulk_source_export_benchmark --num-rows 5000 --bulk-latency 0.05
+"""
+import argparse
+import time
+
+from hail_scripts.shared.elasticsearch_client_v7 import ElasticsearchClient
+from hail_scripts.shared.elasticsearch_client_v7_tests import FakeElasticsearchServer, get_variant_test_rows
+from hail_scripts.shared.elasticsearch_utils import get_bulk_action, get_bulk_source
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--num-rows', type=int, default=5000)
+    p.add_argument('--chunk-size', type=int, default=250)
+    p.add_argument('--bulk-latency', type=float, default=0.05, help='seconds the fake server waits per bulk request')
+    p.add_argument('--num-workers', type=int, nargs='+', default=[1, 4])
+    p.add_argument('--serializer', help='bulk serializer (see get_bulk_serializer)')
+    args = p.parse_args()
+
+    for num_workers in args.num_workers:
+        with FakeElasticsearchServer(bulk_latency=args.bulk_latency) as server:
+            client = ElasticsearchClient(port=server.port, serializer=args.serializer, pool_size=max(num_workers, 10))
+            start = time.time()
+            actions = (
+                get_bulk_action(get_bulk_source(row), 'test_index', id_field='docId')
+                for row in get_variant_test_rows(args.num_rows)
+            )
+            client.bulk_export(actions, num_workers=num_workers, chunk_size=args.chunk_size)
+            rows_per_sec = args.num_rows / (time.time() - start)
+
+            if len(server.docs['test_index']) != args.num_rows:
+                raise ValueError('Exported {} of {} rows'.format(len(server.docs['test_index']), args.num_rows))
+            print('{} workers: {:.0f} rows/sec'.format(num_workers, rows_per_sec))
+
+
+if __name__ == '__main__':
+    main()
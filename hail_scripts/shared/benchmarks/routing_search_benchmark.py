@@ -0,0 +1,76 @@
+"""Compares the shards searched and the latency of region queries for each document routing scheme, against a local
+fake elasticsearch server that waits a fixed time for every few shards a search fans out to.
+
+Run from the repository root:
+
+    python -m hail_scripts.shared.benchmarks.routing_search_benchmark --num-shards 12 --search-shard-latency 0.005
+"""
+import argparse
+import random
+import time
+
+from hail_scripts.shared.elasticsearch_client_v7 import ElasticsearchClient
+from hail_scripts.shared.elasticsearch_client_v7_tests import FakeElasticsearchServer
+from hail_scripts.shared.elasticsearch_utils import (
+    ROUTING_SCHEMES, get_bulk_action, get_routing_key, get_routing_partition_size,
+)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--num-docs', type=int, default=5000)
+    p.add_argument('--num-queries', type=int, default=20)
+    p.add_argument('--region-size', type=int, default=10**6)
+    p.add_argument('--num-shards', type=int, default=12)
+    p.add_argument('--search-shard-latency', type=float, default=0.005,
+                   help='seconds the fake server waits for every --search-threads shards searched')
+    p.add_argument('--search-threads', type=int, default=2)
+    args = p.parse_args()
+
+    # SV-like docs spread across chromosomes 1-22, and region queries starting at a random doc
+    rand = random.Random(1)
+    docs = [
+        {'variantId': 'sv_{}'.format(i), 'xpos': rand.randint(1, 22) * 10**9 + rand.randint(1, 200 * 10**6)}
+        for i in range(args.num_docs)
+    ]
+    regions = [(doc['xpos'], doc['xpos'] + args.region_size) for doc in rand.sample(docs, args.num_queries)]
+
+    hit_counts_by_scheme = {}
+    for routing_scheme in [None] + sorted(ROUTING_SCHEMES):
+        with FakeElasticsearchServer(
+                search_shard_latency=args.search_shard_latency, search_threads=args.search_threads) as server:
+            client = ElasticsearchClient(port=server.port)
+            meta = {'routing': {'scheme': routing_scheme, 'field': 'xpos'}} if routing_scheme else {}
+            client.create_index(
+                'test_index', {}, num_shards=args.num_shards, _meta=meta,
+                routing_partition_size=get_routing_partition_size(routing_scheme, args.num_shards))
+            client.bulk_export(
+                dict(get_bulk_action(dict(doc), 'test_index', id_field='variantId'),
+                     **({'_routing': get_routing_key(doc['xpos'], routing_scheme)} if routing_scheme else {}))
+                for doc in docs
+            )
+
+            start = time.time()
+            shards_searched = []
+            hit_counts = []
+            for xstart, xstop in regions:
+                # the documents are single positions
+                routing = client.get_search_routing('test_index', xstart, xstop, max_variant_length=0)
+                response = client.es.search(
+                    index='test_index', routing=routing,
+                    body={'query': {'range': {'xpos': {'gte': xstart, 'lte': xstop}}}},
+                )
+                shards_searched.append(response['_shards']['total'])
+                hit_counts.append(response['hits']['total']['value'])
+            ms_per_query = (time.time() - start) / len(regions) * 1000
+
+            hit_counts_by_scheme[routing_scheme] = hit_counts
+            print('{} routing: {:.1f} shards searched, {:.1f} ms per query'.format(
+                routing_scheme, sum(shards_searched) / len(regions), ms_per_query))
+
+    if any(hit_counts != hit_counts_by_scheme[None] for hit_counts in hit_counts_by_scheme.values()):
+        raise ValueError('Routing changed the search results')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 import datetime
+import fnmatch
+import gzip
 import inspect
 import logging
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pprint import pformat
 
 
@@ -12,6 +18,16 @@ except ImportError:
     os.system("pip install elasticsearch")
     import elasticsearch
 
+from elasticsearch import helpers as es_helpers
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from hail_scripts.shared.elasticsearch_utils import ROUTING_XPOS_BIN_SIZE, get_routing_keys_for_xpos_range
+
 
 handlers = set(logging.root.handlers)
 logging.root.handlers = list(handlers)
@@ -19,10 +35,113 @@ logger = logging.getLogger()
 
 LOADING_NODES_NAME = 'elasticsearch-es-data-loading*'
 
+# Bulk responses with these statuses mean the cluster is overloaded, and the documents should be resent after a delay
+BULK_RETRY_STATUS_CODES = {429, 503}
+
+# Maximum number of distinct action line templates to cache per client
+MAX_CACHED_ACTION_TEMPLATES = 1000
+
+# Seconds between refreshing the list of sniffed nodes
+SNIFFER_TIMEOUT = 60
+
+FORCEMERGE_TASK_ACTION = 'indices:admin/forcemerge*'
+
+# Index settings while bulk loading. Refreshes and replication are deferred, and the translog is synced in the
+# background instead of on every request.
+LOAD_INDEX_SETTINGS = {
+    'index.refresh_interval': -1,
+    'index.number_of_replicas': 0,
+    'index.translog.durability': 'async',
+    'index.translog.flush_threshold_size': '1gb',
+}
+
+# Index settings after loading. None resets a setting to the elasticsearch default. The number of replicas is set
+# separately by bulk_load
+SERVING_INDEX_SETTINGS = {
+    'index.refresh_interval': None,
+    'index.translog.durability': None,
+    'index.translog.flush_threshold_size': None,
+}
+
+
+def get_versioned_index_name(index_name):
+    """Returns a new physical index name for loading an index that is served through an alias with the given name"""
+    return '{}__{}'.format(index_name, datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+
+
+class JsonBulkSerializer:
+    """Serializes bulk request lines to UTF-8 encoded JSON with the stdlib json module, using the same settings and
+    type conversions as the default elasticsearch-py serializer."""
+
+    name = 'json'
+
+    def __init__(self):
+        self._serializer = JSONSerializer()
+
+    def dumps(self, data):
+        """Returns the serialized data as bytes. Strings are assumed to already be serialized."""
+        return self._serializer.dumps(data).encode('utf-8')
+
+
+class OrjsonBulkSerializer(JsonBulkSerializer):
+    """Serializes bulk request lines with orjson, which is several times faster than the stdlib json module. Types
+    orjson does not support natively fall back to the default elasticsearch-py conversions.
+
+    Unlike the stdlib json module, orjson writes NaN and Infinity floats as null, so it is opt-in."""
+
+    name = 'orjson'
+
+    def __init__(self):
+        super(OrjsonBulkSerializer, self).__init__()
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data.encode('utf-8')
+        return orjson.dumps(
+            data, default=self._serializer.default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+BULK_SERIALIZERS = {serializer.name: serializer for serializer in [JsonBulkSerializer, OrjsonBulkSerializer]}
+
+
+def get_bulk_serializer(serializer=None):
+    """Get a serializer for bulk request lines.
+
+    Args:
+        serializer (str or object): name of a serializer in BULK_SERIALIZERS, or any object with a dumps method that
+            returns bytes. Defaults to the stdlib json module, which serializes documents the same way as the
+            elasticsearch-py client.
+
+    Returns:
+        object: serializer instance
+    """
+    if serializer is None:
+        serializer = JsonBulkSerializer.name
+    if isinstance(serializer, str):
+        if serializer not in BULK_SERIALIZERS:
+            raise ValueError('Unknown serializer {}. Valid serializers: {}'.format(
+                serializer, ', '.join(BULK_SERIALIZERS)))
+        return BULK_SERIALIZERS[serializer]()
+    return serializer
+
+
+def _get_data_node_host_info(node_info, host):
+    """Only send requests to sniffed data nodes, which include the temporary loading nodes"""
+    if 'data' not in node_info.get('roles', []):
+        return None
+    return host
+
 
 class ElasticsearchClient:
 
-    def __init__(self, host='localhost', port='9200', es_username='pipeline', es_password=None):
+    # Shared clients keyed by class and connection arguments, see get_shared_client
+    _shared_clients = {}
+    _shared_clients_lock = threading.Lock()
+
+    def __init__(self, host='localhost', port='9200', es_username='pipeline', es_password=None, serializer=None,
+                 pool_size=10, http_compress=False, sniff=False, lazy_connection_check=False):
         """Constructor.
 
         Args:
@@ -30,21 +149,72 @@ class ElasticsearchClient:
             port (str): Elasticsearch server port
             es_username (str): Elasticsearch username
             es_password (str): Elasticsearch password
+            serializer (str or object): serializer for bulk export request bodies (see get_bulk_serializer)
+            pool_size (int): number of connections kept open to each node. Should be at least the number of
+                bulk_export workers, otherwise connections are discarded and re-opened for every request.
+            http_compress (bool): whether to gzip all request bodies
+            sniff (bool): whether to discover the data nodes in the cluster, including the loading nodes, and spread
+                requests across them. Only use this if the nodes are reachable directly from this host.
+            lazy_connection_check (bool): whether to defer checking the connection until the client is first used
         """
 
         self._host = host
         self._port = port
         self._es_username = es_username
         self._es_password = es_password
+        self.bulk_serializer = get_bulk_serializer(serializer)
+        self._action_templates = {}
+        self._connection_checked = False
+        self._http_compress = http_compress
 
         http_auth =  (self._es_username, self._es_password) if self._es_password else None
 
-        self.es = elasticsearch.Elasticsearch(host, port=port, http_auth=http_auth)
+        sniff_kwargs = {
+            'sniff_on_start': True,
+            'sniff_on_connection_fail': True,
+            'sniffer_timeout': SNIFFER_TIMEOUT,
+            'host_info_callback': _get_data_node_host_info,
+        } if sniff else {}
+
+        self.es = elasticsearch.Elasticsearch(
+            host, port=port, http_auth=http_auth, maxsize=pool_size, http_compress=http_compress, **sniff_kwargs)
+
+        if not lazy_connection_check:
+            self.check_connection()
 
-        # check connection
-        logger.info(pformat(self.es.info()))
+    @classmethod
+    def get_shared_client(cls, host='localhost', port='9200', es_username='pipeline', es_password=None, **kwargs):
+        """Get a client shared by the whole process for the given host, port and credentials, creating it if needed.
 
-    def create_index(self, index_name, elasticsearch_schema, num_shards=1, _meta=None):
+        Operations across many indices can reuse one client, keeping its connections open instead of repeating the
+        TCP/TLS handshake and connection check for each index. The connection is checked the first time the shared
+        client is used.
+
+        Args:
+            host (str): Elasticsearch server host
+            port (str): Elasticsearch server port
+            es_username (str): Elasticsearch username
+            es_password (str): Elasticsearch password
+            kwargs: any other constructor arguments. Clients with different arguments are not shared.
+
+        Returns:
+            ElasticsearchClient: shared client
+        """
+        kwargs['lazy_connection_check'] = True
+        key = (cls, host, str(port), es_username, es_password, tuple(sorted(kwargs.items())))
+        with cls._shared_clients_lock:
+            if key not in cls._shared_clients:
+                cls._shared_clients[key] = cls(
+                    host=host, port=port, es_username=es_username, es_password=es_password, **kwargs)
+            return cls._shared_clients[key]
+
+    def check_connection(self):
+        """Checks the connection to the cluster, if it has not already been checked"""
+        if not self._connection_checked:
+            logger.info(pformat(self.es.info()))
+            self._connection_checked = True
+
+    def create_index(self, index_name, elasticsearch_schema, num_shards=1, _meta=None, routing_partition_size=1):
         """Calls es.indices.create to create an elasticsearch index with the appropriate mapping.
 
         Args:
@@ -53,13 +223,16 @@ class ElasticsearchClient:
             num_shards (int): how many shards the index will contain
             _meta (dict): optional _meta info for this index
                 (see https://www.elastic.co/guide/en/elasticsearch/reference/current/mapping-meta-field.html)
+            routing_partition_size (int): number of shards the documents with the same routing key are spread over
         """
 
         self.create_or_update_mapping(
             index_name, elasticsearch_schema, num_shards=num_shards, _meta=_meta, create_only=True,
+            routing_partition_size=routing_partition_size,
         )
 
-    def create_or_update_mapping(self, index_name, elasticsearch_schema, num_shards=1, _meta=None, create_only=False):
+    def create_or_update_mapping(self, index_name, elasticsearch_schema, num_shards=1, _meta=None, create_only=False,
+                                 routing_partition_size=1):
         """Calls es.indices.create or es.indices.put_mapping to create or update an elasticsearch index mapping.
 
         Args:
@@ -69,7 +242,11 @@ class ElasticsearchClient:
             _meta (dict): optional _meta info for this index
                 (see https://www.elastic.co/guide/en/elasticsearch/reference/current/mapping-meta-field.html)
             create_only (bool): only allow index creation, throws an error if index already exists
+            routing_partition_size (int): number of shards the documents with the same routing key are spread over
+                when creating the index (see get_routing_partition_size). If greater than 1, every document must be
+                indexed with a routing key.
         """
+        self.check_connection()
 
         index_mapping = {
             'properties': elasticsearch_schema,
@@ -90,6 +267,9 @@ class ElasticsearchClient:
                     'index.codec': 'best_compression',  # halves disk usage, no difference in query times
                 }
             }
+            if routing_partition_size > 1:
+                body['settings']['index.routing_partition_size'] = routing_partition_size
+                body['mappings']['_routing'] = {'required': True}
 
             logger.info('create_mapping - elasticsearch schema: \n' + pformat(elasticsearch_schema))
             logger.info('==> creating elasticsearch index {}'.format(index_name))
@@ -122,11 +302,500 @@ class ElasticsearchClient:
             'index.routing.allocation.exclude._name': LOADING_NODES_NAME
         })
 
+    @contextmanager
+    def bulk_load(self, index_name, num_replicas=None, max_num_segments=1, forcemerge_timeout=None,
+                  wait_for_status='green', wait_for_status_timeout='30m'):
+        """Context manager which applies load-optimized settings to an index while bulk loading it.
+
+        On exit, the serving settings are restored and the index is force merged, and then the cluster health is
+        checked for the index. If loading fails, the serving settings are still restored but the index is not merged.
+
+        Args:
+            index_name (str): elasticsearch index name
+            num_replicas (int): number of replicas after loading. Defaults to the number of replicas before loading.
+            max_num_segments (int): number of segments per shard to force merge to. If None, segments are only merged
+                as needed by the merge policy.
+            forcemerge_timeout (int): optional timeout in seconds for the force merge to complete
+            wait_for_status (str): cluster health status to wait for after loading, or None to not wait
+            wait_for_status_timeout (str): how long to wait for the cluster health status
+        """
+        if num_replicas is None:
+            num_replicas = self.get_num_replicas(index_name)
+
+        self._update_settings(index_name, LOAD_INDEX_SETTINGS)
+        try:
+            yield
+        except Exception:
+            self._update_settings(index_name, dict(SERVING_INDEX_SETTINGS, **{'index.number_of_replicas': num_replicas}))
+            raise
+
+        # make all loaded documents part of a segment before merging
+        self.es.indices.refresh(index=index_name, request_timeout=300)
+        self.forcemerge(index_name, max_num_segments=max_num_segments, timeout=forcemerge_timeout)
+
+        self._update_settings(index_name, dict(SERVING_INDEX_SETTINGS, **{'index.number_of_replicas': num_replicas}))
+
+        if wait_for_status:
+            logger.info('==> Waiting for {} status'.format(wait_for_status))
+            health = self.es.cluster.health(
+                index=index_name, wait_for_status=wait_for_status, timeout=wait_for_status_timeout, request_timeout=3600,
+            )
+            if health['timed_out']:
+                raise Exception('Index {} did not reach {} status, current status is {}'.format(
+                    index_name, wait_for_status, health['status']))
+
+    def forcemerge(self, index_name, max_num_segments=None, poll_interval=10, timeout=None):
+        """Force merge an index without holding a request open for the whole merge.
+
+        Large merges can take hours, so if the merge is not done within poll_interval seconds the request is dropped
+        and the merge, which keeps running in elasticsearch, is tracked with the tasks API instead.
+
+        Args:
+            index_name (str): elasticsearch index name
+            max_num_segments (int): number of segments per shard to merge to
+            poll_interval (int): seconds between progress checks
+            timeout (int): optional maximum number of seconds to wait for the merge
+        """
+        logger.info('==> Force merging {} (max_num_segments={})'.format(index_name, max_num_segments))
+        try:
+            self.es.indices.forcemerge(
+                index=index_name, max_num_segments=max_num_segments, request_timeout=poll_interval)
+            return
+        except elasticsearch.ConnectionTimeout:
+            logger.info('==> Force merge of {} is still running'.format(index_name))
+
+        self.wait_for_tasks(FORCEMERGE_TASK_ACTION, index_name, poll_interval=poll_interval, timeout=timeout)
+
+    def get_running_tasks(self, action, index_name):
+        """Returns the running tasks for the given action (which can include wildcards) on the given index"""
+        response = self.es.tasks.list(actions=action, detailed=True)
+        return [
+            task for node in response.get('nodes', {}).values() for task in node.get('tasks', {}).values()
+            if '[{}]'.format(index_name) in task.get('description', '')
+        ]
+
+    def wait_for_tasks(self, action, index_name, poll_interval=10, timeout=None):
+        """Wait until there are no running tasks for the given action on the given index.
+
+        Args:
+            action (str): task action, can include wildcards
+            index_name (str): elasticsearch index name
+            poll_interval (int): seconds between progress checks
+            timeout (int): optional maximum number of seconds to wait
+        """
+        start = time.time()
+        while True:
+            tasks = self.get_running_tasks(action, index_name)
+            if not tasks:
+                logger.info('==> {} tasks for {} completed'.format(action, index_name))
+                return
+
+            running_seconds = max(task['running_time_in_nanos'] for task in tasks) / 1e9
+            logger.info('==> {} {} task(s) running for {} ({:.0f}s)'.format(
+                len(tasks), action, index_name, running_seconds))
+            if timeout is not None and time.time() - start > timeout:
+                raise Exception('Timed out waiting for {} tasks for {}'.format(action, index_name))
+            time.sleep(poll_interval)
+
+    def get_relocation_progress(self, index_name, node_name_pattern=LOADING_NODES_NAME):
+        """Get the progress of moving an index's shards off of the nodes matching the given name pattern.
+
+        Args:
+            index_name (str): elasticsearch index name
+            node_name_pattern (str): name pattern of the nodes shards are being moved off of
+
+        Returns:
+            dict: number of shards still to move or being moved, their total size in bytes, and the bytes already
+                copied by active shard recoveries
+        """
+        shards = self.es.cat.shards(index=index_name, format='json', bytes='b', h='shard,prirep,state,node,store')
+        remaining_shards = [
+            shard for shard in shards
+            if shard['state'] in {'RELOCATING', 'INITIALIZING'} or fnmatch.fnmatch(shard['node'] or '', node_name_pattern)
+        ]
+
+        recovery = self.es.indices.recovery(index=index_name, active_only=True)
+        bytes_recovered = sum(
+            shard['index']['size']['recovered_in_bytes']
+            for index in recovery.values() for shard in index['shards']
+        )
+        return {
+            'shards_remaining': len(remaining_shards),
+            'bytes_remaining': sum(int(shard['store'] or 0) for shard in remaining_shards),
+            'bytes_recovered': bytes_recovered,
+        }
+
+    def wait_for_shards_off_nodes(self, index_name, node_name_pattern=LOADING_NODES_NAME, poll_interval=10, timeout=None,
+                                  progress_callback=None):
+        """Wait until all of an index's shards have moved off of the nodes matching the given name pattern.
+
+        Progress is logged on each check, including the bytes relocated so far and an ETA based on the relocation rate.
+
+        Args:
+            index_name (str): elasticsearch index name
+            node_name_pattern (str): name pattern of the nodes shards are being moved off of
+            poll_interval (int): seconds between progress checks
+            timeout (int): optional maximum number of seconds to wait
+            progress_callback (function): optional function called with the progress dict on each check
+        """
+        start = time.time()
+        initial_bytes = None
+        while True:
+            progress = self.get_relocation_progress(index_name, node_name_pattern=node_name_pattern)
+            bytes_left = max(progress['bytes_remaining'] - progress['bytes_recovered'], 0)
+            if initial_bytes is None:
+                initial_bytes = bytes_left
+            elapsed = time.time() - start
+            progress['bytes_relocated'] = max(initial_bytes - bytes_left, 0)
+            rate = progress['bytes_relocated'] / elapsed if elapsed else 0
+            progress['eta_seconds'] = bytes_left / rate if rate else None
+            if progress_callback:
+                progress_callback(progress)
+
+            if not progress['shards_remaining']:
+                logger.info('==> All {} shards moved off {} nodes'.format(index_name, node_name_pattern))
+                return
+
+            logger.info('==> Waiting for {} {} shards to move off {} nodes: {:.1f} of {:.1f} MB relocated, ETA {}'.format(
+                progress['shards_remaining'], index_name, node_name_pattern, progress['bytes_relocated'] / 1e6,
+                initial_bytes / 1e6, '{:.0f}s'.format(progress['eta_seconds']) if progress['eta_seconds'] else 'unknown',
+            ))
+            if timeout is not None and elapsed > timeout:
+                raise Exception('Shards did not move off {} nodes'.format(node_name_pattern))
+            time.sleep(poll_interval)
+
     def _update_settings(self, index_name, body):
         logger.info('==> Setting {} settings = {}'.format(index_name, body))
 
         self.es.indices.put_settings(index=index_name, body=body)
 
+    def get_num_data_nodes(self):
+        """Returns the number of data nodes in the cluster, including any temporary loading nodes"""
+        nodes = self.es.nodes.info(filter_path='nodes.*.roles').get('nodes', {})
+        return sum(1 for node in nodes.values() if 'data' in node.get('roles', []))
+
+    def get_num_replicas(self, index_name):
+        """Returns the number of replicas of the given index, or of the first index if it is an alias"""
+        settings = self.es.indices.get_settings(index=index_name, name='index.number_of_replicas', flat_settings=True)
+        index_settings = settings.get(index_name) or next(iter(settings.values()))
+        return int(index_settings['settings']['index.number_of_replicas'])
+
     def get_index_meta(self, index_name):
         mappings = self.es.indices.get_mapping(index=index_name)
-        return mappings.get(index_name, {}).get('mappings', {}).get('_meta', {})
+        # if index_name is an alias, the mapping is keyed by the index it points to
+        index_mappings = mappings.get(index_name) or next(iter(mappings.values()), {})
+        return index_mappings.get('mappings', {}).get('_meta', {})
+
+    def get_index_stats(self, index_name):
+        """Get indexing statistics for an index, which are counted even while refreshes are disabled.
+
+        Returns:
+            dict: number of documents indexed into primary shards, store size in bytes of the primary shards, and
+                seconds spent indexing documents and handling bulk requests, summed across the primary shards
+        """
+        stats = self.es.indices.stats(index=index_name, metric='indexing,bulk,store')['_all']['primaries']
+        return {
+            'index_total': stats['indexing']['index_total'],
+            'store_bytes': stats['store']['size_in_bytes'],
+            'indexing_seconds': stats['indexing']['index_time_in_millis'] / 1000,
+            'bulk_seconds': stats.get('bulk', {}).get('total_time_in_millis', 0) / 1000,
+        }
+
+    def get_bulk_rejections(self):
+        """Returns the total number of bulk requests rejected by the write thread pools across the cluster"""
+        thread_pools = self.es.cat.thread_pool(thread_pool_patterns='write', format='json', h='node_name,rejected')
+        return sum(int(thread_pool['rejected']) for thread_pool in thread_pools)
+
+    def get_shard_doc_counts(self, index_name):
+        """Returns the number of documents in each primary shard of an index, keyed by shard number"""
+        shards = self.es.cat.shards(index=index_name, format='json', h='shard,prirep,docs')
+        return {
+            int(shard['shard']): int(shard['docs'] or 0) for shard in shards if shard['prirep'] == 'p'
+        }
+
+    def get_search_routing(self, index_name, xstart, xstop, max_variant_length=None):
+        """Get the routing for a search of the given xpos range, based on the routing scheme in the index _meta.
+
+        Args:
+            index_name (str): elasticsearch index name
+            xstart (int): start of the xpos range
+            xstop (int): end of the xpos range
+            max_variant_length (int): length of the longest variant that starts before the range and should be found
+                by the search. By default variants of any length are found, which for the xpos_bin scheme searches
+                all the bins from the start of the contig.
+
+        Returns:
+            str: comma-separated routing keys to pass as the search routing, or None if the index is not routed
+        """
+        routing = self.get_index_meta(index_name).get('routing')
+        if not routing:
+            return None
+        return ','.join(get_routing_keys_for_xpos_range(
+            xstart, xstop, routing['scheme'], bin_size=routing.get('bin_size', ROUTING_XPOS_BIN_SIZE),
+            max_variant_length=max_variant_length))
+
+    def get_alias_indices(self, alias):
+        """Returns the names of the indices the given alias points to, or an empty list if the alias does not exist"""
+        if not self.es.indices.exists_alias(name=alias):
+            return []
+        return sorted(self.es.indices.get_alias(name=alias).keys())
+
+    def delete_unaliased_versioned_indices(self, alias, older_than=None):
+        """Delete the versioned indices for an alias that it does not point to, which are left behind by loads that
+        failed before swapping the alias.
+
+        Only names created by get_versioned_index_name are matched, so other indices that happen to share the alias
+        prefix are never deleted.
+
+        Args:
+            alias (str): alias that searches use
+            older_than (str): if set, only indices versioned before this index are deleted, so that loads started
+                after it are left alone
+
+        Returns:
+            list: names of the deleted indices
+        """
+        versioned_index_re = re.compile(r'^{}__\d{{8}}_\d{{6}}$'.format(re.escape(alias)))
+        alias_indices = self.get_alias_indices(alias)
+        indices = self.es.cat.indices(index='{}__*'.format(alias), format='json', h='index')
+        unaliased_indices = sorted(
+            index['index'] for index in indices
+            if versioned_index_re.match(index['index']) and index['index'] not in alias_indices and
+            (older_than is None or index['index'] < older_than))
+        for index in unaliased_indices:
+            logger.info('==> Deleting unaliased index {}'.format(index))
+            self.es.indices.delete(index=index)
+        return unaliased_indices
+
+    def swap_alias(self, alias, index_name, delete_previous_indices=True):
+        """Atomically point an alias at a newly loaded index, so searches switch over without any downtime.
+
+        If a regular index already exists with the alias name, for example from before loads used aliases, it is
+        deleted in the same atomic update since an alias can not have the same name as an index.
+
+        Args:
+            alias (str): alias that searches use
+            index_name (str): index to point the alias at
+            delete_previous_indices (bool): whether to delete the indices the alias pointed to before, as well as
+                older versioned indices left behind by failed loads
+        """
+        alias_indices = self.get_alias_indices(alias)
+        previous_indices = [index for index in alias_indices if index != index_name]
+        actions = [{'remove': {'index': index, 'alias': alias}} for index in previous_indices]
+        if not alias_indices and self.es.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index_name, 'alias': alias}})
+
+        logger.info('==> Pointing alias {} at {}'.format(alias, index_name))
+        self.es.indices.update_aliases(body={'actions': actions})
+
+        if delete_previous_indices:
+            for index in previous_indices:
+                logger.info('==> Deleting previous index {}'.format(index))
+                self.es.indices.delete(index=index)
+            self.delete_unaliased_versioned_indices(alias, older_than=index_name)
+
+    def bulk_export(self, actions, num_workers=4, chunk_size=1000, max_chunk_bytes=10 * 1024 * 1024,
+                    max_queued_chunks=4, max_retries=5, initial_backoff=2, max_backoff=60, raise_on_error=True,
+                    request_timeout=300, compress_level=None, ignore_conflicts=False):
+        """Export the given bulk actions to elasticsearch using a pool of worker threads.
+
+        Actions are consumed lazily and split into chunks limited both by document count and by serialized size. At
+        most num_workers + max_queued_chunks chunks are held in memory at once, so a slow cluster applies backpressure
+        to the caller instead of buffering the whole export. Documents rejected with a 429 or 503 status are resent
+        with exponential backoff.
+
+        Statistics for each chunk, including its raw size, the size sent on the wire, the number of rejected documents
+        and the time spent sending it, are returned rather than stored on the client, which may be shared by exports
+        running at the same time (see get_shared_client).
+
+        Args:
+            actions (iterable): bulk actions in the format accepted by elasticsearch.helpers.bulk
+            num_workers (int): number of bulk requests to send in parallel
+            chunk_size (int): maximum number of documents per bulk request
+            max_chunk_bytes (int): maximum size in bytes of a bulk request body
+            max_queued_chunks (int): maximum number of chunks waiting for a free worker
+            max_retries (int): maximum number of times to resend rejected documents
+            initial_backoff (float): seconds to wait before the first retry, doubled for each following retry
+            max_backoff (float): maximum number of seconds to wait between retries
+            raise_on_error (bool): whether to raise a BulkIndexError if any documents fail to index
+            request_timeout (int): timeout in seconds for each bulk request
+            compress_level (int): if set, gzip each bulk request body with this compression level (1-9). Lower levels
+                are faster, higher levels send fewer bytes.
+            ignore_conflicts (bool): whether to skip documents rejected with a 409 version conflict instead of treating
+                them as errors. With create actions, this skips documents that already exist, so an interrupted export
+                can be rerun without overwriting documents that were already written.
+
+        Returns:
+            tuple: number of successfully indexed documents, list of errors and list of statistics for each chunk
+        """
+        self.check_connection()
+        if compress_level is not None and self._http_compress:
+            logger.info('Client already compresses all requests, ignoring compress_level')
+            compress_level = None
+        futures = []
+        failed = threading.Event()
+        in_flight_chunks = threading.BoundedSemaphore(num_workers + max_queued_chunks)
+
+        def _on_chunk_done(future):
+            in_flight_chunks.release()
+            if future.exception():
+                failed.set()
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for chunk in self._chunk_bulk_actions(actions, chunk_size, max_chunk_bytes):
+                in_flight_chunks.acquire()
+                if failed.is_set():
+                    break
+                future = executor.submit(
+                    self._send_bulk_chunk, chunk, max_retries=max_retries, initial_backoff=initial_backoff,
+                    max_backoff=max_backoff, request_timeout=request_timeout, compress_level=compress_level,
+                    ignore_conflicts=ignore_conflicts,
+                )
+                future.add_done_callback(_on_chunk_done)
+                futures.append(future)
+
+        # re-raises the first error from any of the workers
+        results = [future.result() for future in futures]
+        success_count = sum(result[0] for result in results)
+        errors = [error for result in results for error in result[1]]
+        chunk_stats = [result[2] for result in results]
+        retry_count = sum(stats['retries'] for stats in chunk_stats)
+        conflict_count = sum(stats['conflicts'] for stats in chunk_stats)
+        logger.info('==> bulk export indexed {} documents in {} requests ({} retries, {} errors, {} conflicts)'.format(
+            success_count, len(results), retry_count, len(errors), conflict_count))
+        raw_bytes = sum(stats['raw_bytes'] for stats in chunk_stats)
+        wire_bytes = sum(stats['wire_bytes'] for stats in chunk_stats)
+        logger.info('==> sent {:.1f} MB of bulk requests as {:.1f} MB on the wire'.format(
+            raw_bytes / 1e6, wire_bytes / 1e6))
+
+        if errors and raise_on_error:
+            raise es_helpers.BulkIndexError('{} document(s) failed to index.'.format(len(errors)), errors)
+
+        return success_count, errors, chunk_stats
+
+    def _encode_bulk_action(self, action):
+        """Serialize a bulk action line. Action lines for a load usually only differ by document ID, so everything
+        except the ID is encoded once and cached."""
+        if isinstance(action, str):
+            return action.encode('utf-8')
+        (op_type, metadata), = action.items()
+        if '_id' not in metadata:
+            return self.bulk_serializer.dumps(action)
+
+        prefix_key = (op_type, tuple((key, value) for key, value in metadata.items() if key != '_id'))
+        try:
+            template = self._action_templates.get(prefix_key)
+        except TypeError:
+            # unhashable metadata values can not be cached
+            return self.bulk_serializer.dumps(action)
+        if template is None:
+            # Serialize the action with a null ID and split it around the ID, e.g. for {'index': {'_index': 'my_index'}}
+            # the template is (b'{"index":{"_index":"my_index","_id":', b'}}')
+            encoded = self.bulk_serializer.dumps({op_type: dict(prefix_key[1], _id=None)})
+            id_index = encoded.rindex(b'null')
+            template = (encoded[:id_index], encoded[id_index + len(b'null'):])
+            if len(self._action_templates) < MAX_CACHED_ACTION_TEMPLATES:
+                self._action_templates[prefix_key] = template
+        # IDs are serialized in a list so strings are always quoted
+        return template[0] + self.bulk_serializer.dumps([metadata['_id']])[1:-1] + template[1]
+
+    def _chunk_bulk_actions(self, actions, chunk_size, max_chunk_bytes):
+        """Serialize bulk actions into NDJSON bulk request bodies.
+
+        Lines are written into a single reusable buffer, which is copied out once per chunk. Each chunk is a tuple of
+        the body and the (start, end) offsets of each action within it, so rejected actions can be resent.
+        """
+        buffer = bytearray()
+        offsets = []
+        for action in actions:
+            action, data = es_helpers.expand_action(action)
+            action_line = self._encode_bulk_action(action)
+            data_line = self.bulk_serializer.dumps(data) if data is not None else None
+            # account for the newline at the end of each line
+            line_bytes = len(action_line) + 1 + (len(data_line) + 1 if data_line is not None else 0)
+            if offsets and (len(offsets) >= chunk_size or len(buffer) + line_bytes > max_chunk_bytes):
+                yield bytes(buffer), offsets
+                buffer.clear()
+                offsets = []
+
+            start = len(buffer)
+            buffer += action_line
+            buffer += b'\n'
+            if data_line is not None:
+                buffer += data_line
+                buffer += b'\n'
+            offsets.append((start, len(buffer)))
+
+        if offsets:
+            yield bytes(buffer), offsets
+
+    @staticmethod
+    def _get_bulk_sub_chunk(body, offsets):
+        """Get the chunk of only the actions at the given offsets in a bulk request body"""
+        sub_chunk_offsets = []
+        sub_chunk_bytes = 0
+        for start, end in offsets:
+            sub_chunk_offsets.append((sub_chunk_bytes, sub_chunk_bytes + end - start))
+            sub_chunk_bytes += end - start
+        return b''.join(body[start:end] for start, end in offsets), sub_chunk_offsets
+
+    def _send_bulk_request(self, body, request_timeout, compress_level):
+        """Send a bulk request body, optionally gzipped"""
+        if compress_level is None:
+            return self.es.bulk(body=body, request_timeout=request_timeout)
+
+        # es.bulk appends a newline to bodies which do not end with one, so compressed bodies are sent directly
+        return self.es.transport.perform_request(
+            'POST', '/_bulk', body=body, params={'request_timeout': request_timeout},
+            headers={'content-type': 'application/x-ndjson', 'content-encoding': 'gzip'},
+        )
+
+    def _send_bulk_chunk(self, chunk, max_retries, initial_backoff, max_backoff, request_timeout, compress_level=None,
+                         ignore_conflicts=False):
+        """Send a single chunk of serialized bulk actions, resending any documents rejected due to load"""
+        body, offsets = chunk
+        success_count = 0
+        errors = []
+        stats = {
+            'docs': len(offsets), 'raw_bytes': 0, 'wire_bytes': 0, 'retries': 0, 'rejected': 0, 'conflicts': 0,
+            'seconds': 0,
+        }
+        start = time.time()
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(min(max_backoff, initial_backoff * 2 ** (attempt - 1)))
+            wire_body = gzip.compress(body, compresslevel=compress_level) if compress_level is not None else body
+            stats['retries'] = attempt
+            stats['raw_bytes'] += len(body)
+            stats['wire_bytes'] += len(wire_body)
+
+            try:
+                response = self._send_bulk_request(wire_body, request_timeout, compress_level)
+            except elasticsearch.TransportError as e:
+                if e.status_code in BULK_RETRY_STATUS_CODES and attempt < max_retries:
+                    logger.info('Bulk request rejected with status {}, retrying'.format(e.status_code))
+                    stats['rejected'] += len(offsets)
+                    continue
+                raise
+
+            retry_offsets = []
+            for offset, item in zip(offsets, response['items']):
+                op_type, result = next(iter(item.items()))
+                if 200 <= result.get('status', 500) < 300:
+                    success_count += 1
+                elif result['status'] in BULK_RETRY_STATUS_CODES and attempt < max_retries:
+                    retry_offsets.append(offset)
+                elif result['status'] == 409 and ignore_conflicts:
+                    stats['conflicts'] += 1
+                else:
+                    errors.append({op_type: result})
+
+            if not retry_offsets:
+                break
+            logger.info('{} documents rejected, retrying'.format(len(retry_offsets)))
+            stats['rejected'] += len(retry_offsets)
+            body, offsets = self._get_bulk_sub_chunk(body, retry_offsets)
+
+        stats['seconds'] = time.time() - start
+        return success_count, errors, stats
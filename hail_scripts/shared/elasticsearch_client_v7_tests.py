@@ -0,0 +1,656 @@
+import gzip
+import json
+import math
+import random
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import elasticsearch
+from elasticsearch import helpers as es_helpers
+
+from hail_scripts.shared.elasticsearch_client_v7 import (
+    ElasticsearchClient, JsonBulkSerializer, get_versioned_index_name, orjson,
+)
+from hail_scripts.shared.elasticsearch_utils import (
+    get_bulk_action, get_bulk_source, get_routing_key, get_routing_partition_size,
+)
+
+
+class FakeElasticsearchServer:
+    """Minimal local stand-in for the elasticsearch HTTP API, used to measure bulk export behavior offline.
+
+    Bulk requests are parsed and the documents stored by index and ID. The first reject_bulk_requests bulk requests
+    are rejected entirely, and the first reject_bulk_items documents are rejected individually, both with
+    reject_status. Each bulk request waits bulk_latency seconds before responding to simulate indexing time.
+
+    Documents are assigned to shards by a hash of their routing key or ID, spread over index.routing_partition_size
+    shards by their ID if it is set. Searches support a range query on a single field, and only search the shards for
+    the routing keys given, if any. Each search waits search_shard_latency seconds for every search_threads shards
+    searched.
+    """
+
+    def __init__(self, reject_bulk_requests=0, reject_bulk_items=0, reject_status=429, bulk_latency=0,
+                 search_shard_latency=0, search_threads=4):
+        self.reject_bulk_requests = reject_bulk_requests
+        self.reject_bulk_items = reject_bulk_items
+        self.reject_status = reject_status
+        self.bulk_latency = bulk_latency
+        self.search_shard_latency = search_shard_latency
+        self.search_threads = search_threads
+        self.docs = {}
+        self.doc_shards = {}
+        self.settings = {}
+        self.meta = {}
+        self.requests = []
+        self.bulk_request_count = 0
+        self.max_bulk_body_bytes = 0
+        self.bulk_wire_bytes = 0
+        self.max_concurrent_bulk_requests = 0
+        self._concurrent_bulk_requests = 0
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(('localhost', 0), self._request_handler())
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, path, body, headers):
+        """Returns a (status, response) tuple for the given request"""
+        path, _, query = path.partition('?')
+        with self._lock:
+            self.requests.append((method, path, headers))
+        if path.endswith('/_bulk'):
+            with self._lock:
+                self.bulk_wire_bytes += len(body)
+            if {k.lower(): v for k, v in headers.items()}.get('content-encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return self._handle_bulk(body)
+        if path.endswith('/_search'):
+            return self._handle_search(path.split('/')[1], json.loads(body), parse_qs(query).get('routing'))
+        if path.endswith('/_mapping') and method == 'GET':
+            index_name = path.split('/')[1]
+            return 200, {index_name: {'mappings': {'_meta': self.meta.get(index_name, {})}}}
+        if method == 'GET' and path == '/':
+            return 200, {'name': 'fake', 'cluster_name': 'fake', 'version': {'number': '7.9.1'}}
+        if method == 'GET' and path == '/_nodes':
+            return 200, {'nodes': {
+                'data-0': {'roles': ['data', 'ingest']},
+                'data-loading-0': {'roles': ['data']},
+                'master-0': {'roles': ['master']},
+            }}
+        if path.startswith('/_cluster/health'):
+            return 200, {'status': 'green', 'timed_out': False}
+        if method == 'HEAD':
+            return (200 if path.strip('/') in self.docs else 404), None
+        if method == 'PUT' and path.count('/') == 1:
+            index_name = path.strip('/')
+            self.docs.setdefault(index_name, {})
+            settings = json.loads(body).get('settings', {}) if body else {}
+            self.meta[index_name] = json.loads(body).get('mappings', {}).get('_meta', {}) if body else {}
+            self.settings[index_name] = {
+                key if key.startswith('index.') else 'index.{}'.format(key): str(value) for key, value in settings.items()
+            }
+        if path.endswith('/_settings') and method == 'PUT':
+            index_settings = self.settings.setdefault(path.split('/')[1], {})
+            for key, value in json.loads(body).items():
+                if value is None:
+                    index_settings.pop(key, None)
+                else:
+                    index_settings[key] = str(value)
+        if '/_settings' in path and method == 'GET':
+            index_name = path.split('/')[1]
+            return 200, {index_name: {'settings': self.settings.get(index_name, {})}}
+        return 200, {'acknowledged': True}
+
+    def _handle_bulk(self, body):
+        with self._lock:
+            self.bulk_request_count += 1
+            self.max_bulk_body_bytes = max(self.max_bulk_body_bytes, len(body))
+            reject_request = self.bulk_request_count <= self.reject_bulk_requests
+            self._concurrent_bulk_requests += 1
+            self.max_concurrent_bulk_requests = max(self.max_concurrent_bulk_requests, self._concurrent_bulk_requests)
+
+        time.sleep(self.bulk_latency)
+        try:
+            if reject_request:
+                return self.reject_status, {'error': 'rejected', 'status': self.reject_status}
+
+            lines = body.decode('utf-8').splitlines()
+            items = []
+            for action_line, source_line in zip(lines[::2], lines[1::2]):
+                op_type, action = next(iter(json.loads(action_line).items()))
+                status = 201
+                with self._lock:
+                    index_docs = self.docs.setdefault(action['_index'], {})
+                    if self.reject_bulk_items > 0:
+                        self.reject_bulk_items -= 1
+                        status = self.reject_status
+                    elif op_type == 'create' and action['_id'] in index_docs:
+                        status = 409
+                    else:
+                        index_docs[action['_id']] = json.loads(source_line)
+                        self.doc_shards.setdefault(action['_index'], {})[action['_id']] = self._get_shard(
+                            action['_index'], action.get('routing', action.get('_routing', action['_id'])),
+                            action['_id'])
+                items.append({op_type: {'_index': action['_index'], '_id': action['_id'], 'status': status}})
+            return 200, {'took': 1, 'errors': False, 'items': items}
+        finally:
+            with self._lock:
+                self._concurrent_bulk_requests -= 1
+
+    def _get_routing_shards(self, index_name, routing):
+        index_settings = self.settings.get(index_name, {})
+        num_shards = int(index_settings.get('index.number_of_shards', 1))
+        routing_partition_size = int(index_settings.get('index.routing_partition_size', 1))
+        routing_hash = zlib.crc32(str(routing).encode('utf-8'))
+        return [(routing_hash + i) % num_shards for i in range(routing_partition_size)]
+
+    def _get_shard(self, index_name, routing, doc_id):
+        shards = self._get_routing_shards(index_name, routing)
+        return shards[zlib.crc32(str(doc_id).encode('utf-8')) % len(shards)]
+
+    def _handle_search(self, index_name, body, routing):
+        num_shards = int(self.settings.get(index_name, {}).get('index.number_of_shards', 1))
+        if routing:
+            shards = {shard for key in routing[0].split(',') for shard in self._get_routing_shards(index_name, key)}
+        else:
+            shards = set(range(num_shards))
+        time.sleep(math.ceil(len(shards) / self.search_threads) * self.search_shard_latency)
+
+        (field, value_range), = body['query']['range'].items()
+        doc_shards = self.doc_shards.get(index_name, {})
+        hits = [
+            {'_id': doc_id, '_source': doc} for doc_id, doc in self.docs.get(index_name, {}).items()
+            if doc_shards.get(doc_id) in shards and value_range['gte'] <= doc[field] <= value_range['lte']
+        ]
+        return 200, {
+            '_shards': {'total': len(shards), 'successful': len(shards), 'failed': 0},
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': hits},
+        }
+
+    def _request_handler(self):
+        server = self
+
+        class FakeElasticsearchRequestHandler(BaseHTTPRequestHandler):
+
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, response = server.handle(self.command, self.path, body, dict(self.headers))
+                response_body = json.dumps(response).encode('utf-8') if response is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(response_body)
+
+            do_GET = do_PUT = do_POST = do_HEAD = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return FakeElasticsearchRequestHandler
+
+
+def get_test_actions(num_docs, index_name='test_index'):
+    return ({
+        '_index': index_name,
+        '_op_type': 'index',
+        '_id': 'variant_{}'.format(i),
+        '_source': {'variantId': 'variant_{}'.format(i), 'samples': ['SAMPLE-{}'.format(j) for j in range(20)]},
+    } for i in range(num_docs))
+
+
+def get_sv_test_actions(num_docs, index_name='test_index'):
+    """Bulk actions for documents shaped like those exported by the SV loader"""
+    for i in range(num_docs):
+        sample_ids = ['SAMPLE-{}'.format(j) for j in range(i % 7, i % 7 + 10)]
+        yield {
+            '_index': index_name,
+            '_op_type': 'index',
+            '_id': 'prefix_{}_DEL'.format(i),
+            '_source': {
+                'contig': '1', 'sc': 10, 'sf': 0.0125, 'sn': 800, 'svType': 'DEL', 'variantId': 'prefix_{}_DEL'.format(i),
+                'start': 1000 + i, 'end': 5000 + i, 'pos': 1000 + i, 'num_exon': 2, 'xpos': 1000001000 + i,
+                'xstart': 1000001000 + i, 'xstop': 1000005000 + i, 'StrVCTVRE_score': 0.75,
+                'geneIds': ['ENSG00000186092', 'ENSG00000227232'], 'transcriptConsequenceTerms': ['DEL'],
+                'sortedTranscriptConsequences': [{'gene_id': 'ENSG00000186092'}, {'gene_id': 'ENSG00000227232'}],
+                'samples': sample_ids, 'samples_cn_1': sample_ids, 'samples_qs_30_to_40': sample_ids[:5],
+                'samples_qs_50_to_60': sample_ids[5:],
+                'genotypes': [
+                    {'sample_id': sample_id, 'qs': 33, 'cn': 1, 'defragged': False, 'start': 1001 + i, 'end': 4999 + i}
+                    for sample_id in sample_ids
+                ],
+            },
+        }
+
+
+def get_variant_test_rows(num_rows):
+    """Rows shaped like collected seqr variant rows, with nested structs, sets and missing values"""
+    for i in range(num_rows):
+        yield {
+            'docId': '1-{}-A-G'.format(i), 'contig': '1', 'start': i, 'filters': {'PASS'}, 'AF': None,
+            'transcriptConsequenceTerms': ('missense_variant', 'intron_variant'),
+            'genotypes': [{'sample_id': 'S{}'.format(j), 'gq': 99, 'ab': None} for j in range(10)],
+        }
+
+
+class ElasticsearchClientV7Test(unittest.TestCase):
+
+    def test_get_shared_client(self):
+        with FakeElasticsearchServer() as server:
+            client = ElasticsearchClient.get_shared_client(port=server.port, pool_size=4)
+            self.assertEqual(server.requests, [])
+            self.assertIs(ElasticsearchClient.get_shared_client(port=str(server.port), pool_size=4), client)
+            self.assertIsNot(ElasticsearchClient.get_shared_client(port=server.port), client)
+            self.assertIsNot(ElasticsearchClient.get_shared_client(port=server.port, es_password='pw', pool_size=4), client)
+            self.assertEqual(client.es.transport.get_connection().pool.pool.maxsize, 4)
+
+            # the connection is only checked on first use
+            client.bulk_export(get_test_actions(10))
+            client.bulk_export(get_test_actions(10))
+            self.assertEqual([path for method, path, _ in server.requests if method == 'GET'], ['/'])
+
+    def test_get_num_data_nodes(self):
+        with FakeElasticsearchServer() as server:
+            client = ElasticsearchClient(port=server.port)
+            self.assertEqual(client.get_num_data_nodes(), 2)
+
+    def test_bulk_load(self):
+        with FakeElasticsearchServer() as server:
+            client = ElasticsearchClient(port=server.port)
+            client.create_index('test_index', {}, num_shards=2)
+            server.settings['test_index']['index.number_of_replicas'] = '2'
+
+            with client.bulk_load('test_index'):
+                self.assertDictEqual(server.settings['test_index'], {
+                    'index.number_of_shards': '2', 'index.number_of_replicas': '0', 'index.refresh_interval': '-1',
+                    'index.translog.durability': 'async', 'index.translog.flush_threshold_size': '1gb',
+                    'index.mapping.total_fields.limit': '10000', 'index.codec': 'best_compression',
+                })
+                client.bulk_export(get_test_actions(10))
+
+            self.assertDictEqual(server.settings['test_index'], {
+                'index.number_of_shards': '2', 'index.number_of_replicas': '2',
+                'index.mapping.total_fields.limit': '10000', 'index.codec': 'best_compression',
+            })
+            request_paths = [path for _, path, _ in server.requests]
+            self.assertListEqual(request_paths[-4:], [
+                '/test_index/_refresh', '/test_index/_forcemerge', '/test_index/_settings',
+                '/_cluster/health/test_index',
+            ])
+
+            # settings are restored but the index is not merged if loading fails
+            server.requests = []
+            with self.assertRaises(ValueError):
+                with client.bulk_load('test_index', num_replicas=1):
+                    raise ValueError()
+            self.assertEqual(server.settings['test_index']['index.number_of_replicas'], '1')
+            self.assertNotIn('index.translog.durability', server.settings['test_index'])
+            self.assertListEqual([path for _, path, _ in server.requests], ['/test_index/_settings'] * 2)
+
+    @mock.patch('hail_scripts.shared.elasticsearch_client_v7.time.sleep')
+    def test_forcemerge(self, mock_sleep):
+        client = ElasticsearchClient(lazy_connection_check=True)
+        client.es = mock.MagicMock()
+        client.forcemerge('test_index', max_num_segments=1)
+        client.es.indices.forcemerge.assert_called_with(index='test_index', max_num_segments=1, request_timeout=10)
+        client.es.tasks.list.assert_not_called()
+
+        # a merge that outlasts the request is tracked with the tasks API
+        client.es.indices.forcemerge.side_effect = elasticsearch.ConnectionTimeout('TIMEOUT', 'timed out', None)
+        merge_task = {'description': 'Force-merge indices [test_index], maxSegments[1]', 'running_time_in_nanos': 1e9}
+        other_task = {'description': 'Force-merge indices [other_index], maxSegments[1]', 'running_time_in_nanos': 1e9}
+        client.es.tasks.list.side_effect = [
+            {'nodes': {'node1': {'tasks': {'t1': merge_task, 't2': other_task}}}},
+            {'nodes': {'node1': {'tasks': {'t1': merge_task}}}},
+            {'nodes': {'node1': {'tasks': {'t2': other_task}}}},
+        ]
+        client.forcemerge('test_index', max_num_segments=1)
+        self.assertEqual(client.es.tasks.list.call_count, 3)
+        client.es.tasks.list.assert_called_with(actions='indices:admin/forcemerge*', detailed=True)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        client.es.tasks.list.side_effect = None
+        client.es.tasks.list.return_value = {'nodes': {'node1': {'tasks': {'t1': merge_task}}}}
+        with self.assertRaises(Exception):
+            client.forcemerge('test_index', timeout=-1)
+
+    @mock.patch('hail_scripts.shared.elasticsearch_client_v7.time.sleep')
+    def test_wait_for_shards_off_nodes(self, mock_sleep):
+        client = ElasticsearchClient(lazy_connection_check=True)
+        client.es = mock.MagicMock()
+        client.es.cat.shards.side_effect = [
+            [
+                {'shard': '0', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-loading-0', 'store': '1000'},
+                {'shard': '1', 'prirep': 'p', 'state': 'RELOCATING', 'node': 'elasticsearch-es-data-loading-1', 'store': '3000'},
+                {'shard': '2', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-0', 'store': '2000'},
+            ],
+            [
+                {'shard': '0', 'prirep': 'p', 'state': 'RELOCATING', 'node': 'elasticsearch-es-data-loading-0', 'store': '1000'},
+                {'shard': '1', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-1', 'store': '3000'},
+                {'shard': '2', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-0', 'store': '2000'},
+            ],
+            [
+                {'shard': '0', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-2', 'store': '1000'},
+                {'shard': '1', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-1', 'store': '3000'},
+                {'shard': '2', 'prirep': 'p', 'state': 'STARTED', 'node': 'elasticsearch-es-data-0', 'store': '2000'},
+            ],
+        ]
+        client.es.indices.recovery.side_effect = [
+            {'test_index': {'shards': [{'index': {'size': {'recovered_in_bytes': 1000}}}]}},
+            {'test_index': {'shards': [{'index': {'size': {'recovered_in_bytes': 500}}}]}},
+            {},
+        ]
+
+        progress = []
+        client.wait_for_shards_off_nodes('test_index', progress_callback=progress.append)
+
+        self.assertListEqual([p['shards_remaining'] for p in progress], [2, 1, 0])
+        self.assertListEqual([p['bytes_remaining'] for p in progress], [4000, 1000, 0])
+        self.assertListEqual([p['bytes_relocated'] for p in progress], [0, 2500, 3000])
+        self.assertIsNone(progress[0]['eta_seconds'])
+        self.assertEqual(mock_sleep.call_count, 2)
+        client.es.cat.shards.assert_called_with(
+            index='test_index', format='json', bytes='b', h='shard,prirep,state,node,store')
+
+    def test_delete_unaliased_versioned_indices(self):
+        client = ElasticsearchClient(lazy_connection_check=True)
+        client.es = mock.MagicMock()
+        client.es.indices.exists_alias.return_value = True
+        client.es.indices.get_alias.return_value = {'test_index__20200101_000000': {'aliases': {'test_index': {}}}}
+        client.es.cat.indices.return_value = [
+            {'index': 'test_index__20200101_000000'},
+            {'index': 'test_index__20200201_000000'},
+            {'index': 'test_index__foo'},
+            {'index': 'test_index__20200201_000000_backup'},
+        ]
+
+        self.assertListEqual(client.delete_unaliased_versioned_indices('test_index'), ['test_index__20200201_000000'])
+        client.es.cat.indices.assert_called_with(index='test_index__*', format='json', h='index')
+        client.es.indices.delete.assert_called_once_with(index='test_index__20200201_000000')
+
+        # indices of loads started after the given index are kept
+        client.es.reset_mock()
+        self.assertListEqual(
+            client.delete_unaliased_versioned_indices('test_index', older_than='test_index__20200115_000000'), [])
+        client.es.indices.delete.assert_not_called()
+
+    def test_swap_alias(self):
+        self.assertRegex(get_versioned_index_name('test_index'), r'^test_index__\d{8}_\d{6}$')
+
+        client = ElasticsearchClient(lazy_connection_check=True)
+        client.es = mock.MagicMock()
+        client.es.indices.exists_alias.return_value = True
+        client.es.indices.get_alias.return_value = {'test_index__20200101_000000': {'aliases': {'test_index': {}}}}
+        client.swap_alias('test_index', 'test_index__20200201_000000')
+        client.es.indices.update_aliases.assert_called_with(body={'actions': [
+            {'remove': {'index': 'test_index__20200101_000000', 'alias': 'test_index'}},
+            {'add': {'index': 'test_index__20200201_000000', 'alias': 'test_index'}},
+        ]})
+        client.es.indices.delete.assert_called_once_with(index='test_index__20200101_000000')
+
+        # after the swap, indices left by older failed loads are deleted but not those of newer loads
+        client.es.reset_mock()
+        client.es.indices.get_alias.return_value = {'test_index__20200201_000000': {'aliases': {'test_index': {}}}}
+        client.es.cat.indices.return_value = [
+            {'index': 'test_index__20200115_000000'},
+            {'index': 'test_index__20200201_000000'},
+            {'index': 'test_index__20200301_000000'},
+            {'index': 'test_index__foo'},
+        ]
+        client.swap_alias('test_index', 'test_index__20200201_000000')
+        client.es.indices.delete.assert_called_once_with(index='test_index__20200115_000000')
+
+        # a regular index with the alias name is replaced in the same atomic update
+        client.es.reset_mock()
+        client.es.indices.exists_alias.return_value = False
+        client.es.indices.exists.return_value = True
+        client.es.cat.indices.return_value = []
+        client.swap_alias('test_index', 'test_index__20200201_000000')
+        client.es.indices.update_aliases.assert_called_with(body={'actions': [
+            {'remove_index': {'index': 'test_index'}},
+            {'add': {'index': 'test_index__20200201_000000', 'alias': 'test_index'}},
+        ]})
+        client.es.indices.delete.assert_not_called()
+
+        # the mapping and settings of an alias are keyed by the index it points to
+        client.es.indices.get_mapping.return_value = {
+            'test_index__20200201_000000': {'mappings': {'_meta': {'genomeVersion': '38'}}}}
+        self.assertDictEqual(client.get_index_meta('test_index'), {'genomeVersion': '38'})
+        client.es.indices.get_settings.return_value = {
+            'test_index__20200201_000000': {'settings': {'index.number_of_replicas': '1'}}}
+        self.assertEqual(client.get_num_replicas('test_index'), 1)
+
+    def test_export_stats(self):
+        client = ElasticsearchClient(lazy_connection_check=True)
+        client.es = mock.MagicMock()
+        client.es.indices.stats.return_value = {'_all': {'primaries': {
+            'indexing': {'index_total': 1000, 'index_time_in_millis': 2500},
+            'bulk': {'total_time_in_millis': 4000},
+            'store': {'size_in_bytes': 10000},
+        }}}
+        self.assertDictEqual(client.get_index_stats('test_index'), {
+            'index_total': 1000, 'store_bytes': 10000, 'indexing_seconds': 2.5, 'bulk_seconds': 4,
+        })
+
+        client.es.cat.thread_pool.return_value = [
+            {'node_name': 'data-0', 'rejected': '3'}, {'node_name': 'data-1', 'rejected': '0'}]
+        self.assertEqual(client.get_bulk_rejections(), 3)
+
+        client.es.cat.shards.return_value = [
+            {'shard': '0', 'prirep': 'p', 'docs': '400'}, {'shard': '0', 'prirep': 'r', 'docs': '400'},
+            {'shard': '1', 'prirep': 'p', 'docs': '600'}, {'shard': '2', 'prirep': 'p', 'docs': None},
+        ]
+        self.assertDictEqual(client.get_shard_doc_counts('test_index'), {0: 400, 1: 600, 2: 0})
+
+    def test_bulk_export(self):
+        with FakeElasticsearchServer() as server:
+            client = ElasticsearchClient(port=server.port)
+            success_count, errors, chunk_stats = client.bulk_export(get_test_actions(2500), chunk_size=1000)
+
+            self.assertEqual(success_count, 2500)
+            self.assertListEqual(errors, [])
+            self.assertListEqual([stats['docs'] for stats in chunk_stats], [1000, 1000, 500])
+            self.assertEqual(len(server.docs['test_index']), 2500)
+            self.assertEqual(server.bulk_request_count, 3)
+            server.max_bulk_body_bytes = 0
+
+            # chunks are also limited by size
+            success_count, _, _ = client.bulk_export(get_test_actions(100), chunk_size=1000, max_chunk_bytes=5000)
+            self.assertEqual(success_count, 100)
+            self.assertEqual(server.bulk_request_count, 10)
+            self.assertLessEqual(server.max_bulk_body_bytes, 5000)
+
+    def test_bulk_export_retries(self):
+        with FakeElasticsearchServer(reject_bulk_requests=2, reject_bulk_items=10, reject_status=503) as server:
+            client = ElasticsearchClient(port=server.port)
+            success_count, errors, _ = client.bulk_export(
+                get_test_actions(100), num_workers=1, chunk_size=50, initial_backoff=0.01)
+
+            self.assertEqual(success_count, 100)
+            self.assertListEqual(errors, [])
+            self.assertEqual(len(server.docs['test_index']), 100)
+            # 2 rejected requests, 2 accepted chunks and 1 request resending the 10 rejected documents
+            self.assertEqual(server.bulk_request_count, 5)
+
+        with FakeElasticsearchServer(reject_bulk_items=200) as server:
+            client = ElasticsearchClient(port=server.port)
+            with self.assertRaises(es_helpers.BulkIndexError) as ee:
+                client.bulk_export(get_test_actions(10), max_retries=2, initial_backoff=0.01)
+            self.assertEqual(str(ee.exception.args[0]), '10 document(s) failed to index.')
+            self.assertEqual(server.bulk_request_count, 3)
+
+    def test_bulk_export_ignore_conflicts(self):
+        with FakeElasticsearchServer() as server:
+            client = ElasticsearchClient(port=server.port)
+            actions = [dict(action, _op_type='create') for action in get_test_actions(100)]
+            client.bulk_export(actions[:60], chunk_size=25)
+            server.docs['test_index'][actions[0]['_id']] = 'first write'
+
+            # a rerun of an interrupted export skips the documents that were already written
+            success_count, errors, chunk_stats = client.bulk_export(actions, chunk_size=25, ignore_conflicts=True)
+            self.assertEqual(success_count, 40)
+            self.assertListEqual(errors, [])
+            self.assertEqual(sum(stats['conflicts'] for stats in chunk_stats), 60)
+            self.assertEqual(len(server.docs['test_index']), 100)
+            self.assertEqual(server.docs['test_index'][actions[0]['_id']], 'first write')
+
+            with self.assertRaises(es_helpers.BulkIndexError):
+                client.bulk_export(actions, chunk_size=25)
+
+    def test_bulk_serializers(self):
+        actions = list(get_sv_test_actions(100)) + [
+            {'_index': 'test_index', '_op_type': 'update', '_id': 12, 'routing': 'chr1', 'doc': {'a': 'é', 'b': None}},
+            {'_index': 'test_index', '_source': {'a': 1}},
+            '{"a": 2}',
+        ]
+        with FakeElasticsearchServer() as server:
+            client = ElasticsearchClient(port=server.port)
+            self.assertIsInstance(client.bulk_serializer, JsonBulkSerializer)
+            expected_bodies = [body for body, _ in client._chunk_bulk_actions(actions, 40, 10 * 1024 * 1024)]
+            self.assertEqual(len(expected_bodies), 3)
+            self.assertListEqual(
+                [json.loads(line) for line in expected_bodies[0].splitlines()[:2]],
+                [{'index': {'_id': 'prefix_0_DEL', '_index': 'test_index'}}, actions[0]['_source']])
+            self.assertListEqual(
+                [json.loads(line) for line in expected_bodies[-1].splitlines()[-6:]],
+                [{'update': {'_id': 12, '_index': 'test_index', 'routing': 'chr1'}}, {'doc': {'a': 'é', 'b': None}},
+                 {'index': {'_index': 'test_index'}}, {'a': 1}, {'index': {}}, {'a': 2}])
+
+            with self.assertRaises(ValueError):
+                ElasticsearchClient(port=server.port, serializer='unknown')
+
+            if orjson is not None:
+                client = ElasticsearchClient(port=server.port, serializer='orjson')
+                self.assertEqual(client.bulk_serializer.name, 'orjson')
+                bodies = [body for body, _ in client._chunk_bulk_actions(actions, 40, 10 * 1024 * 1024)]
+                self.assertListEqual(
+                    [[json.loads(line) for line in body.splitlines()] for body in bodies],
+                    [[json.loads(line) for line in body.splitlines()] for body in expected_bodies])
+
+    def test_bulk_serializer_non_finite_floats(self):
+        # the default serializer keeps NaN and Infinity like elasticsearch-py, while orjson writes them as null
+        doc = {'a': float('nan'), 'b': float('inf'), 'c': -float('inf'), 'd': 1.5}
+        self.assertEqual(JsonBulkSerializer().dumps(doc), b'{"a":NaN,"b":Infinity,"c":-Infinity,"d":1.5}')
+        if orjson is not None:
+            client = ElasticsearchClient(serializer='orjson', lazy_connection_check=True)
+            self.assertEqual(client.bulk_serializer.dumps(doc), b'{"a":null,"b":null,"c":null,"d":1.5}')
+
+    def test_bulk_serializer_chunks(self):
+        actions = list(get_sv_test_actions(5000))
+        serializers = ['json'] + (['orjson'] if orjson is not None else [])
+        with FakeElasticsearchServer() as server:
+            for serializer in serializers:
+                client = ElasticsearchClient(port=server.port, serializer=serializer)
+                bodies = [body for body, _ in client._chunk_bulk_actions(actions, 1000, 10 * 1024 * 1024)]
+
+                self.assertListEqual([len(body.splitlines()) for body in bodies], [2000] * 5)
+
+    def test_bulk_export_compression(self):
+        with FakeElasticsearchServer(reject_bulk_items=5) as server:
+            client = ElasticsearchClient(port=server.port)
+            success_count, _, chunk_stats = client.bulk_export(
+                get_sv_test_actions(1000), num_workers=1, chunk_size=250, compress_level=1, initial_backoff=0.01)
+
+            self.assertEqual(success_count, 1000)
+            self.assertEqual(len(server.docs['test_index']), 1000)
+            self.assertDictEqual(server.docs['test_index']['prefix_10_DEL'], list(get_sv_test_actions(11))[10]['_source'])
+            self.assertEqual(len(chunk_stats), 4)
+            self.assertDictEqual(
+                {k: v for k, v in chunk_stats[0].items() if 'bytes' not in k and k != 'seconds'},
+                {'docs': 250, 'retries': 1, 'rejected': 5, 'conflicts': 0},
+            )
+            raw_bytes = sum(stats['raw_bytes'] for stats in chunk_stats)
+            wire_bytes = sum(stats['wire_bytes'] for stats in chunk_stats)
+            self.assertEqual(wire_bytes, server.bulk_wire_bytes)
+            self.assertLess(wire_bytes * 10, raw_bytes)
+
+            _, _, chunk_stats = client.bulk_export(get_sv_test_actions(1000), chunk_size=250)
+            self.assertEqual(
+                sum(stats['wire_bytes'] for stats in chunk_stats), sum(stats['raw_bytes'] for stats in chunk_stats))
+
+    def test_bulk_export_workers(self):
+        for num_workers in [1, 4]:
+            with FakeElasticsearchServer(bulk_latency=0.05) as server:
+                client = ElasticsearchClient(port=server.port)
+                client.bulk_export(get_test_actions(5000), num_workers=num_workers, chunk_size=250)
+
+                self.assertEqual(len(server.docs['test_index']), 5000)
+                self.assertLessEqual(server.max_concurrent_bulk_requests, num_workers)
+
+    def test_bulk_source_export(self):
+        for num_workers in [1, 4]:
+            with FakeElasticsearchServer() as server:
+                client = ElasticsearchClient(port=server.port)
+                actions = (
+                    get_bulk_action(get_bulk_source(row), 'test_index', id_field='docId') for row in get_variant_test_rows(5000)
+                )
+                client.bulk_export(actions, num_workers=num_workers, chunk_size=250)
+
+                self.assertEqual(len(server.docs['test_index']), 5000)
+                self.assertDictEqual(server.docs['test_index']['1-7-A-G'], {
+                    'docId': '1-7-A-G', 'contig': '1', 'start': 7, 'filters': ['PASS'],
+                    'transcriptConsequenceTerms': ['missense_variant', 'intron_variant'],
+                    'genotypes': [{'sample_id': 'S{}'.format(j), 'gq': 99} for j in range(10)],
+                })
+
+    def test_routing_search(self):
+        # SV-like docs spread across chromosomes 1-22, and 1Mb region queries
+        rand = random.Random(1)
+        docs = [
+            {'variantId': 'sv_{}'.format(i), 'xpos': rand.randint(1, 22) * 10**9 + rand.randint(1, 200 * 10**6)}
+            for i in range(5000)
+        ]
+        regions = [(doc['xpos'], doc['xpos'] + 10**6) for doc in rand.sample(docs, 20)]
+
+        results = {}
+        for routing_scheme in [None, 'xpos_bin', 'contig']:
+            with FakeElasticsearchServer() as server:
+                client = ElasticsearchClient(port=server.port)
+                meta = {'routing': {'scheme': routing_scheme, 'field': 'xpos'}} if routing_scheme else {}
+                client.create_index(
+                    'test_index', {}, num_shards=12, _meta=meta,
+                    routing_partition_size=get_routing_partition_size(routing_scheme, 12))
+                client.bulk_export(
+                    dict(get_bulk_action(dict(doc), 'test_index', id_field='variantId'),
+                         **({'_routing': get_routing_key(doc['xpos'], routing_scheme)} if routing_scheme else {}))
+                    for doc in docs
+                )
+
+                shards_searched = []
+                hit_counts = []
+                for xstart, xstop in regions:
+                    # the test documents are single positions
+                    routing = client.get_search_routing('test_index', xstart, xstop, max_variant_length=0)
+                    response = client.es.search(
+                        index='test_index', routing=routing,
+                        body={'query': {'range': {'xpos': {'gte': xstart, 'lte': xstop}}}},
+                    )
+                    shards_searched.append(response['_shards']['total'])
+                    hit_counts.append(response['hits']['total']['value'])
+                results[routing_scheme] = (sum(shards_searched) / len(regions), hit_counts)
+
+        self.assertEqual(results[None][0], 12)
+        self.assertLess(results['xpos_bin'][0], 2)
+        # each contig is spread over a few shards
+        self.assertEqual(results['contig'][0], 4)
+        # routing does not change the results
+        self.assertListEqual(results['xpos_bin'][1], results[None][1])
+        self.assertListEqual(results['contig'][1], results[None][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,12 @@
+import math
+import re
 import sys
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 if sys.version_info[0] < 3:
     from StringIO import StringIO
 else:
@@ -17,6 +24,28 @@ ELASTICSEARCH_WRITE_OPERATIONS = set([
 ])
 
 
+# Backends for exporting tables to elasticsearch: the es-hadoop connector running in spark, or the python bulk client
+EXPORT_BACKEND_ES_HADOOP = "es-hadoop"
+EXPORT_BACKEND_PYTHON = "python"
+EXPORT_BACKENDS = set([EXPORT_BACKEND_ES_HADOOP, EXPORT_BACKEND_PYTHON])
+
+
+# Custom document routing schemes. Documents are routed to shards by a key computed from their xpos, so all the
+# documents in a genomic region are on a few shards and region queries only need to search those shards.
+ROUTING_SCHEME_CONTIG = "contig"
+ROUTING_SCHEME_XPOS_BIN = "xpos_bin"
+ROUTING_SCHEMES = set([ROUTING_SCHEME_CONTIG, ROUTING_SCHEME_XPOS_BIN])
+ROUTING_XPOS_BIN_SIZE = 10 * 1000 * 1000
+# The contig scheme only has about 25 routing keys, so each would put a whole contig on one shard. The documents of a
+# contig are instead spread over this many shards with index.routing_partition_size, and a region query searches them
+# all. Shards still differ in size with the contig sizes.
+ROUTING_CONTIG_PARTITION_SIZE = 4
+ROUTING_FIELD = "xpos"
+# Field the routing key is computed into before exporting, which is not stored in the documents
+ROUTING_KEY_FIELD = "routingKey"
+XPOS_CONTIG_OFFSET = 10**9
+
+
 # make encoded values as human-readable as possible
 ES_FIELD_NAME_ESCAPE_CHAR = '$'
 ES_FIELD_NAME_BAD_LEADING_CHARS = set(['_', '-', '+', ES_FIELD_NAME_ESCAPE_CHAR])
@@ -83,3 +112,215 @@ def _decode_field_name(field_name):
                 i += 1
 
     return original_string.getvalue()
+
+
+# Bounds for the es-hadoop bulk request settings chosen by get_export_tuning_config.
+# See https://www.elastic.co/guide/en/elasticsearch/hadoop/current/configuration.html#configuration-serialization
+ES_BULK_BYTES_PER_DATA_NODE = 32 * 1024 * 1024  # total size of concurrent bulk requests a data node handles well
+ES_BATCH_SIZE_BYTES_MIN = 1024 * 1024
+ES_BATCH_SIZE_BYTES_MAX = 10 * 1024 * 1024
+ES_BATCH_SIZE_ENTRIES_MIN = 10
+ES_BATCH_SIZE_ENTRIES_MAX = 10000
+ES_MIN_DOCS_PER_SHARD = 10
+ES_HTTP_RETRIES_MIN = 3
+ES_HTTP_RETRIES_MAX = 10
+# Units accepted in es-hadoop byte size settings like es.batch.size.bytes
+ES_BYTE_SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3}
+
+# Index sizing for get_num_shards. Shards between 10 and 50GB recover and rebalance well.
+# See https://www.elastic.co/guide/en/elasticsearch/reference/current/size-your-shards.html
+ES_TARGET_SHARD_BYTES = 30 * 1024**3
+ES_MAX_NUM_SHARDS = 200
+# Approximate size on disk of an index with best_compression, including doc values and the inverted index, per byte
+# of serialized documents. This is a rough default rather than a measured value. The store_bytes_per_source_byte export
+# metric of a previous full load measures it for a dataset.
+ES_INDEX_BYTES_PER_SOURCE_BYTE = 0.5
+
+
+def _clamp(value, min_value, max_value):
+    return max(min_value, min(max_value, value))
+
+
+def get_export_tuning_config(row_bytes, num_data_nodes, num_shards, num_writers, overrides=None):
+    """Choose es-hadoop bulk request settings for an export.
+
+    The cluster's bulk capacity is split between all the writers sending requests at once. Each writer's request size is
+    then converted to a number of documents using the serialized row size, so tables with small rows send more
+    documents per request than tables with large rows. Requests have at least a few documents per shard where the
+    size limit allows, and more retries are allowed when many writers share each node.
+
+    Args:
+        row_bytes (int): estimated serialized size of a row in bytes
+        num_data_nodes (int): number of elasticsearch data nodes, including loading nodes
+        num_shards (int): number of shards in the index
+        num_writers (int): number of tasks exporting to elasticsearch at once
+        overrides (dict): optional es-hadoop settings to use instead of the chosen ones
+
+    Returns:
+        dict: es-hadoop config with es.batch.size.bytes, es.batch.size.entries and es.http.retries
+    """
+    num_data_nodes = max(num_data_nodes, 1)
+    num_writers = max(num_writers, 1)
+
+    batch_bytes = _clamp(
+        ES_BULK_BYTES_PER_DATA_NODE * num_data_nodes // num_writers, ES_BATCH_SIZE_BYTES_MIN, ES_BATCH_SIZE_BYTES_MAX)
+    batch_entries = _clamp(
+        max(batch_bytes // max(row_bytes, 1), num_shards * ES_MIN_DOCS_PER_SHARD),
+        ES_BATCH_SIZE_ENTRIES_MIN, ES_BATCH_SIZE_ENTRIES_MAX,
+    )
+    writers_per_node = -(-num_writers // num_data_nodes)
+    http_retries = _clamp(writers_per_node // 2, ES_HTTP_RETRIES_MIN, ES_HTTP_RETRIES_MAX)
+
+    config = {
+        "es.batch.size.bytes": "{}kb".format(batch_bytes // 1024),
+        "es.batch.size.entries": str(batch_entries),
+        "es.http.retries": str(http_retries),
+    }
+    config.update(overrides or {})
+    return config
+
+
+def parse_byte_size(value):
+    """Converts an es-hadoop byte size setting, like "4096kb" or "1mb", to a number of bytes"""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?b)?\s*$", str(value).lower())
+    if not match:
+        raise ValueError("Invalid byte size: " + str(value))
+    number, unit = match.groups()
+    return int(float(number) * ES_BYTE_SIZE_UNITS[unit or "b"])
+
+
+def get_bulk_source(value, write_null_values=False):
+    """Convert a collected row (or any value within it) to a json-serializable elasticsearch document.
+
+    Structs and dicts become dicts, and sets and tuples become lists. Like es-hadoop, fields that are null are left out
+    of the document unless write_null_values is set.
+    """
+    if isinstance(value, Mapping):
+        return {
+            key: get_bulk_source(field_value, write_null_values) for key, field_value in value.items()
+            if field_value is not None or write_null_values
+        }
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [get_bulk_source(item, write_null_values) for item in value]
+    return value
+
+
+def get_bulk_action(
+    source, index_name, elasticsearch_write_operation=ELASTICSEARCH_INDEX, id_field=None, routing_field=None,
+):
+    """Returns the bulk action for writing a document with the given elasticsearch write operation.
+
+    Args:
+        source (dict): document
+        index_name (str): elasticsearch index name
+        elasticsearch_write_operation (str): one of ELASTICSEARCH_WRITE_OPERATIONS
+        id_field (str): optional document field to use as the document ID, like es.mapping.id in es-hadoop
+        routing_field (str): optional document field to use as the routing key, like es.mapping.routing in
+            es-hadoop. The field is removed from the document.
+
+    Returns:
+        dict: bulk action in the format accepted by elasticsearch.helpers.bulk
+    """
+    action = {"_index": index_name}
+    if id_field is not None:
+        action["_id"] = source[id_field]
+    elif elasticsearch_write_operation in (ELASTICSEARCH_UPDATE, ELASTICSEARCH_UPSERT):
+        raise ValueError("A document ID field is required for {} operations".format(elasticsearch_write_operation))
+    if routing_field is not None:
+        action["_routing"] = source.pop(routing_field)
+
+    if elasticsearch_write_operation == ELASTICSEARCH_UPDATE:
+        action.update({"_op_type": "update", "doc": source})
+    elif elasticsearch_write_operation == ELASTICSEARCH_UPSERT:
+        action.update({"_op_type": "update", "doc": source, "doc_as_upsert": True})
+    else:
+        action.update({"_op_type": elasticsearch_write_operation or ELASTICSEARCH_INDEX, "_source": source})
+    return action
+
+
+def get_routing_key(xpos, routing_scheme, bin_size=ROUTING_XPOS_BIN_SIZE):
+    """Returns the routing key for a document with the given xpos (contig number * 10**9 + position).
+
+    Args:
+        xpos (int): document xpos
+        routing_scheme (str): one of ROUTING_SCHEMES
+        bin_size (int): size in base pairs of the bins of the ROUTING_SCHEME_XPOS_BIN scheme
+
+    Returns:
+        str: "<contig number>" or "<contig number>-<bin>"
+    """
+    contig_number = xpos // XPOS_CONTIG_OFFSET
+    if routing_scheme == ROUTING_SCHEME_CONTIG:
+        return str(contig_number)
+    if routing_scheme == ROUTING_SCHEME_XPOS_BIN:
+        return "{}-{}".format(contig_number, (xpos % XPOS_CONTIG_OFFSET) // bin_size)
+    raise ValueError("Unexpected routing scheme: " + str(routing_scheme))
+
+
+def get_routing_keys_for_xpos_range(xstart, xstop, routing_scheme, bin_size=ROUTING_XPOS_BIN_SIZE,
+                                    max_variant_length=None):
+    """Returns the routing keys of all documents that can overlap the given xpos range, to route a region query with.
+
+    Documents are routed by their start position, so variants that start before the region but overlap it are found
+    by moving xstart back by max_variant_length. By default xstart is moved back to the start of its contig, which
+    finds variants of any length.
+
+    Args:
+        xstart (int): start of the xpos range
+        xstop (int): end of the xpos range
+        routing_scheme (str): one of ROUTING_SCHEMES
+        bin_size (int): size in base pairs of the bins of the ROUTING_SCHEME_XPOS_BIN scheme
+        max_variant_length (int): length in base pairs of the longest variant to find, or None for no limit
+
+    Returns:
+        list: routing keys
+    """
+    contig_start = xstart - xstart % XPOS_CONTIG_OFFSET
+    xstart = contig_start if max_variant_length is None else max(xstart - max_variant_length, contig_start)
+    keys = []
+    for contig_number in range(xstart // XPOS_CONTIG_OFFSET, xstop // XPOS_CONTIG_OFFSET + 1):
+        contig_xstart = max(xstart, contig_number * XPOS_CONTIG_OFFSET)
+        contig_xstop = min(xstop, (contig_number + 1) * XPOS_CONTIG_OFFSET - 1)
+        if routing_scheme == ROUTING_SCHEME_CONTIG:
+            keys.append(get_routing_key(contig_xstart, routing_scheme))
+        else:
+            first_bin = (contig_xstart % XPOS_CONTIG_OFFSET) // bin_size
+            last_bin = (contig_xstop % XPOS_CONTIG_OFFSET) // bin_size
+            keys += ["{}-{}".format(contig_number, i) for i in range(first_bin, last_bin + 1)]
+    return keys
+
+
+def get_routing_partition_size(routing_scheme, num_shards):
+    """Returns the index.routing_partition_size to create an index with the given routing scheme and shards with.
+    It has to be less than the number of shards.
+    """
+    if routing_scheme != ROUTING_SCHEME_CONTIG:
+        return 1
+    return max(1, min(ROUTING_CONTIG_PARTITION_SIZE, num_shards - 1))
+
+
+def get_routing_meta(routing_scheme, bin_size=ROUTING_XPOS_BIN_SIZE):
+    """Returns the description of a routing scheme to store in the index _meta, so clients can route queries"""
+    meta = {"scheme": routing_scheme, "field": ROUTING_FIELD}
+    if routing_scheme == ROUTING_SCHEME_XPOS_BIN:
+        meta["bin_size"] = bin_size
+    return meta
+
+
+def get_num_shards(num_docs, doc_bytes, target_shard_bytes=ES_TARGET_SHARD_BYTES, min_num_shards=1,
+                   max_num_shards=ES_MAX_NUM_SHARDS, index_bytes_per_source_byte=ES_INDEX_BYTES_PER_SOURCE_BYTE):
+    """Choose the number of shards for an index from its estimated size.
+
+    Args:
+        num_docs (int): number of documents
+        doc_bytes (float): mean serialized size of a document in bytes
+        target_shard_bytes (int): shard size to aim for
+        min_num_shards (int): minimum number of shards
+        max_num_shards (int): maximum number of shards
+        index_bytes_per_source_byte (float): size of the index on disk per byte of serialized documents
+
+    Returns:
+        int: number of shards
+    """
+    index_bytes = num_docs * doc_bytes * index_bytes_per_source_byte
+    return _clamp(int(math.ceil(index_bytes / target_shard_bytes)), min_num_shards, max_num_shards)
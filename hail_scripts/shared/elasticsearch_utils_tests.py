@@ -1,6 +1,10 @@
 import unittest
 
-from elasticsearch_utils import _encode_field_name, _decode_field_name
+from elasticsearch_utils import (
+    _encode_field_name, _decode_field_name, get_export_tuning_config, get_bulk_source, get_bulk_action,
+    get_routing_key, get_routing_keys_for_xpos_range, get_routing_meta, get_num_shards, parse_byte_size,
+    get_routing_partition_size,
+)
 
 
 class TestElasticsearchUtils(unittest.TestCase):
@@ -35,5 +39,110 @@ class TestElasticsearchUtils(unittest.TestCase):
 
             print("%s => %s" % (test_string, encoded))
 
+    def test_get_export_tuning_config(self):
+        # small clinvar-like rows on a small cluster
+        self.assertDictEqual(get_export_tuning_config(300, num_data_nodes=2, num_shards=1, num_writers=16), {
+            "es.batch.size.bytes": "4096kb", "es.batch.size.entries": "10000", "es.http.retries": "4",
+        })
+        # large genotype-heavy rows
+        self.assertDictEqual(get_export_tuning_config(50000, num_data_nodes=2, num_shards=6, num_writers=16), {
+            "es.batch.size.bytes": "4096kb", "es.batch.size.entries": "83", "es.http.retries": "4",
+        })
+        # many writers per node get smaller requests, but still a few documents per shard
+        self.assertDictEqual(get_export_tuning_config(50000, num_data_nodes=2, num_shards=12, num_writers=200), {
+            "es.batch.size.bytes": "1024kb", "es.batch.size.entries": "120", "es.http.retries": "10",
+        })
+        self.assertDictEqual(
+            get_export_tuning_config(300, 2, 1, 16, overrides={"es.batch.size.entries": "200", "es.http.timeout": "5m"}),
+            {"es.batch.size.bytes": "4096kb", "es.batch.size.entries": "200", "es.http.retries": "4",
+             "es.http.timeout": "5m"},
+        )
+
+    def test_parse_byte_size(self):
+        self.assertEqual(parse_byte_size("4096kb"), 4096 * 1024)
+        self.assertEqual(parse_byte_size("1mb"), 1024 * 1024)
+        self.assertEqual(parse_byte_size("1.5MB"), 1536 * 1024)
+        self.assertEqual(parse_byte_size("2gb"), 2 * 1024**3)
+        self.assertEqual(parse_byte_size("512b"), 512)
+        self.assertEqual(parse_byte_size("1000"), 1000)
+        with self.assertRaises(ValueError):
+            parse_byte_size("1tb")
+
+    def test_get_num_shards(self):
+        # a small callset fits in one shard
+        self.assertEqual(get_num_shards(100000, 2000), 1)
+        # 30M variants with large genotype arrays
+        self.assertEqual(get_num_shards(30 * 10**6, 50000), 24)
+        self.assertEqual(get_num_shards(30 * 10**6, 50000, target_shard_bytes=50 * 1024**3), 14)
+        self.assertEqual(get_num_shards(100000, 2000, min_num_shards=6), 6)
+        self.assertEqual(get_num_shards(10**9, 50000, max_num_shards=50), 50)
+        self.assertEqual(get_num_shards(30 * 10**6, 50000, index_bytes_per_source_byte=0.25), 12)
+
+    def test_get_bulk_source(self):
+        row = {"contig": "1", "pos": 100, "filters": {"PASS"}, "AF": None, "info": {"AC": (1, 2), "AN": None},
+               "genotypes": [{"sample_id": "S1", "gq": None}]}
+        self.assertDictEqual(get_bulk_source(row), {
+            "contig": "1", "pos": 100, "filters": ["PASS"], "info": {"AC": [1, 2]}, "genotypes": [{"sample_id": "S1"}],
+        })
+        self.assertDictEqual(get_bulk_source(row, write_null_values=True), {
+            "contig": "1", "pos": 100, "filters": ["PASS"], "AF": None, "info": {"AC": [1, 2], "AN": None},
+            "genotypes": [{"sample_id": "S1", "gq": None}],
+        })
+
+    def test_get_bulk_action(self):
+        source = {"variantId": "1-100-A-G", "AF": 0.1}
+        self.assertDictEqual(get_bulk_action(source, "test_index"), {
+            "_index": "test_index", "_op_type": "index", "_source": source,
+        })
+        self.assertDictEqual(get_bulk_action(source, "test_index", "create", id_field="variantId"), {
+            "_index": "test_index", "_id": "1-100-A-G", "_op_type": "create", "_source": source,
+        })
+        self.assertDictEqual(get_bulk_action(source, "test_index", "upsert", id_field="variantId"), {
+            "_index": "test_index", "_id": "1-100-A-G", "_op_type": "update", "doc": source, "doc_as_upsert": True,
+        })
+        with self.assertRaises(ValueError):
+            get_bulk_action(source, "test_index", "update")
+
+        self.assertDictEqual(get_bulk_action(dict(source, routingKey="1-0"), "test_index", routing_field="routingKey"), {
+            "_index": "test_index", "_routing": "1-0", "_op_type": "index", "_source": source,
+        })
+
+    def test_routing(self):
+        self.assertEqual(get_routing_key(1055505463, "contig"), "1")
+        self.assertEqual(get_routing_key(1055505463, "xpos_bin"), "1-5")
+        self.assertEqual(get_routing_key(23018525192, "xpos_bin", bin_size=1000000), "23-18")
+        with self.assertRaises(ValueError):
+            get_routing_key(1055505463, "gene")
+
+        self.assertListEqual(
+            get_routing_keys_for_xpos_range(1055505463, 1075000000, "xpos_bin", max_variant_length=0),
+            ["1-5", "1-6", "1-7"],
+        )
+        # an SV that starts in an earlier bin and overlaps the region
+        self.assertListEqual(
+            get_routing_keys_for_xpos_range(1055505463, 1075000000, "xpos_bin", max_variant_length=10000000),
+            ["1-4", "1-5", "1-6", "1-7"],
+        )
+        self.assertListEqual(
+            get_routing_keys_for_xpos_range(1025505463, 1045000000, "xpos_bin"), ["1-0", "1-1", "1-2", "1-3", "1-4"])
+        # the padding does not extend into the previous contig
+        self.assertListEqual(
+            get_routing_keys_for_xpos_range(2000000100, 2000000200, "xpos_bin", max_variant_length=10**6), ["2-0"])
+        self.assertListEqual(get_routing_keys_for_xpos_range(1055505463, 1075000000, "contig"), ["1"])
+        self.assertListEqual(
+            get_routing_keys_for_xpos_range(
+                1245000000, 2005000000, "xpos_bin", bin_size=100000000, max_variant_length=0),
+            ["1-2", "1-3", "1-4", "1-5", "1-6", "1-7", "1-8", "1-9", "2-0"],
+        )
+        self.assertListEqual(get_routing_keys_for_xpos_range(1245000000, 3005000000, "contig"), ["1", "2", "3"])
+        self.assertDictEqual(get_routing_meta("xpos_bin"), {"scheme": "xpos_bin", "field": "xpos", "bin_size": 10000000})
+        self.assertDictEqual(get_routing_meta("contig"), {"scheme": "contig", "field": "xpos"})
+
+        self.assertEqual(get_routing_partition_size("contig", 12), 4)
+        self.assertEqual(get_routing_partition_size("contig", 3), 2)
+        self.assertEqual(get_routing_partition_size("contig", 1), 1)
+        self.assertEqual(get_routing_partition_size("xpos_bin", 12), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,7 +5,7 @@ import hail as hl
 from hail_scripts.v02.utils.elasticsearch_client import ElasticsearchClient
 
 
-def export_table_to_elasticsearch(table_url, host, index_name, index_type, port=9200, num_shards=1, block_size=200):
+def export_table_to_elasticsearch(table_url, host, index_name, index_type, port=9200, num_shards=1, block_size=None):
     ds = hl.read_table(table_url)
 
     es = ElasticsearchClient(host, port)
@@ -29,7 +29,8 @@ def main():
     p.add_argument("--index-name", help="Elasticsearch index name", required=True)
     p.add_argument("--index-type", help="Elasticsearch index type", default='_doc')
     p.add_argument("--num-shards", help="Number of Elasticsearch shards", default=1, type=int)
-    p.add_argument("--block-size", help="Elasticsearch block size to use when exporting", default=200, type=int)
+    p.add_argument("--block-size", help="Elasticsearch block size to use when exporting. By default this is chosen "
+                   "based on the row size and cluster size", type=int)
     args = p.parse_args()
 
     export_table_to_elasticsearch(
@@ -29,7 +29,8 @@ p.add_argument("-p", "--port", help="Elasticsearch port", default=9200, type=int
 p.add_argument("-i", "--index-name", help="Elasticsearch index name")
 p.add_argument("-t", "--index-type", help="Elasticsearch index type", default="variant")
 p.add_argument("-s", "--num-shards", help="Number of elasticsearch shards", default=1, type=int)
-p.add_argument("-b", "--es-block-size", help="Elasticsearch block size to use when exporting", default=200, type=int)
+p.add_argument("-b", "--es-block-size", help="Elasticsearch block size to use when exporting. By default this is chosen "
+               "based on the row size and cluster size", type=int)
 args = p.parse_args()
 
 
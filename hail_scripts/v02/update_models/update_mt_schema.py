@@ -5,7 +5,10 @@ from hail_scripts.v02.utils.computed_fields import variant_id
 
 class UpdateSchema(BaseMTSchema):
     @row_annotation(name='docId')
-    def doc_id(self, length=512):
+    def doc_id(self, length=512, hashed=False):
+        # Must match the IDs of the index being updated, see variant_id.DOC_ID_SCHEME_HASHED
+        if hashed:
+            return variant_id.get_expr_for_doc_id(self.mt, length)
         return variant_id.get_expr_for_variant_id(self.mt, length)
 
     @row_annotation()
@@ -7,10 +7,11 @@ import argparse
 from pprint import pprint
 import logging
 
-from hail_scripts.shared.elasticsearch_utils import ELASTICSEARCH_UPDATE
+from hail_scripts.shared.elasticsearch_utils import ELASTICSEARCH_UPDATE, ROUTING_XPOS_BIN_SIZE
 
 import hail as hl
 from hail_scripts.v02.update_models.update_mt_schema import HGMDSchema, CLINVARSchema, CIDRSchema
+from hail_scripts.v02.utils.computed_fields.variant_id import DOC_ID_SCHEME_HASHED, get_expr_for_xpos
 from hail_scripts.v02.utils.elasticsearch_client import ElasticsearchClient
 from lib.model.seqr_mt_schema import SeqrVariantsAndGenotypesSchema
 
@@ -23,7 +24,7 @@ cidr_ht_path='/seqr-reference-data/GRCh37/CIDR/Holland_20190829_no_genotypes_sel
 
 
 def update_all_datasets(hc, args):
-    client = ElasticsearchClient(host=args.host, port=args.port)
+    client = ElasticsearchClient.get_shared_client(host=args.host, port=args.port)
     indices = client.es.cat.indices(h="index", s="index").strip().split("\n")
     for i, index_name in enumerate(indices):
         _meta = client.get_index_meta(index_name)
@@ -40,7 +41,8 @@ def update_all_datasets(hc, args):
 
 
 def update_dataset(index_name, args):
-    elasticsearch_client = ElasticsearchClient(host=args.host, port=args.port)
+    # reuses the connections opened by update_all_datasets when updating many indices
+    elasticsearch_client = ElasticsearchClient.get_shared_client(host=args.host, port=args.port)
     _meta = elasticsearch_client.get_index_meta(index_name)
     if not args.dataset_path and (not _meta or "sourceFilePath" not in _meta):
         raise ValueError("Couldn't update reference data in {} because it doesn't have a recorded sourceFilePath. Please use "
@@ -78,9 +80,20 @@ def update_dataset(index_name, args):
         cidr = hl.read_table(cidr_ht_path)
         mt = CIDRSchema(mt, cidr_data=cidr).cidr()
 
-    mt = mt.aIndex().doc_id()
+    # indices loaded before docIdScheme was recorded have truncated variant IDs as document IDs
+    mt = mt.aIndex().doc_id(hashed=(_meta or {}).get("docIdScheme") == DOC_ID_SCHEME_HASHED)
     mt = mt.select_annotated_mt()
 
+    # documents in an index with custom routing can only be updated with the same routing
+    routing = (_meta or {}).get("routing")
+    routing_kwargs = {}
+    if routing:
+        mt = mt.annotate_rows(xpos=get_expr_for_xpos(mt.locus))
+        routing_kwargs = {
+            "routing_scheme": routing["scheme"],
+            "routing_bin_size": routing.get("bin_size", ROUTING_XPOS_BIN_SIZE),
+        }
+
     variant_count = mt.count_rows()
     logger.info("\n==> exporting {} variants to elasticsearch:".format(variant_count))
 
@@ -98,13 +111,15 @@ def update_dataset(index_name, args):
         delete_index_before_exporting=False,
         ignore_elasticsearch_write_errors=False,
         export_globals_to_index_meta=True,
+        **routing_kwargs,
     )
 
 
 p = argparse.ArgumentParser()
 p.add_argument("--host", help="Elasticsearch host", default=os.environ.get("ELASTICSEARCH_SERVICE_HOSTNAME"))
 p.add_argument("--port", help="Elasticsearch port", default="9200")
-p.add_argument("--block-size", help="Block size to use when exporting to elasticsearch", default=1000, type=int)
+p.add_argument("--block-size", help="Block size to use when exporting to elasticsearch. By default this is chosen "
+               "based on the row size and cluster size", type=int)
 
 #p.add_argument("--download-latest-clinvar-vcf", action="store_true", help="First download the latest GRCh37 and GRCh38 clinvar VCFs from NCBI.")
 p.add_argument("--update-clinvar", action="store_true", help="Update clinvar fields.")
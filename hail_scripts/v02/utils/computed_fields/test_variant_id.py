@@ -2,7 +2,7 @@ import unittest
 
 import hail as hl
 
-from .variant_id import get_expr_for_xpos
+from .variant_id import get_expr_for_doc_id, get_expr_for_xpos
 
 
 class TestXpos(unittest.TestCase):
@@ -19,5 +19,25 @@ class TestXpos(unittest.TestCase):
         self.assertEqual(hl.eval(get_expr_for_xpos(locus)), 2166847734)
 
 
+class TestDocId(unittest.TestCase):
+    def test_doc_id(self):
+        long_ref = "A" * 600
+        ht = hl.Table.parallelize(
+            [
+                {"locus": hl.Locus("1", 100), "alleles": ["A", "G"]},
+                {"locus": hl.Locus("1", 100), "alleles": [long_ref + "C", "A"]},
+                {"locus": hl.Locus("1", 100), "alleles": [long_ref + "T", "A"]},
+            ],
+            hl.tstruct(locus=hl.tlocus("GRCh37"), alleles=hl.tarray(hl.tstr)),
+        )
+        doc_ids = ht.aggregate(hl.agg.collect(get_expr_for_doc_id(ht, max_length=512)))
+
+        self.assertEqual(doc_ids[0], "1-100-A-G")
+        self.assertEqual(len(doc_ids[1]), 512)
+        self.assertTrue(doc_ids[1].startswith("1-100-AAAA"))
+        self.assertNotEqual(doc_ids[1], doc_ids[2])
+        self.assertListEqual(ht.aggregate(hl.agg.collect(get_expr_for_doc_id(ht, max_length=512))), doc_ids)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -82,6 +82,48 @@ def get_expr_for_variant_id(table, max_length=None):
     return variant_id
 
 
+# Recorded as docIdScheme in the index _meta of datasets whose document IDs come from get_expr_for_doc_id. Older
+# indices have IDs that are variant IDs truncated to 512 characters, and must be updated with the same IDs.
+DOC_ID_SCHEME_HASHED = "hashed"
+
+# Two moduli for a polynomial string hash, combined into a 62-bit hash
+STRING_HASH_MODULI = (2147483647, 2147483629)
+STRING_HASH_BASE = 131
+ASCII_CODES = {chr(i): i for i in range(128)}
+
+
+def get_expr_for_string_hash(s: hl.expr.StringExpression) -> hl.expr.StringExpression:
+    """Deterministic hash of a string, as 16 hex characters. Unlike python's hash, this is the same in every run."""
+    codes = hl.literal(ASCII_CODES)
+    chars = hl.range(hl.len(s)).map(lambda i: codes.get(s[i], 0))
+    hashes = [
+        hl.fold(lambda acc, code: (acc * STRING_HASH_BASE + code) % modulus, hl.int64(0), chars)
+        for modulus in STRING_HASH_MODULI
+    ]
+    return hl.format("%08x%08x", *hashes)
+
+
+def get_expr_for_doc_id(table, max_length=512):
+    """Expression for a unique elasticsearch document ID of at most max_length characters.
+
+    This is the variant ID, except for very long indels where the variant ID is longer than max_length. Their IDs are
+    truncated, with a hash of the full variant ID appended. This keeps them from colliding when indels share their
+    first max_length characters, so the same variant always gets the same ID.
+
+    Args:
+        max_length: maximum ID length
+
+    Return:
+        string: "<chrom>-<pos>-<ref>-<alt>" or "<chrom>-<pos>-<truncated ref and alt>-<hash>"
+    """
+    variant_id = get_expr_for_variant_id(table)
+    return hl.cond(
+        hl.len(variant_id) <= max_length,
+        variant_id,
+        variant_id[0:max_length - 17] + "-" + get_expr_for_string_hash(variant_id),
+    )
+
+
 def get_expr_for_xpos(locus: hl.expr.LocusExpression) -> hl.expr.Int64Expression:
     """Genomic position represented as a single number = contig_number * 10**9 + position.
     This represents chrom:pos more compactly and allows for easier sorting.
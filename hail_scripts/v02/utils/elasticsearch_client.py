@@ -1,18 +1,43 @@
+import contextlib
+import json
 import logging
+import random
 import re
+import time
 from pprint import pformat
 
 import hail as hl
 
 from hail_scripts.shared.elasticsearch_client_v7 import ElasticsearchClient as BaseElasticsearchClient
 from hail_scripts.shared.elasticsearch_utils import (
+    ELASTICSEARCH_CREATE,
     ELASTICSEARCH_INDEX,
     ELASTICSEARCH_UPDATE,
     ELASTICSEARCH_UPSERT,
     ELASTICSEARCH_WRITE_OPERATIONS,
+    EXPORT_BACKEND_ES_HADOOP,
+    EXPORT_BACKEND_PYTHON,
+    EXPORT_BACKENDS,
+    ROUTING_FIELD,
+    ROUTING_KEY_FIELD,
+    ROUTING_SCHEMES,
+    ROUTING_XPOS_BIN_SIZE,
+    ES_INDEX_BYTES_PER_SOURCE_BYTE,
+    ES_TARGET_SHARD_BYTES,
     _encode_field_name,
+    get_bulk_action,
+    get_bulk_source,
+    get_export_tuning_config,
+    get_num_shards,
+    get_routing_meta,
+    get_routing_partition_size,
+    parse_byte_size,
+)
+from hail_scripts.v02.utils.elasticsearch_utils import (
+    elasticsearch_schema_for_table,
+    estimate_json_size_for_type,
+    get_expr_for_routing_key,
 )
-from hail_scripts.v02.utils.elasticsearch_utils import elasticsearch_schema_for_table
 
 
 logger = logging.getLogger()
@@ -22,13 +47,262 @@ def struct_to_dict(struct):
     return {k: dict(struct_to_dict(v)) if isinstance(v, hl.utils.Struct) else v for k, v in struct.items()}
 
 
+def get_partition_ranges(num_partitions, partitions_per_range):
+    """Split the partitions of a table into consecutive [start, end) ranges of at most partitions_per_range partitions"""
+    return [
+        [start, min(start + partitions_per_range, num_partitions)]
+        for start in range(0, num_partitions, partitions_per_range)
+    ]
+
+
+def read_export_manifest(manifest_path):
+    """Returns the export manifest at the given local or gs:// path, or None if it does not exist"""
+    if not hl.hadoop_exists(manifest_path):
+        return None
+    with hl.hadoop_open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_export_manifest(manifest_path, manifest):
+    """Overwrites the export manifest at the given local or gs:// path"""
+    with hl.hadoop_open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+
 class ElasticsearchClient(BaseElasticsearchClient):
+    def estimate_table_row_bytes(self, table, sample_size=100):
+        """Returns the serialized size of a row of the given table in bytes.
+
+        The row size is measured by serializing a sample of rows, or estimated from the row type if sample_size is 0
+        or the table is empty.
+        """
+        row_bytes = estimate_json_size_for_type(table.row_value.dtype)
+        logger.info("==> estimated row size from type: %d bytes", row_bytes)
+        if sample_size:
+            sample = table.head(sample_size)
+            sampled_row_bytes = sample.aggregate(hl.agg.mean(hl.len(hl.json(sample.row_value))))
+            if sampled_row_bytes is not None:
+                logger.info("==> mean serialized row size of %d sampled rows: %d bytes", sample_size, sampled_row_bytes)
+                row_bytes = int(sampled_row_bytes)
+        return row_bytes
+
+    def sample_table_row_bytes(self, table, sample_fraction=0.01, max_sample_partitions=20, seed=0):
+        """Returns the mean serialized size in bytes of the rows in a random sample of the table's partitions.
+
+        Whole partitions are sampled, so only those partitions are computed, and they are spread across the table so
+        rows from different parts of the genome are included.
+
+        Args:
+            table (Table): hail Table
+            sample_fraction (float): fraction of partitions to sample
+            max_sample_partitions (int): maximum number of partitions to sample
+            seed (int): random seed, so the same partitions are sampled each time
+        """
+        num_partitions = table.n_partitions()
+        num_sample_partitions = min(max(1, int(num_partitions * sample_fraction)), max_sample_partitions, num_partitions)
+        sample_partitions = sorted(random.Random(seed).sample(range(num_partitions), num_sample_partitions))
+        sample = table._filter_partitions(sample_partitions)
+        row_bytes = sample.aggregate(hl.agg.mean(hl.len(hl.json(sample.row_value))))
+        logger.info("==> mean serialized row size in %d sampled partitions: %s bytes", num_sample_partitions, row_bytes)
+        return row_bytes
+
+    def get_table_row_bytes(self, table, sample_fraction=0.01):
+        """Returns the serialized size of a row of the given table in bytes, measured from a sample of its partitions
+        (see sample_table_row_bytes), or estimated from the row type if the sampled partitions are empty.
+        """
+        row_bytes = self.sample_table_row_bytes(table, sample_fraction=sample_fraction)
+        if row_bytes is None:
+            row_bytes = estimate_json_size_for_type(table.row_value.dtype)
+        return int(row_bytes)
+
+    def get_table_num_shards(
+        self, table, num_rows, target_shard_bytes=ES_TARGET_SHARD_BYTES, min_num_shards=1, sample_fraction=0.01,
+        row_bytes=None, index_bytes_per_source_byte=ES_INDEX_BYTES_PER_SOURCE_BYTE,
+    ):
+        """Choose the number of shards for exporting the given table from its estimated index size.
+
+        The number of rows is passed in rather than counted, so a count that is already known, such as the partition
+        counts stored in the metadata of a matrix table that was just read, can be used without another spark job.
+
+        Args:
+            table (Table): hail Table, as it will be exported
+            num_rows (int): number of rows in the table
+            target_shard_bytes (int): shard size to aim for
+            min_num_shards (int): minimum number of shards
+            sample_fraction (float): fraction of partitions to serialize to measure the row size
+            row_bytes (int): serialized row size, if it was already measured with get_table_row_bytes
+            index_bytes_per_source_byte (float): size of the index on disk per byte of serialized rows
+
+        Returns:
+            int: number of shards
+        """
+        if row_bytes is None:
+            row_bytes = self.get_table_row_bytes(table, sample_fraction=sample_fraction)
+        num_shards = get_num_shards(
+            num_rows, row_bytes, target_shard_bytes=target_shard_bytes, min_num_shards=min_num_shards,
+            index_bytes_per_source_byte=index_bytes_per_source_byte)
+        logger.info(
+            "==> %d rows of %d bytes (%.1f GB serialized): using %d shards",
+            num_rows, row_bytes, num_rows * row_bytes / 1024**3, num_shards,
+        )
+        return num_shards
+
+    def get_table_export_tuning_config(
+        self, table, num_shards, sample_size=100, overrides=None, num_writers=None, row_bytes=None,
+    ):
+        """Choose es-hadoop bulk request settings for exporting the given table (see get_export_tuning_config).
+
+        Args:
+            table (Table): hail Table
+            num_shards (int): number of shards in the index
+            sample_size (int): number of rows to serialize to measure the row size (see estimate_table_row_bytes)
+            overrides (dict): optional es-hadoop settings to use instead of the chosen ones
+            num_writers (int): number of bulk requests sent at once. Defaults to the spark parallelism.
+            row_bytes (int): serialized row size, if it was already measured
+
+        Returns:
+            dict: es-hadoop config
+        """
+        if row_bytes is None:
+            row_bytes = self.estimate_table_row_bytes(table, sample_size=sample_size)
+
+        config = get_export_tuning_config(
+            row_bytes,
+            num_data_nodes=self.get_num_data_nodes(),
+            num_shards=num_shards,
+            num_writers=num_writers or hl.spark_context().defaultParallelism,
+            overrides=overrides,
+        )
+        logger.info("==> export tuning config: %s", config)
+        return config
+
+    def export_table_partitions_with_bulk_client(
+        self,
+        table,
+        index_name,
+        elasticsearch_write_operation=ELASTICSEARCH_INDEX,
+        ignore_elasticsearch_write_errors=False,
+        elasticsearch_mapping_id=None,
+        write_null_values=False,
+        routing_field=None,
+        **bulk_export_kwargs,
+    ):
+        """Export a table to an existing index with the python bulk client instead of es-hadoop.
+
+        The table is collected one partition at a time, so only one partition's rows are held in memory while its
+        documents are sent by a pool of bulk workers. Like es-hadoop, types that have no json equivalent, such as
+        loci, intervals and dicts, are first expanded into structs and arrays (see Table.expand_types). Field names
+        should already be encoded for elasticsearch (see export_table_to_elasticsearch).
+
+        Args:
+            table (Table): hail Table
+            index_name (string): elasticsearch index name
+            elasticsearch_write_operation (string): one of ELASTICSEARCH_WRITE_OPERATIONS
+            ignore_elasticsearch_write_errors (bool): if True, documents that fail to index are logged instead of
+                raising an error
+            elasticsearch_mapping_id (str): optional field to use as the document ID
+            write_null_values (bool): whether to write fields that are null to the index
+            routing_field (str): optional field to route documents by, which is not stored in the documents
+            bulk_export_kwargs: keyword args for bulk_export, like num_workers and chunk_size
+
+        Returns:
+            tuple: number of successfully indexed documents, list of errors, and a dict of export statistics with the
+                bulk_export statistics of each chunk under "chunks", and the number of rows and the time hail spent
+                computing each partition under "partitions"
+        """
+        table = table.expand_types()
+        num_partitions = table.n_partitions()
+        partition_stats = []
+
+        def _actions():
+            for i in range(num_partitions):
+                start = time.time()
+                rows = table._filter_partitions([i]).collect()
+                partition_stats.append({"partition": i, "docs": len(rows), "hail_seconds": time.time() - start})
+                for row in rows:
+                    yield get_bulk_action(
+                        get_bulk_source(row, write_null_values),
+                        index_name,
+                        elasticsearch_write_operation=elasticsearch_write_operation,
+                        id_field=elasticsearch_mapping_id,
+                        routing_field=routing_field,
+                    )
+                logger.info("==> exported partition %d of %d", i + 1, num_partitions)
+
+        success_count, errors, chunk_stats = self.bulk_export(
+            _actions(), raise_on_error=not ignore_elasticsearch_write_errors, **bulk_export_kwargs
+        )
+        for error in errors[:10]:
+            logger.warning("Bulk export error: %s", error)
+        if errors:
+            logger.warning("==> %d documents failed to export", len(errors))
+        return success_count, errors, {"chunks": chunk_stats, "partitions": partition_stats}
+
+    def _get_export_metrics(
+        self, index_name, export_backend, range_metrics, row_bytes, index_stats_before, bulk_rejections_before,
+        total_seconds,
+    ):
+        """Summarize an export, to tell whether it was limited by hail computing the table or by elasticsearch indexing.
+
+        es_busy_fraction is the fraction of the export time that each primary shard spent handling bulk requests. If it
+        is close to 1, elasticsearch was the bottleneck. hail_seconds is only measured by the python backend, where
+        rows are computed separately from being indexed. Row bytes are estimated from a sample for es-hadoop exports.
+
+        Args:
+            index_name (str): elasticsearch index name
+            export_backend (str): one of EXPORT_BACKENDS
+            range_metrics (list): metrics for each exported range of partitions
+            row_bytes (int): estimated serialized size of a row
+            index_stats_before (dict): get_index_stats before the export
+            bulk_rejections_before (int): get_bulk_rejections before the export
+            total_seconds (float): seconds for the whole export, including merging the index
+
+        Returns:
+            dict: export metrics
+        """
+        index_stats = self.get_index_stats(index_name)
+        shard_doc_counts = self.get_shard_doc_counts(index_name)
+        export_seconds = sum(metrics["seconds"] for metrics in range_metrics)
+        docs = sum(metrics["docs"] for metrics in range_metrics)
+        if export_backend == EXPORT_BACKEND_PYTHON:
+            num_bytes = sum(metrics["bytes"] for metrics in range_metrics)
+        else:
+            num_bytes = docs * row_bytes
+        bulk_seconds = index_stats["bulk_seconds"] - index_stats_before["bulk_seconds"]
+
+        return {
+            "index_name": index_name,
+            "export_backend": export_backend,
+            "total_seconds": total_seconds,
+            "export_seconds": export_seconds,
+            "docs": docs,
+            "docs_per_sec": docs / export_seconds if export_seconds else None,
+            "bytes": num_bytes,
+            "bytes_estimated": export_backend != EXPORT_BACKEND_PYTHON,
+            "bytes_per_sec": num_bytes / export_seconds if export_seconds else None,
+            "store_bytes": index_stats["store_bytes"],
+            "store_bytes_per_source_byte": index_stats["store_bytes"] / num_bytes if num_bytes else None,
+            "hail_seconds": sum(metrics["hail_seconds"] for metrics in range_metrics)
+            if export_backend == EXPORT_BACKEND_PYTHON else None,
+            "es_indexing_seconds": index_stats["indexing_seconds"] - index_stats_before["indexing_seconds"],
+            "es_bulk_seconds": bulk_seconds,
+            "es_busy_fraction": bulk_seconds / (export_seconds * len(shard_doc_counts))
+            if export_seconds and shard_doc_counts else None,
+            "bulk_rejections": self.get_bulk_rejections() - bulk_rejections_before,
+            "bulk_retried_docs": sum(metrics["rejected"] for metrics in range_metrics)
+            if export_backend == EXPORT_BACKEND_PYTHON else None,
+            "bulk_conflicts": sum(metrics["conflicts"] for metrics in range_metrics)
+            if export_backend == EXPORT_BACKEND_PYTHON else None,
+            "shard_doc_counts": shard_doc_counts,
+            "partition_ranges": range_metrics,
+        }
+
     def export_table_to_elasticsearch(
         self,
         table: hl.Table,
         index_name :str = "data",
         index_type_name :str = '_doc',
-        block_size :int = 5000,
+        block_size :int = None,
         num_shards :int = 10,
         delete_index_before_exporting :bool = True,
         elasticsearch_write_operation :str = ELASTICSEARCH_INDEX,
@@ -42,14 +316,37 @@ class ElasticsearchClient(BaseElasticsearchClient):
         export_globals_to_index_meta=True,
         verbose=True,
         write_null_values=False,
+        export_manifest_path=None,
+        partitions_per_export=100,
+        export_tuning_overrides=None,
+        export_tuning_sample_size=100,
+        export_backend=EXPORT_BACKEND_ES_HADOOP,
+        export_num_workers=4,
+        index_alias=None,
+        func_to_run_before_alias_swap=None,
+        idempotent=False,
+        routing_scheme=None,
+        routing_bin_size=ROUTING_XPOS_BIN_SIZE,
+        row_bytes=None,
     ):
         """Create a new elasticsearch index to store the records in this table, and then export all records to it.
 
+        Returns metrics for the export (see _get_export_metrics).
+
+        If the export creates the index, it is loaded with the bulk_load settings, then refreshed, merged and
+        replicated once at the end. An existing index that is exported to with delete_index_before_exporting=False is
+        updated in place with its settings unchanged.
+
+        If export_manifest_path is set, the table is exported in ranges of partitions_per_export partitions and each
+        completed range is recorded in the manifest. If the export is interrupted, rerunning it with the same manifest
+        path, index and number of partitions keeps the index and only exports the ranges that were not completed.
+
         Args:
             table (Table): hail Table
             index_name (string): elasticsearch index name
             index_type_name (string): elasticsearch index type
-            block_size (int): number of records to write in one bulk insert
+            block_size (int): number of records to write in one bulk insert. If not set, this is chosen along with the
+                other bulk request settings from the size of the rows and the cluster (see get_table_export_tuning_config)
             num_shards (int): number of shards to use for this index
                 (see https://www.elastic.co/guide/en/elasticsearch/guide/current/overallocation.html)
             delete_index_before_exporting (bool): Whether to drop and re-create the index before exporting.
@@ -91,7 +388,50 @@ class ElasticsearchClient(BaseElasticsearchClient):
             child_table (Table): if not None, records in this Table will be exported as children of records in the main Table.
             verbose (bool): whether to print schema and stats
             write_null_values (bool): whether to write fields that are null to the index
+            export_manifest_path (str): optional local or gs:// path of a json manifest to record completed partition
+                ranges in, to allow an interrupted export to be resumed. Requires elasticsearch_mapping_id, so that
+                the documents of a partially exported range are overwritten instead of duplicated when it is
+                exported again.
+            partitions_per_export (int): number of partitions to export at a time when export_manifest_path is set
+            export_tuning_overrides (dict): es-hadoop settings to use instead of the ones chosen for the table
+            export_tuning_sample_size (int): number of rows to sample when choosing bulk request settings
+            export_backend (str): EXPORT_BACKEND_ES_HADOOP to export with the es-hadoop connector in spark, or
+                EXPORT_BACKEND_PYTHON to collect the table one partition at a time and export it with the python bulk
+                client (see export_table_partitions_with_bulk_client)
+            export_num_workers (int): number of bulk requests to send in parallel with the python backend
+            index_alias (str): if set, index_name should be a new index (see get_versioned_index_name). Once it is
+                loaded and merged, this alias is atomically moved to it from the previous index, which is deleted, so
+                searches on the alias see no downtime during a full reload.
+            func_to_run_before_alias_swap (function): optional function to run after loading the index, but before
+                moving the alias to it
+            idempotent (bool): make rerunning an export, or part of one, skip the documents that were already
+                written instead of adding duplicates. Requires elasticsearch_mapping_id to be a deterministic ID and
+                the python backend, which writes with create operations and ignores the conflicts for documents that
+                already exist. es-hadoop can not ignore only conflicts, so it is not supported. Use with
+                export_manifest_path so completed partition ranges are not exported again.
+            routing_scheme (str): optional scheme in ROUTING_SCHEMES to route documents to shards by their xpos
+                instead of their ID, so region queries can be routed to a subset of shards. The table must have an
+                xpos field. The scheme is recorded in the "routing" field of the index _meta.
+            routing_bin_size (int): size in base pairs of the bins of the ROUTING_SCHEME_XPOS_BIN scheme
+            row_bytes (int): serialized row size, if it was already measured, for example with get_table_row_bytes
+                when choosing the number of shards. Otherwise it is measured from export_tuning_sample_size rows.
         """
+        if export_backend not in EXPORT_BACKENDS:
+            raise ValueError("Unexpected value for export_backend arg: " + str(export_backend))
+        if routing_scheme is not None and routing_scheme not in ROUTING_SCHEMES:
+            raise ValueError("Unexpected value for routing_scheme arg: " + str(routing_scheme))
+
+        if export_manifest_path and elasticsearch_mapping_id is None:
+            raise ValueError("elasticsearch_mapping_id is required for exports with an export_manifest_path")
+
+        if idempotent:
+            if elasticsearch_mapping_id is None:
+                raise ValueError("elasticsearch_mapping_id is required for idempotent exports")
+            if export_backend != EXPORT_BACKEND_PYTHON:
+                # es-hadoop error handlers can only drop all bulk errors, not just the conflicts of create operations
+                raise ValueError("idempotent exports require export_backend=" + EXPORT_BACKEND_PYTHON)
+            if elasticsearch_write_operation == ELASTICSEARCH_INDEX:
+                elasticsearch_write_operation = ELASTICSEARCH_CREATE
 
         elasticsearch_config = {}
         if (
@@ -114,11 +454,26 @@ class ElasticsearchClient(BaseElasticsearchClient):
         if elasticsearch_mapping_id is not None:
             elasticsearch_config["es.mapping.id"] = elasticsearch_mapping_id
 
+        # the index is refreshed once loading is complete (see bulk_load)
+        elasticsearch_config["es.batch.write.refresh"] = "false"
+
         if ignore_elasticsearch_write_errors:
             # see docs in https://www.elastic.co/guide/en/elasticsearch/hadoop/current/errorhandlers.html
             elasticsearch_config["es.write.rest.error.handlers"] = "log"
             elasticsearch_config["es.write.rest.error.handler.log.logger.name"] = "BulkErrors"
 
+        export_start = time.time()
+        export_tuning_overrides = dict(export_tuning_overrides or {})
+        if block_size is not None:
+            export_tuning_overrides["es.batch.size.entries"] = str(block_size)
+        if row_bytes is None:
+            row_bytes = self.estimate_table_row_bytes(table, sample_size=export_tuning_sample_size)
+        elasticsearch_config.update(self.get_table_export_tuning_config(
+            table, num_shards, overrides=export_tuning_overrides, row_bytes=row_bytes,
+            num_writers=export_num_workers if export_backend == EXPORT_BACKEND_PYTHON else None,
+        ))
+        block_size = int(elasticsearch_config["es.batch.size.entries"])
+
         if self._es_password:
             elasticsearch_config.update({
                 'es.net.http.auth.user': self._es_username,
@@ -169,6 +524,44 @@ class ElasticsearchClient(BaseElasticsearchClient):
 
             elasticsearch_schema = modified_elasticsearch_schema
 
+        # check for a previous interrupted export of the same table to this index
+        partition_ranges = None
+        completed_ranges = []
+        resuming_export = False
+        if export_manifest_path:
+            num_partitions = table.n_partitions()
+            manifest = read_export_manifest(export_manifest_path)
+            if manifest and (
+                manifest.get("index_name") == index_name
+                and manifest.get("num_partitions") == num_partitions
+                and manifest.get("partitions_per_export") == partitions_per_export
+                and manifest.get("index_alias") == index_alias
+                and self.es.indices.exists(index=index_name)
+            ):
+                completed_ranges = manifest["completed_ranges"]
+                logger.info(
+                    "==> resuming export to %s, %d of %d partitions already exported",
+                    index_name, sum(end - start for start, end in completed_ranges), num_partitions,
+                )
+                delete_index_before_exporting = False
+                resuming_export = True
+            elif manifest:
+                logger.info("==> ignoring export manifest for a different export: %s", manifest)
+
+            partition_ranges = get_partition_ranges(num_partitions, partitions_per_export)
+            manifest = {
+                "index_name": index_name,
+                "num_partitions": num_partitions,
+                "partitions_per_export": partitions_per_export,
+                "index_alias": index_alias,
+                "completed_ranges": completed_ranges,
+            }
+            write_export_manifest(export_manifest_path, manifest)
+
+        # only an index created by this export gets the bulk load settings. Existing indices that are updated in place,
+        # like when updating reference data, are serving searches and keep their settings.
+        is_new_index = delete_index_before_exporting or resuming_export or not self.es.indices.exists(index=index_name)
+
         # optionally delete the index before creating it
         if delete_index_before_exporting and self.es.indices.exists(index=index_name):
             self.es.indices.delete(index=index_name)
@@ -177,20 +570,113 @@ class ElasticsearchClient(BaseElasticsearchClient):
         if export_globals_to_index_meta:
             _meta = struct_to_dict(hl.eval(table.globals))
 
-        self.create_or_update_mapping(index_name, elasticsearch_schema, num_shards=num_shards, _meta=_meta)
+        routing_field = None
+        if routing_scheme is not None:
+            routing_field = ROUTING_KEY_FIELD
+            table = table.annotate(**{
+                routing_field: get_expr_for_routing_key(table[ROUTING_FIELD], routing_scheme, bin_size=routing_bin_size)
+            })
+            elasticsearch_config["es.mapping.routing"] = routing_field
+            elasticsearch_config["es.mapping.exclude"] = routing_field
+            _meta = dict(_meta or {}, routing=get_routing_meta(routing_scheme, bin_size=routing_bin_size))
+
+        self.create_or_update_mapping(
+            index_name, elasticsearch_schema, num_shards=num_shards, _meta=_meta,
+            routing_partition_size=get_routing_partition_size(routing_scheme, num_shards),
+        )
 
         if func_to_run_after_index_exists:
             func_to_run_after_index_exists()
 
         logger.info(
-            "==> exporting data to elasticsearch. Write mode: %s, blocksize: %d",
+            "==> exporting data to elasticsearch with %s. Write mode: %s, blocksize: %d",
+            export_backend,
             elasticsearch_write_operation,
             block_size,
         )
 
-        hl.export_elasticsearch(
-            table, self._host, int(self._port), index_name, index_type_name, block_size, elasticsearch_config, verbose
+        range_metrics = []
+
+        def _export(table_to_export, start, end):
+            index_stats = self.get_index_stats(index_name)
+            range_start = time.time()
+            bulk_stats = None
+            if export_backend == EXPORT_BACKEND_PYTHON:
+                _, _, bulk_stats = self.export_table_partitions_with_bulk_client(
+                    table_to_export,
+                    index_name,
+                    elasticsearch_write_operation=elasticsearch_write_operation,
+                    ignore_elasticsearch_write_errors=ignore_elasticsearch_write_errors,
+                    elasticsearch_mapping_id=elasticsearch_mapping_id,
+                    write_null_values=write_null_values,
+                    routing_field=routing_field,
+                    num_workers=export_num_workers,
+                    ignore_conflicts=idempotent,
+                    chunk_size=block_size,
+                    max_chunk_bytes=parse_byte_size(elasticsearch_config["es.batch.size.bytes"]),
+                )
+            else:
+                hl.export_elasticsearch(
+                    table_to_export, self._host, int(self._port), index_name, index_type_name, block_size,
+                    elasticsearch_config, verbose,
+                )
+
+            metrics = {
+                "start": start,
+                "end": end,
+                "seconds": time.time() - range_start,
+                "docs": self.get_index_stats(index_name)["index_total"] - index_stats["index_total"],
+            }
+            if bulk_stats is not None:
+                chunk_stats = bulk_stats["chunks"]
+                metrics.update({
+                    "bytes": sum(stats["raw_bytes"] for stats in chunk_stats),
+                    "rejected": sum(stats["rejected"] for stats in chunk_stats),
+                    "conflicts": sum(stats["conflicts"] for stats in chunk_stats),
+                    "hail_seconds": sum(stats["hail_seconds"] for stats in bulk_stats["partitions"]),
+                    "bulk_request_seconds": sum(stats["seconds"] for stats in chunk_stats),
+                    "partitions": [
+                        dict(stats, partition=stats["partition"] + start) for stats in bulk_stats["partitions"]
+                    ],
+                })
+            logger.info("==> exported partitions %d-%d: %s", start, end - 1, {
+                k: v for k, v in metrics.items() if k != "partitions"})
+            range_metrics.append(metrics)
+
+        # a new index gets the same number of replicas as the one it replaces
+        num_replicas = None
+        if index_alias and self.es.indices.exists(index=index_alias):
+            num_replicas = self.get_num_replicas(index_alias)
+
+        index_stats = self.get_index_stats(index_name)
+        bulk_rejections = self.get_bulk_rejections()
+
+        # refresh, replicate and merge a new index once at the end of the export instead of during it
+        load_context = self.bulk_load(index_name, num_replicas=num_replicas) if is_new_index else contextlib.nullcontext()
+        with load_context:
+            if partition_ranges is None:
+                _export(table, 0, table.n_partitions())
+            else:
+                for start, end in partition_ranges:
+                    if [start, end] in completed_ranges:
+                        continue
+
+                    logger.info("==> exporting partitions %d-%d of %d", start, end - 1, partition_ranges[-1][1])
+                    _export(table._filter_partitions(list(range(start, end))), start, end)
+
+                    completed_ranges.append([start, end])
+                    write_export_manifest(export_manifest_path, manifest)
+
+        export_metrics = self._get_export_metrics(
+            index_name, export_backend, range_metrics, row_bytes, index_stats, bulk_rejections,
+            total_seconds=time.time() - export_start,
         )
+        logger.info("==> export metrics: %s", {k: v for k, v in export_metrics.items() if k != "partition_ranges"})
+
+        if index_alias:
+            if func_to_run_before_alias_swap:
+                func_to_run_before_alias_swap()
+            self.swap_alias(index_alias, index_name)
 
         """
         Potentially useful config settings for export_elasticsearch(..)
@@ -204,4 +690,4 @@ class ElasticsearchClient(BaseElasticsearchClient):
         es.batch.write.refresh // default true  (Whether to invoke an index refresh or not after a bulk update has been completed)
         """
 
-        self.es.indices.forcemerge(index=index_name, request_timeout=60)
+        return export_metrics
@@ -1,6 +1,13 @@
 import hail as hl
 import logging
 
+from hail_scripts.shared.elasticsearch_utils import (
+    ROUTING_SCHEME_CONTIG,
+    ROUTING_SCHEME_XPOS_BIN,
+    ROUTING_XPOS_BIN_SIZE,
+    XPOS_CONTIG_OFFSET,
+)
+
 logger = logging.getLogger()
 
 
@@ -75,3 +82,53 @@ def elasticsearch_schema_for_table(table, disable_doc_values_for_fields=(), disa
             properties[es_field_name]["index"] = False
 
     return properties
+
+
+# Rough serialized sizes in bytes, used to estimate the size of a row from its type
+HAIL_TYPE_TO_JSON_SIZE_ESTIMATE = {
+    hl.tint32: 6,
+    hl.tint64: 12,
+    hl.tfloat32: 10,
+    hl.tfloat64: 18,
+    hl.tstr: 16,
+    hl.tbool: 5,
+}
+ESTIMATED_ARRAY_LENGTH = 5
+
+
+def estimate_json_size_for_type(dtype):
+    """
+    Estimates the serialized size in bytes of a value of the given type. Used to size elasticsearch bulk requests
+    when a table can't be sampled.
+
+    Args:
+        dtype (hail.HailType): the type of the value
+    Returns:
+        int: estimated size in bytes
+    """
+    if isinstance(dtype, hl.tstruct):
+        return 2 + sum(len(field) + 4 + estimate_json_size_for_type(dtype[field]) for field in dtype.fields)
+    if isinstance(dtype, (hl.tarray, hl.tset)):
+        return 2 + ESTIMATED_ARRAY_LENGTH * (estimate_json_size_for_type(dtype.element_type) + 1)
+    if isinstance(dtype, hl.tlocus):
+        return 40
+    return HAIL_TYPE_TO_JSON_SIZE_ESTIMATE.get(dtype, 16)
+
+
+def get_expr_for_routing_key(xpos, routing_scheme, bin_size=ROUTING_XPOS_BIN_SIZE):
+    """
+    Expression for the routing key of a document. Matches hail_scripts.shared.elasticsearch_utils.get_routing_key.
+
+    Args:
+        xpos (Int64Expression): document xpos
+        routing_scheme (str): one of ROUTING_SCHEMES
+        bin_size (int): size in base pairs of the bins of the ROUTING_SCHEME_XPOS_BIN scheme
+    Returns:
+        StringExpression: "<contig number>" or "<contig number>-<bin>"
+    """
+    contig_number = hl.str(xpos // XPOS_CONTIG_OFFSET)
+    if routing_scheme == ROUTING_SCHEME_CONTIG:
+        return contig_number
+    if routing_scheme == ROUTING_SCHEME_XPOS_BIN:
+        return contig_number + "-" + hl.str((xpos % XPOS_CONTIG_OFFSET) // bin_size)
+    raise ValueError("Unexpected routing scheme: " + str(routing_scheme))
@@ -5,6 +5,8 @@ from hail_scripts.v02.utils.computed_fields.variant_id import get_expr_for_varia
 
 logger = logging.getLogger()
 
+VEP_CONFIG_PATH = "file:///vep_data/vep-gcloud.json"
+
 
 def import_table(
         table_path: str,
@@ -121,7 +123,7 @@ def run_vep(
     else:
         if genome_version not in ["37", "38"]:
             raise ValueError(f"Invalid genome version: {genome_version}")
-        config = "file:///vep_data/vep-gcloud.json"
+        config = VEP_CONFIG_PATH
 
     mt = hl.vep(mt, config=config, name=name, block_size=block_size)
 
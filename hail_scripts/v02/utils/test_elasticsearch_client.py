@@ -0,0 +1,176 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import hail as hl
+
+from hail_scripts.shared.elasticsearch_utils import EXPORT_BACKEND_PYTHON
+from .elasticsearch_client import ElasticsearchClient, read_export_manifest, write_export_manifest
+
+
+class TestElasticsearchClient(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.test_dir, "manifest.json")
+        ht = hl.utils.range_table(20, n_partitions=4)
+        self.table = ht.annotate(variantId=hl.str(ht.idx))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _get_client(self, exported_ids, exported_actions=None):
+        # a client that records the exported document IDs instead of sending them to elasticsearch
+        def _bulk_export(actions, **kwargs):
+            actions = list(actions)
+            exported_ids.extend(action["_id"] for action in actions)
+            if exported_actions is not None:
+                exported_actions.extend(actions)
+            chunk_stats = {"docs": len(actions), "raw_bytes": 0, "rejected": 0, "conflicts": 0, "seconds": 0}
+            return len(actions), [], [chunk_stats]
+
+        client = ElasticsearchClient(lazy_connection_check=True)
+        client.es = mock.MagicMock()
+        client.bulk_export = mock.Mock(side_effect=_bulk_export)
+        client.bulk_load = mock.Mock(return_value=contextlib.nullcontext())
+        client.create_or_update_mapping = mock.Mock()
+        client.get_num_data_nodes = mock.Mock(return_value=1)
+        client.get_index_stats = mock.Mock(return_value={
+            "index_total": 0, "store_bytes": 0, "indexing_seconds": 0, "bulk_seconds": 0})
+        client.get_bulk_rejections = mock.Mock(return_value=0)
+        client.get_shard_doc_counts = mock.Mock(return_value={0: 0})
+        return client
+
+    def _export(self, client):
+        return client.export_table_to_elasticsearch(
+            self.table,
+            "test_index",
+            num_shards=1,
+            elasticsearch_mapping_id="variantId",
+            export_manifest_path=self.manifest_path,
+            partitions_per_export=2,
+            export_backend=EXPORT_BACKEND_PYTHON,
+        )
+
+    def test_checkpointed_export(self):
+        exported_ids = []
+        client = self._get_client(exported_ids)
+        export_metrics = self._export(client)
+
+        self.assertListEqual(sorted(exported_ids, key=int), [str(i) for i in range(20)])
+        partition_metrics = export_metrics["partition_ranges"][0]["partitions"]
+        self.assertListEqual([metrics["docs"] for metrics in partition_metrics], [5, 5])
+        self.assertListEqual(read_export_manifest(self.manifest_path)["completed_ranges"], [[0, 2], [2, 4]])
+        client.bulk_load.assert_called_once()
+
+    def test_resume_checkpointed_export(self):
+        write_export_manifest(self.manifest_path, {
+            "index_name": "test_index",
+            "num_partitions": 4,
+            "partitions_per_export": 2,
+            "index_alias": None,
+            "completed_ranges": [[0, 2]],
+        })
+
+        exported_ids = []
+        client = self._get_client(exported_ids)
+        self._export(client)
+
+        # only the partitions that were not already exported are sent, to the existing index
+        self.assertListEqual(sorted(exported_ids, key=int), [str(i) for i in range(10, 20)])
+        self.assertListEqual(read_export_manifest(self.manifest_path)["completed_ranges"], [[0, 2], [2, 4]])
+        client.es.indices.delete.assert_not_called()
+        client.bulk_load.assert_called_once()
+
+    def test_idempotent_export(self):
+        exported_actions = []
+        client = self._get_client([], exported_actions)
+        client.export_table_to_elasticsearch(
+            self.table,
+            "test_index",
+            num_shards=1,
+            elasticsearch_mapping_id="variantId",
+            export_backend=EXPORT_BACKEND_PYTHON,
+            idempotent=True,
+        )
+        self.assertSetEqual({action["_op_type"] for action in exported_actions}, {"create"})
+        self.assertTrue(all(call[1]["ignore_conflicts"] for call in client.bulk_export.call_args_list))
+
+        # es-hadoop would fail on, or drop every error along with, the conflicts of create operations
+        with self.assertRaises(ValueError):
+            client.export_table_to_elasticsearch(
+                self.table, "test_index", num_shards=1, elasticsearch_mapping_id="variantId", idempotent=True)
+        with self.assertRaises(ValueError):
+            client.export_table_to_elasticsearch(
+                self.table, "test_index", num_shards=1, export_backend=EXPORT_BACKEND_PYTHON, idempotent=True)
+
+    def test_checkpointed_export_requires_mapping_id(self):
+        # a resumed range is exported again, which would duplicate documents with generated IDs
+        client = self._get_client([])
+        with self.assertRaises(ValueError):
+            client.export_table_to_elasticsearch(
+                self.table,
+                "test_index",
+                num_shards=1,
+                export_manifest_path=self.manifest_path,
+                partitions_per_export=2,
+                export_backend=EXPORT_BACKEND_PYTHON,
+            )
+        client.bulk_export.assert_not_called()
+
+    def test_update_existing_index(self):
+        # an existing index updated in place keeps its serving settings
+        exported_ids = []
+        client = self._get_client(exported_ids)
+        client.es.indices.exists.return_value = True
+        client.export_table_to_elasticsearch(
+            self.table,
+            "test_index",
+            num_shards=1,
+            delete_index_before_exporting=False,
+            elasticsearch_write_operation="update",
+            elasticsearch_mapping_id="variantId",
+            export_backend=EXPORT_BACKEND_PYTHON,
+        )
+
+        self.assertEqual(len(exported_ids), 20)
+        client.bulk_load.assert_not_called()
+        client.es.indices.delete.assert_not_called()
+
+    def test_export_with_measured_row_bytes(self):
+        # a row size that was already measured, for example to choose the number of shards, is not measured again
+        exported_ids = []
+        client = self._get_client(exported_ids)
+        client.estimate_table_row_bytes = mock.Mock()
+        client.export_table_to_elasticsearch(
+            self.table,
+            "test_index",
+            num_shards=1,
+            elasticsearch_mapping_id="variantId",
+            export_backend=EXPORT_BACKEND_PYTHON,
+            row_bytes=100,
+        )
+
+        self.assertEqual(len(exported_ids), 20)
+        client.estimate_table_row_bytes.assert_not_called()
+
+    def test_bulk_export_expands_types(self):
+        # loci and dicts are exported in the same shape as with es-hadoop
+        table = self.table.annotate(
+            rg37_locus=hl.locus("1", self.table.idx + 1, reference_genome="GRCh37"),
+            counts=hl.dict([("AC", self.table.idx)]),
+        )
+        exported_ids = []
+        exported_actions = []
+        client = self._get_client(exported_ids, exported_actions)
+        client.export_table_partitions_with_bulk_client(table, "test_index", elasticsearch_mapping_id="variantId")
+
+        source = next(action["_source"] for action in exported_actions if action["_id"] == "0")
+        self.assertDictEqual(source["rg37_locus"], {"contig": "1", "position": 1})
+        self.assertListEqual(source["counts"], [{"key": "AC", "value": 0}])
+
+
+if __name__ == "__main__":
+    unittest.main()
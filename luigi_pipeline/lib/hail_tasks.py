@@ -3,17 +3,21 @@ Tasks for Hail.
 """
 import json
 import logging
-import math
 import os
+import time
 
 import hail as hl
 import luigi
 from luigi.contrib import gcs
 from luigi.parameter import ParameterVisibility
 
-from hail_scripts.v02.utils.elasticsearch_client import ElasticsearchClient
+from hail_scripts.shared.elasticsearch_utils import EXPORT_BACKEND_ES_HADOOP, EXPORT_BACKEND_PYTHON, EXPORT_BACKENDS, \
+    ES_INDEX_BYTES_PER_SOURCE_BYTE
+from hail_scripts.shared.elasticsearch_client_v7 import get_versioned_index_name
+from hail_scripts.v02.utils.elasticsearch_client import ElasticsearchClient, read_export_manifest
 from lib.global_config import GlobalConfig
 import lib.hail_vep_runners as vep_runners
+import lib.vcf_partitions as vcf_partitions
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +51,15 @@ class HailMatrixTableTask(luigi.Task):
     genome_version = luigi.Parameter(description='Reference Genome Version (37 or 38)')
     vep_runner = luigi.ChoiceParameter(choices=['VEP', 'DUMMY'], default='VEP', description='Choice of which vep runner'
                                                                                             'to annotate vep.')
+    vep_cache_path = luigi.OptionalParameter(default=None,
+                                             description='Path of a persistent VEP cache. When set, VEP only runs '
+                                                         'on variants not already in the cache.')
+    vcf_min_partitions = luigi.IntParameter(default=0,
+                                            description='Partitions to import the VCFs with. 0 plans them from the '
+                                                        'VCF sizes, tabix indices and sample count.')
+    vcf_partition_cores = luigi.IntParameter(default=0,
+                                             description='Cluster cores to round the planned VCF partitions up to a '
+                                                         'multiple of. 0 does not round.')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -75,7 +88,7 @@ class HailMatrixTableTask(luigi.Task):
         mt.write(self.output().path)
 
     def import_vcf(self):
-        # Import the VCFs from inputs. Set min partitions so that local pipeline execution takes advantage of all CPUs.
+        # Import the VCFs from inputs.
         recode = {}
         if self.genome_version == "38":
             recode = {f"{i}": f"chr{i}" for i in (list(range(1, 23)) + ['X', 'Y'])}
@@ -86,7 +99,43 @@ class HailMatrixTableTask(luigi.Task):
                              reference_genome='GRCh' + self.genome_version,
                              skip_invalid_loci=True,
                              contig_recoding=recode,
-                             force_bgz=True, min_partitions=500)
+                             force_bgz=True, min_partitions=self.get_vcf_min_partitions())
+
+    def get_vcf_min_partitions(self):
+        """
+        Plans min_partitions for import_vcf. Only file sizes and contents are used, so the plan for a callset is the
+        same locally and on Dataproc.
+
+        :return: number of partitions
+        """
+        if self.vcf_min_partitions:
+            return self.vcf_min_partitions
+
+        # hadoop_ls expands globs in the source paths.
+        vcf_files = [file_info for source_path in self.source_paths for file_info in hl.hadoop_ls(source_path)]
+        vcf_paths = [file_info['path'] for file_info in vcf_files]
+        vcf_bytes = sum(file_info['size_bytes'] for file_info in vcf_files)
+        with hl.hadoop_open(vcf_paths[0]) as f:
+            num_samples = vcf_partitions.get_vcf_num_samples(f)
+
+        num_records = 0
+        for vcf_path in vcf_paths:
+            if not hl.hadoop_exists(f'{vcf_path}.tbi'):
+                num_records = None
+                break
+            with hl.hadoop_open(f'{vcf_path}.tbi', 'rb') as f:
+                vcf_num_records = vcf_partitions.get_tabix_num_records(f.read())
+            if vcf_num_records is None:
+                num_records = None
+                break
+            num_records += vcf_num_records
+
+        min_partitions = vcf_partitions.get_vcf_min_partitions(vcf_bytes, num_samples, num_records=num_records,
+                                                               num_cores=self.vcf_partition_cores)
+        logger.info(f'Importing {len(vcf_paths)} VCFs ({vcf_bytes} bytes, {num_samples} samples, '
+                    f'{num_records if num_records is not None else "unknown"} records) with {min_partitions} '
+                    f'partitions')
+        return min_partitions
 
     @staticmethod
     def sample_type_stats(mt, genome_version, threshold=0.3):
@@ -99,28 +148,47 @@ class HailMatrixTableTask(luigi.Task):
         :param threshold: if the matched percentage is over this threshold, we classify as match
         :return: a dict of coding/non-coding to dict with 'matched_count', 'total_count' and 'match' boolean.
         """
-        stats = {}
         types_to_ht_path = {
             'noncoding': GlobalConfig().param_kwargs['validation_%s_noncoding_ht' % genome_version],
             'coding': GlobalConfig().param_kwargs['validation_%s_coding_ht' % genome_version]
         }
+        # Union the validation tables with their category so the mt rows are only joined and aggregated once.
+        validation_ht = None
+        total_counts = {}
         for sample_type, ht_path in types_to_ht_path.items():
             ht = hl.read_table(ht_path)
-            stats[sample_type] = ht_stats = {
-                'matched_count': mt.semi_join_rows(ht).count_rows(),
-                'total_count': ht.count(),
+            # Counting a table read from disk uses its metadata, not a Spark job.
+            total_counts[sample_type] = ht.count()
+            ht = ht.select(category=sample_type).select_globals()
+            validation_ht = ht if validation_ht is None else validation_ht.union(ht)
+        validation_ht = validation_ht.annotate_globals(total_counts=total_counts)
+
+        rows_ht = mt.rows().select()
+        counts = validation_ht.aggregate(hl.struct(
+            matched_counts=hl.agg.filter(hl.is_defined(rows_ht[validation_ht.key]),
+                                         hl.agg.counter(validation_ht.category)),
+            total_counts=validation_ht.total_counts,
+        ))
 
+        stats = {}
+        for sample_type in types_to_ht_path:
+            stats[sample_type] = ht_stats = {
+                'matched_count': counts.matched_counts.get(sample_type, 0),
+                'total_count': counts.total_counts[sample_type],
             }
             ht_stats['match'] = (ht_stats['matched_count']/ht_stats['total_count']) >= threshold
         return stats
 
-    def run_vep(mt, genome_version, runner='VEP', vep_config_json_path=None):
+    def run_vep(mt, genome_version, runner='VEP', vep_config_json_path=None, vep_cache_path=None):
         runners = {
             'VEP': vep_runners.HailVEPRunner,
             'DUMMY': vep_runners.HailVEPDummyRunner
         }
 
-        return runners[runner]().run(mt, genome_version, vep_config_json_path=vep_config_json_path)
+        vep_runner = runners[runner]()
+        if vep_cache_path:
+            vep_runner = vep_runners.HailVEPCacheRunner(vep_runner, vep_cache_path)
+        return vep_runner.run(mt, genome_version, vep_config_json_path=vep_config_json_path)
 
     @staticmethod
     def subset_samples_and_variants(mt, subset_path):
@@ -206,14 +274,49 @@ class HailElasticSearchTask(luigi.Task):
     es_index_min_num_shards = luigi.IntParameter(default=6,
                                                  description='Number of shards for the index will be the greater of '
                                                              'this value and a calculated value based on the matrix.')
+    es_target_shard_size_gb = luigi.FloatParameter(default=30,
+                                                   description='Shard size to aim for when calculating the number of '
+                                                               'shards from the estimated index size.')
+    es_index_bytes_per_source_byte = luigi.FloatParameter(default=ES_INDEX_BYTES_PER_SOURCE_BYTE,
+                                                          description='Size of the index on disk per byte of '
+                                                                      'exported JSON, used to estimate the index size. '
+                                                                      'The store_bytes_per_source_byte export metric '
+                                                                      'of a previous load measures it.')
+    es_partitions_per_export = luigi.IntParameter(default=0,
+                                                  description='If set, export to ElasticSearch this many partitions at '
+                                                              'a time, recording progress so an interrupted export '
+                                                              'can be resumed.')
+    es_relocation_timeout = luigi.IntParameter(default=0,
+                                               description='If set, maximum number of seconds to wait for the index '
+                                                           'shards to move off the loading nodes.')
+    es_export_backend = luigi.ChoiceParameter(choices=sorted(EXPORT_BACKENDS), default=EXPORT_BACKEND_ES_HADOOP,
+                                              description='Export with the es-hadoop connector in spark, or '
+                                                          'partition by partition with the python bulk client.')
+    es_use_index_alias = luigi.BoolParameter(default=False,
+                                             description='Load into a new timestamped index and atomically point '
+                                                         'es_index at it as an alias once loaded, instead of deleting '
+                                                         'and recreating es_index.')
+    es_idempotent_export = luigi.BoolParameter(default=False,
+                                               description='Record each exported partition so a retried or '
+                                                           'resumed export skips completed partitions, and skip '
+                                                           'documents that were already written. Requires the python '
+                                                           'export backend.')
+    es_routing_scheme = luigi.OptionalParameter(default=None,
+                                                description='Route documents to shards by "contig" or "xpos_bin" '
+                                                            'so region queries only search a few shards.')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if self.es_index != self.es_index.lower():
             raise Exception(f"Invalid es_index name [{self.es_index}], must be lowercase")
+        if self.es_idempotent_export and self.es_export_backend != EXPORT_BACKEND_PYTHON:
+            raise Exception(f"es_idempotent_export requires es_export_backend={EXPORT_BACKEND_PYTHON}")
 
-        self._es = ElasticsearchClient(
+        self._es = ElasticsearchClient.get_shared_client(
             host=self.es_host, port=self.es_port, es_username=self.es_username, es_password=self.es_password)
+        # The physical index being loaded, which differs from es_index when loading behind an alias
+        self._load_index = self.es_index
+        self.export_metrics = {}
 
     def requires(self):
         return [VcfFile(filename=self.source_path)]
@@ -225,22 +328,68 @@ class HailElasticSearchTask(luigi.Task):
     def import_mt(self):
         return hl.read_matrix_table(self.input()[0].path)
 
-    def export_table_to_elasticsearch(self, table, num_shards):
+    def _get_load_index_name(self, export_manifest_path=None):
+        if not self.es_use_index_alias:
+            return self.es_index
+        # resume loading the same index as an interrupted export, unless that export finished and the index is serving
+        manifest = read_export_manifest(export_manifest_path) if export_manifest_path else None
+        if manifest and manifest.get('index_alias') == self.es_index and \
+                manifest['index_name'] not in self._es.get_alias_indices(self.es_index):
+            return manifest['index_name']
+        # indices left by earlier failed loads are deleted once the alias is swapped to the new index
+        return get_versioned_index_name(self.es_index)
+
+    def export_table_to_elasticsearch(self, table, num_shards, export_manifest_path=None, row_bytes=None):
+        partitions_per_export = self.es_partitions_per_export
+        if self.es_idempotent_export and not partitions_per_export:
+            # The python backend exports one partition at a time anyway
+            partitions_per_export = 1
+        checkpoint_kwargs = {}
+        if export_manifest_path and partitions_per_export:
+            checkpoint_kwargs = {
+                'export_manifest_path': export_manifest_path,
+                'partitions_per_export': partitions_per_export,
+            }
+        self._load_index = self._get_load_index_name(checkpoint_kwargs.get('export_manifest_path'))
         func_to_run_after_index_exists = None if not self.use_temp_loading_nodes else \
-            lambda: self._es.route_index_to_temp_es_cluster(self.es_index)
-        self._es.export_table_to_elasticsearch(table,
-                                               index_name=self.es_index,
-                                               func_to_run_after_index_exists=func_to_run_after_index_exists,
-                                               elasticsearch_mapping_id="docId",
-                                               num_shards=num_shards,
-                                               write_null_values=True)
+            lambda: self._es.route_index_to_temp_es_cluster(self._load_index)
+        alias_kwargs = {}
+        if self.es_use_index_alias:
+            # the index is moved off the loading nodes before it starts serving searches
+            alias_kwargs = {'index_alias': self.es_index, 'func_to_run_before_alias_swap': self.cleanup}
+        export_metrics = self._es.export_table_to_elasticsearch(
+            table,
+            index_name=self._load_index,
+            func_to_run_after_index_exists=func_to_run_after_index_exists,
+            elasticsearch_mapping_id="docId",
+            num_shards=num_shards,
+            write_null_values=True,
+            export_backend=self.es_export_backend,
+            idempotent=self.es_idempotent_export,
+            routing_scheme=self.es_routing_scheme,
+            row_bytes=row_bytes,
+            **checkpoint_kwargs,
+            **alias_kwargs,
+        )
+        self.export_metrics.update(export_metrics)
+
+    def write_export_metrics(self, export_metrics_path):
+        with hl.hadoop_open(export_metrics_path, 'w') as f:
+            json.dump(self.export_metrics, f, indent=2)
 
     def cleanup(self):
-        self._es.route_index_off_temp_es_cluster(self.es_index)
-
-
-    def _mt_num_shards(self, mt):
-        # The greater of the user specified min shards and calculated based on the variants and samples
-        denominator = 1.4*10**9
-        calculated_num_shards = math.ceil((mt.count_rows() * mt.count_cols())/denominator)
-        return max(self.es_index_min_num_shards, calculated_num_shards)
+        start = time.time()
+        self._es.route_index_off_temp_es_cluster(self._load_index)
+        # Only done once the shards are off the loading nodes, so they can be scaled down safely.
+        self._es.wait_for_shards_off_nodes(self._load_index, timeout=self.es_relocation_timeout or None)
+        self.export_metrics.setdefault('relocation_seconds', time.time() - start)
+
+
+    def _get_num_shards(self, mt, row_table, row_bytes=None):
+        # The greater of the user specified min shards and calculated from the estimated size of the exported rows.
+        # The row count of a matrix table that was just read comes from its metadata, so it does not run a spark job.
+        return self._es.get_table_num_shards(row_table, mt.count_rows(),
+                                             target_shard_bytes=int(self.es_target_shard_size_gb * 1024**3),
+                                             min_num_shards=self.es_index_min_num_shards,
+                                             row_bytes=row_bytes,
+                                             index_bytes_per_source_byte=self.es_index_bytes_per_source_byte)
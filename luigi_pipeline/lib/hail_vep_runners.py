@@ -1,22 +1,158 @@
+import hashlib
+import logging
+import os
+import re
+import uuid
 from abc import ABC, abstractmethod
 
 import hail as hl
 
 from hail_scripts.v02.utils import hail_utils
 
+logger = logging.getLogger(__name__)
+
+# <generation>_<writer id>.ht, or <generation>.ht for caches written before the writer id was added
+VEP_CACHE_GENERATION_RE = re.compile(r'^(\d+)(?:_[0-9a-f]+)?\.ht$')
+
 
 class HailVEPRunnerBase(ABC):
 
     @abstractmethod
-    def run(self, mt, genome_version):
+    def run(self, mt, genome_version, vep_config_json_path=None):
         pass
 
+    def get_config_fingerprint(self, genome_version, vep_config_json_path=None):
+        """
+        Returns a string that changes whenever the annotations produced by this runner change. Used to version
+        the VEP cache.
+        """
+        return type(self).__name__
+
 
 class HailVEPRunner(HailVEPRunnerBase):
 
     def run(self, mt, genome_version, vep_config_json_path=None):
         return hail_utils.run_vep(mt, genome_version, vep_config_json_path=vep_config_json_path)
 
+    def get_config_fingerprint(self, genome_version, vep_config_json_path=None):
+        # The config pins the VEP version, cache and plugins, and so the gencode version of the annotations.
+        with hl.hadoop_open(vep_config_json_path or hail_utils.VEP_CONFIG_PATH) as f:
+            return f.read()
+
+
+class HailVEPCacheRunner(HailVEPRunnerBase):
+    """
+    Wraps another runner so VEP only runs on variants missing from a persistent cache of `vep` annotations.
+
+    The cache is a Hail Table keyed by locus and alleles, kept in a directory per VEP version (a hash of the
+    genome version and the runner's config). Its globals hold the globals VEP adds, e.g. gencodeVersion. Each
+    run that finds new variants writes the merged annotations as the next generation of the cache, so a
+    generation is never overwritten while it is being read. After writing, generations older than the last
+    `keep_generations` are deleted, since each generation already holds every annotation of the ones before it.
+    Keeping the previous generation lets runs that started reading it before the write finish.
+
+    Each write goes to a path unique to the run, so concurrent runs that start from the same generation both
+    write the next generation without conflicting. Only one of them is read by later runs, which send the
+    variants that are missing from it to VEP again.
+    """
+
+    def __init__(self, runner, cache_path, keep_generations=2):
+        self.runner = runner
+        self.cache_path = cache_path
+        self.keep_generations = keep_generations
+
+    def get_cache_version_path(self, genome_version, vep_config_json_path=None):
+        fingerprint = self.runner.get_config_fingerprint(genome_version, vep_config_json_path=vep_config_json_path)
+        version = hashlib.sha256(f'{genome_version}\n{fingerprint}'.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_path, f'GRCh{genome_version}', version)
+
+    @staticmethod
+    def get_latest_cache_generation(version_path):
+        """
+        :param version_path: cache directory for one VEP version
+        :return: tuple of the latest complete generation number and its table path, or (-1, None) if empty
+        """
+        generations = [
+            (generation, name) for generation, name in HailVEPCacheRunner.list_cache_generations(version_path)
+            if hl.hadoop_exists(os.path.join(version_path, name, '_SUCCESS'))
+        ]
+        if not generations:
+            return -1, None
+
+        # concurrent runs can write the same generation, so the name breaks ties to always pick the same one
+        generation, name = max(generations)
+        return generation, os.path.join(version_path, name)
+
+    @staticmethod
+    def list_cache_generations(version_path):
+        """
+        :param version_path: cache directory for one VEP version
+        :return: list of (generation number, table name) tuples, including tables that are still being written
+        """
+        if not hl.hadoop_exists(version_path):
+            return []
+
+        generations = []
+        for file_info in hl.hadoop_ls(version_path):
+            name = os.path.basename(file_info['path'].rstrip('/'))
+            match = VEP_CACHE_GENERATION_RE.match(name)
+            if match:
+                generations.append((int(match.group(1)), name))
+        return generations
+
+    def prune_cache_generations(self, version_path, generation):
+        """
+        Deletes the tables of generations that are more than `keep_generations` older than the given generation,
+        including tables left by runs that failed while writing them.
+
+        :param version_path: cache directory for one VEP version
+        :param generation: latest generation number
+        :return: list of the deleted table paths
+        """
+        deleted_paths = []
+        for name_generation, name in sorted(self.list_cache_generations(version_path)):
+            if name_generation > generation - self.keep_generations:
+                continue
+            path = os.path.join(version_path, name)
+            logger.info(f'Deleting VEP cache generation {path}')
+            hl.current_backend().fs.rmtree(path)
+            deleted_paths.append(path)
+        return deleted_paths
+
+    def run(self, mt, genome_version, vep_config_json_path=None):
+        version_path = self.get_cache_version_path(genome_version, vep_config_json_path=vep_config_json_path)
+        generation, cache_ht_path = self.get_latest_cache_generation(version_path)
+
+        rows_ht = mt.rows().select().select_globals().distinct()
+        cache_ht = hl.read_table(cache_ht_path) if cache_ht_path else None
+        misses_ht = rows_ht.anti_join(cache_ht) if cache_ht is not None else rows_ht
+
+        num_misses = misses_ht.count()
+        logger.info(f'VEP cache {version_path} generation {generation}: running VEP on {num_misses} new variants')
+        if num_misses == 0 and cache_ht is None:
+            return self.runner.run(mt, genome_version, vep_config_json_path=vep_config_json_path)
+
+        if num_misses > 0:
+            vep_ht = self.runner.run(
+                hl.MatrixTable.from_rows_table(misses_ht), genome_version, vep_config_json_path=vep_config_json_path,
+            ).rows().select('vep')
+
+            if cache_ht is not None:
+                cache_globals, vep_globals = hl.eval(cache_ht.globals), hl.eval(vep_ht.globals)
+                if cache_globals != vep_globals:
+                    raise ValueError(f'VEP cache {cache_ht_path} globals {cache_globals} do not match the '
+                                     f'globals of new VEP annotations {vep_globals}')
+                vep_ht = cache_ht.union(vep_ht)
+
+            cache_ht_path = os.path.join(version_path, f'{generation + 1:05d}_{uuid.uuid4().hex[:12]}.ht')
+            vep_ht.write(cache_ht_path)
+            logger.info(f'Wrote VEP cache generation {cache_ht_path}')
+            cache_ht = hl.read_table(cache_ht_path)
+            self.prune_cache_generations(version_path, generation + 1)
+
+        mt = mt.annotate_rows(vep=cache_ht[mt.row_key].vep)
+        return mt.annotate_globals(**hl.eval(cache_ht.globals))
+
 
 class HailVEPDummyRunner(HailVEPRunnerBase):
     """ Dummy hail runner used in environments (e.g. local) when a VEP installation is not available to run.
@@ -559,5 +695,5 @@ class HailVEPDummyRunner(HailVEPRunnerBase):
            'variant_class': 'SNV'},)
 
 
-    def run(self, mt, genome_version):
+    def run(self, mt, genome_version, vep_config_json_path=None):
         return mt.annotate_rows(vep=self.MOCK_VEP_DATA)
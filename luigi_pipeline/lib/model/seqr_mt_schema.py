@@ -45,7 +45,7 @@ class SeqrSchema(BaseMTSchema):
 
     @row_annotation(name='docId')
     def doc_id(self, length=512):
-        return variant_id.get_expr_for_variant_id(self.mt, length)
+        return variant_id.get_expr_for_doc_id(self.mt, length)
 
     @row_annotation(name='variantId')
     def variant_id(self):
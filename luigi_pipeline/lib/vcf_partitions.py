@@ -0,0 +1,89 @@
+"""
+Plans the number of partitions to import VCFs with, from the VCF sizes, their tabix indices and sample count.
+"""
+import gzip
+import math
+import struct
+
+# Compressed VCF bytes per partition.
+TARGET_PARTITION_BYTES = 64 * 1024 ** 2
+# Genotypes per partition, which bounds the executor memory a partition needs regardless of the sample count.
+TARGET_PARTITION_ENTRIES = 20 * 10 ** 6
+
+# Tabix pseudo-bin holding the mapped and unmapped record counts of a contig.
+TABIX_PSEUDO_BIN = 37450
+
+
+def get_vcf_num_samples(lines):
+    """
+    Counts the samples in a VCF header.
+
+    :param lines: iterable of the decompressed VCF lines
+    :return: number of sample columns
+    """
+    for line in lines:
+        if line.startswith('#CHROM'):
+            return max(len(line.rstrip('\n').split('\t')) - 9, 0)
+        if not line.startswith('#'):
+            break
+    raise ValueError('VCF header is missing the #CHROM line')
+
+
+def get_tabix_num_records(data):
+    """
+    Reads the number of records in a VCF from the per contig counts of its tabix index.
+
+    :param data: bytes of the bgzipped .tbi file
+    :return: number of records, or None if the index does not have record counts
+    """
+    data = gzip.decompress(data)
+    if data[:4] != b'TBI\x01':
+        raise ValueError('Not a tabix index')
+
+    n_ref, = struct.unpack_from('<i', data, 4)
+    l_nm, = struct.unpack_from('<i', data, 32)
+    offset = 36 + l_nm
+
+    num_records = 0
+    for _ in range(n_ref):
+        has_counts = False
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin_id == TABIX_PSEUDO_BIN:
+                n_mapped, = struct.unpack_from('<Q', data, offset + 16)
+                num_records += n_mapped
+                has_counts = True
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+
+        if not has_counts:
+            return None
+
+    return num_records
+
+
+def get_vcf_min_partitions(vcf_bytes, num_samples, num_records=None, num_cores=None,
+                           target_partition_bytes=TARGET_PARTITION_BYTES,
+                           target_partition_entries=TARGET_PARTITION_ENTRIES):
+    """
+    Picks the min_partitions to import VCFs with. Small callsets get a few partitions instead of many tiny tasks,
+    and large multi-sample callsets get partitions with a bounded number of genotypes.
+
+    :param vcf_bytes: total compressed size of the VCFs
+    :param num_samples: number of samples in the VCFs
+    :param num_records: number of VCF records, if known from the tabix indices
+    :param num_cores: if set, round the partitions up to a multiple of the cluster cores
+    :param target_partition_bytes: compressed VCF bytes per partition
+    :param target_partition_entries: genotypes per partition
+    :return: number of partitions
+    """
+    min_partitions = math.ceil(vcf_bytes / target_partition_bytes)
+    if num_records:
+        min_partitions = max(min_partitions, math.ceil(num_records * max(num_samples, 1) / target_partition_entries))
+    if num_cores:
+        min_partitions = math.ceil(min_partitions / num_cores) * num_cores
+    return max(min_partitions, 1)
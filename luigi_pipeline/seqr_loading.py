@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import pkg_resources
@@ -7,11 +8,15 @@ import sys
 import luigi
 import hail as hl
 
+from hail_scripts.v02.utils.computed_fields.variant_id import DOC_ID_SCHEME_HASHED
 from lib.hail_tasks import HailMatrixTableTask, HailElasticSearchTask, GCSorLocalTarget, MatrixTableSampleSetError
 from lib.model.seqr_mt_schema import SeqrVariantSchema, SeqrGenotypesSchema, SeqrVariantsAndGenotypesSchema
 
 logger = logging.getLogger(__name__)
 
+# Global of the checkpoints of SeqrVCFToMTTask with the parameters they were written with
+CHECKPOINT_PARAMS_GLOBAL = 'checkpointParams'
+
 
 def check_if_path_exists(path, label=""):
     if (path.startswith("gs://") and not hl.hadoop_exists(path)) or (not path.startswith("gs://") and not os.path.exists(path)):
@@ -41,8 +46,17 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
     vep_config_json_path = luigi.OptionalParameter(default=None,
                                         description="Path of hail vep config .json file")
 
+    # Parameters that determine the contents of a checkpoint written by this task
+    checkpoint_params = ()
+
+    def requires(self):
+        return [self.clone_checkpoint_task(SeqrVCFToSitesHTTask)]
+
     def run(self):
-        # first validate paths
+        self.check_paths()
+        self.read_vcf_write_mt()
+
+    def check_paths(self):
         for source_path in self.source_paths:
             check_if_path_exists(source_path, "source_path")
         check_if_path_exists(self.reference_ht_path, "reference_ht_path")
@@ -52,39 +66,112 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
         if self.subset_path: check_if_path_exists(self.subset_path, "subset_path")
         if self.vep_config_json_path: check_if_path_exists(self.vep_config_json_path, "vep_config_json_path")
 
-        self.read_vcf_write_mt()
+    def clone_checkpoint_task(self, cls):
+        # source_paths is parsed into a list in __init__, so pass the original parameter value.
+        return self.clone(cls, source_paths=self.param_kwargs['source_paths'])
+
+    def _get_checkpoint_path(self, suffix):
+        # e.g. gs://bucket/callset.mt => gs://bucket/callset_sites.ht
+        path = self.dest_path.rstrip('/')
+        if path.endswith('.mt'):
+            path = path[:-len('.mt')]
+        return path + suffix
+
+    @property
+    def split_mt_path(self):
+        return self._get_checkpoint_path('_split.mt')
 
-    def read_vcf_write_mt(self, schema_cls=SeqrVariantsAndGenotypesSchema):
+    @property
+    def sites_ht_path(self):
+        return self._get_checkpoint_path('_sites.ht')
+
+    def read_vcf_write_mt(self, genotypes_schema_cls=SeqrGenotypesSchema):
         logger.info("Args:")
         pprint.pprint(self.__dict__)
 
-        mt = self.import_vcf()
-        mt = self.annotate_old_and_split_multi_hts(mt)
-        if not self.dont_validate:
-            self.validate_mt(mt, self.genome_version, self.sample_type)
+        mt = self.read_subset_mt()
+        sites_ht = hl.read_table(self.sites_ht_path)
+        # genotypes are annotated on the entries, then the annotated sites are joined back.
+        if genotypes_schema_cls:
+            mt = genotypes_schema_cls(mt).annotate_all(overwrite=True).select_annotated_mt()
+            mt = mt.annotate_rows(**sites_ht[mt.row_key])
+        else:
+            mt = mt.select_rows(**sites_ht[mt.row_key])
+
+        mt = mt.annotate_globals(**hl.eval(sites_ht.globals.drop(CHECKPOINT_PARAMS_GLOBAL)))
+        mt = mt.annotate_globals(sourceFilePath=','.join(self.source_paths),
+                                 genomeVersion=self.genome_version,
+                                 sampleType=self.sample_type,
+                                 docIdScheme=DOC_ID_SCHEME_HASHED,
+                                 hail_version=pkg_resources.get_distribution('hail').version)
+
+        mt.describe()
+        mt.write(self.output().path, stage_locally=True, overwrite=True)
+
+    def read_split_mt(self):
+        return hl.read_matrix_table(self.split_mt_path).drop(CHECKPOINT_PARAMS_GLOBAL)
+
+    def read_subset_mt(self, split_mt=None):
+        """
+        :param split_mt: the split mt, if it was already read
+        :return: split mt with remapped sample IDs, subset to the samples and the variants they have
+        """
+        mt = split_mt if split_mt is not None else self.read_split_mt()
         if self.remap_path:
             mt = self.remap_sample_ids(mt, self.remap_path)
         if self.subset_path:
             mt = self.subset_samples_and_variants(mt, self.subset_path)
+        return mt
+
+    def get_checkpoint_params(self):
+        str_params = self.to_str_params()
+        return json.dumps({name: str_params[name] for name in self.checkpoint_params}, sort_keys=True)
+
+    def is_checkpoint_complete(self, path, read_fn):
+        """
+        Checks that a checkpoint was completely written, with the current checkpoint parameters. A checkpoint
+        written for other inputs, e.g. other source paths or VEP settings, is stale and is rewritten.
+
+        :param path: checkpoint path
+        :param read_fn: hl.read_matrix_table or hl.read_table
+        :return: True if the checkpoint can be reused
+        """
+        if not GCSorLocalTarget(os.path.join(path, '_SUCCESS')).exists():
+            return False
+
+        checkpoint_globals = read_fn(path).globals
+        params = None
+        if CHECKPOINT_PARAMS_GLOBAL in checkpoint_globals.dtype.fields:
+            params = hl.eval(checkpoint_globals[CHECKPOINT_PARAMS_GLOBAL])
+        if params != self.get_checkpoint_params():
+            logger.info(f'Checkpoint {path} was written with other parameters ({params}), rewriting it')
+            return False
+        return True
+
+    def annotate_sites(self, mt, schema_cls=SeqrVariantSchema):
+        """
+        Runs VEP and the row annotations of `schema_cls` on the distinct sites of the mt, without its entries,
+        so VEP blocks and reference data joins do not carry genotypes.
+
+        :param mt: split mt with the VCF row fields
+        :param schema_cls: schema with the row annotations to compute
+        :return: table keyed by locus and alleles with the annotated row fields
+        """
+        sites_mt = hl.MatrixTable.from_rows_table(mt.rows().distinct())
         if self.genome_version == '38':
-            mt = self.add_37_coordinates(mt)
-        mt = HailMatrixTableTask.run_vep(mt, self.genome_version, self.vep_runner, vep_config_json_path=self.vep_config_json_path)
+            sites_mt = self.add_37_coordinates(sites_mt)
+        sites_mt = HailMatrixTableTask.run_vep(sites_mt, self.genome_version, self.vep_runner,
+                                               vep_config_json_path=self.vep_config_json_path,
+                                               vep_cache_path=self.vep_cache_path)
 
         ref_data = hl.read_table(self.reference_ht_path)
         clinvar = hl.read_table(self.clinvar_ht_path)
         # hgmd is optional.
         hgmd = hl.read_table(self.hgmd_ht_path) if self.hgmd_ht_path else None
 
-        mt = schema_cls(mt, ref_data=ref_data, clinvar_data=clinvar, hgmd_data=hgmd).annotate_all(
+        sites_mt = schema_cls(sites_mt, ref_data=ref_data, clinvar_data=clinvar, hgmd_data=hgmd).annotate_all(
             overwrite=True).select_annotated_mt()
-
-        mt = mt.annotate_globals(sourceFilePath=','.join(self.source_paths),
-                                 genomeVersion=self.genome_version,
-                                 sampleType=self.sample_type,
-                                 hail_version=pkg_resources.get_distribution('hail').version)
-
-        mt.describe()
-        mt.write(self.output().path, stage_locally=True, overwrite=True)
+        return sites_mt.rows()
 
     def annotate_old_and_split_multi_hts(self, mt):
         """
@@ -144,11 +231,64 @@ class SeqrVCFToMTTask(HailMatrixTableTask):
         return True
 
 
+class SeqrVCFToSplitMTTask(SeqrVCFToMTTask):
+    """
+    Checkpoints the imported and split callset, so later steps and validation do not re-read the VCFs.
+    """
+    checkpoint_params = ('source_paths', 'genome_version')
+
+    def requires(self):
+        return HailMatrixTableTask.requires(self)
+
+    def output(self):
+        return GCSorLocalTarget(self.split_mt_path)
+
+    def complete(self):
+        return self.is_checkpoint_complete(self.split_mt_path, hl.read_matrix_table)
+
+    def run(self):
+        self.check_paths()
+        mt = self.annotate_old_and_split_multi_hts(self.import_vcf())
+        mt = mt.annotate_globals(**{CHECKPOINT_PARAMS_GLOBAL: self.get_checkpoint_params()})
+        mt.write(self.split_mt_path, stage_locally=True, overwrite=True)
+
+
+class SeqrVCFToSitesHTTask(SeqrVCFToMTTask):
+    """
+    Validates the split callset, then checkpoints the sites of the remapped and subsetted samples annotated with VEP
+    and the variant schema. Only variants that the subset has are annotated, so loading one project from a joint
+    callset does not run VEP on the whole callset.
+    """
+    schema_cls = SeqrVariantSchema
+    checkpoint_params = SeqrVCFToSplitMTTask.checkpoint_params + (
+        'vep_runner', 'vep_config_json_path', 'reference_ht_path', 'clinvar_ht_path', 'hgmd_ht_path',
+        'remap_path', 'subset_path', 'dont_validate', 'sample_type')
+
+    def requires(self):
+        return [self.clone_checkpoint_task(SeqrVCFToSplitMTTask)]
+
+    def output(self):
+        return GCSorLocalTarget(self.sites_ht_path)
+
+    def complete(self):
+        return self.is_checkpoint_complete(self.sites_ht_path, hl.read_table)
+
+    def run(self):
+        self.check_paths()
+        mt = self.read_split_mt()
+        if not self.dont_validate:
+            self.validate_mt(mt, self.genome_version, self.sample_type)
+        sites_ht = self.annotate_sites(self.read_subset_mt(mt), self.schema_cls)
+        sites_ht = sites_ht.annotate_globals(**{CHECKPOINT_PARAMS_GLOBAL: self.get_checkpoint_params()})
+        sites_ht.write(self.sites_ht_path, stage_locally=True, overwrite=True)
+
+
 class SeqrMTToESTask(HailElasticSearchTask):
     source_paths = luigi.Parameter(default="[]", description='Path or list of paths of VCFs to be loaded.')
     dest_path = luigi.Parameter(description='Path to write the matrix table.')
     genome_version = luigi.Parameter(description='Reference Genome Version (37 or 38)')
     vep_runner = luigi.ChoiceParameter(choices=['VEP', 'DUMMY'], default='VEP', description='Choice of which vep runner to annotate vep.')
+    vep_cache_path = luigi.OptionalParameter(default=None, description='Path of a persistent VEP cache.')
 
     reference_ht_path = luigi.Parameter(default=None, description='Path to the Hail table storing the reference variants.')
     clinvar_ht_path = luigi.Parameter(default=None, description='Path to the Hail table storing the clinvar variants.')
@@ -167,6 +307,10 @@ class SeqrMTToESTask(HailElasticSearchTask):
         super().__init__(*args, **kwargs)
 
         self.completed_marker_path = os.path.join(self.dest_path, '_EXPORTED_TO_ES')
+        # Records the partitions already exported, so a failed export can be resumed
+        self.export_manifest_path = os.path.join(self.dest_path, '_EXPORTED_TO_ES_MANIFEST.json')
+        # Throughput and timing metrics for the export
+        self.export_metrics_path = os.path.join(self.dest_path, '_EXPORTED_TO_ES_METRICS.json')
 
     def requires(self):
         return [SeqrVCFToMTTask(
@@ -174,6 +318,7 @@ class SeqrMTToESTask(HailElasticSearchTask):
             dest_path=self.dest_path,
             genome_version=self.genome_version,
             vep_runner=self.vep_runner,
+            vep_cache_path=self.vep_cache_path,
             reference_ht_path=self.reference_ht_path,
             clinvar_ht_path=self.clinvar_ht_path,
             hgmd_ht_path=self.hgmd_ht_path,
@@ -198,13 +343,20 @@ class SeqrMTToESTask(HailElasticSearchTask):
     def run(self):
         mt = self.import_mt()
         row_table = SeqrVariantsAndGenotypesSchema.elasticsearch_row(mt)
-        self.export_table_to_elasticsearch(row_table, self._mt_num_shards(mt))
+        # The row size is measured once, to choose both the number of shards and the bulk request settings.
+        row_bytes = self._es.get_table_row_bytes(row_table)
+        self.export_table_to_elasticsearch(row_table, self._get_num_shards(mt, row_table, row_bytes),
+                                           self.export_manifest_path, row_bytes=row_bytes)
+
+        # The task is not complete until the index has moved off the loading nodes. When loading behind an alias this
+        # already ran before the alias swap.
+        if not self.es_use_index_alias:
+            self.cleanup()
+        self.write_export_metrics(self.export_metrics_path)
 
         with hl.hadoop_open(self.completed_marker_path, "w") as f:
             f.write(".")
 
-        self.cleanup()
-
 
 if __name__ == '__main__':
     # If run does not succeed, exit with 1 status code.
@@ -20,7 +20,7 @@ class SeqrVCFToVariantMTTask(seqr_loading.SeqrVCFToMTTask):
 
     def run(self):
         # We only want to use the Variant Schema.
-        self.read_vcf_write_mt(schema_cls=SeqrVariantSchema)
+        self.read_vcf_write_mt(genotypes_schema_cls=None)
 
 
 class SeqrVCFToGenotypesMTTask(HailMatrixTableTask):
@@ -61,9 +61,12 @@ class SeqrMTToESOptimizedTask(HailElasticSearchTask):
         row_ht = genotypes_mt.rows().join(variants_mt.rows())
 
         row_ht = SeqrVariantsAndGenotypesSchema.elasticsearch_row(row_ht)
-        self.export_table_to_elasticsearch(row_ht, self._mt_num_shards(genotypes_mt))
+        row_bytes = self._es.get_table_row_bytes(row_ht)
+        self.export_table_to_elasticsearch(row_ht, self._get_num_shards(genotypes_mt, row_ht, row_bytes),
+                                           row_bytes=row_bytes)
 
-        self.cleanup()
+        if not self.es_use_index_alias:
+            self.cleanup()
 
 
 if __name__ == '__main__':
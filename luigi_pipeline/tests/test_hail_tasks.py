@@ -7,6 +7,7 @@ import luigi
 from elasticsearch.client.indices import IndicesClient
 from lib.hail_tasks import HailMatrixTableTask, HailElasticSearchTask, MatrixTableSampleSetError
 from lib.global_config import GlobalConfig
+from lib.hail_vep_runners import HailVEPCacheRunner, HailVEPDummyRunner
 
 TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
 
@@ -147,6 +148,72 @@ class TestHailTasks(unittest.TestCase):
             HailMatrixTableTask.subset_samples_and_variants(mt, self._create_temp_sample_subset_file(mt, 1, True))
             self.assertEqual(e.missing_samples, ['wrong_sample'])
 
+    def test_run_vep_cache(self):
+        # Only variants missing from the cache are sent to VEP, and new annotations are merged back into it
+        vep_cache_path = os.path.join(self.test_dir, 'vep_cache')
+        mt = hl.split_multi_hts(hl.import_vcf(TEST_DATA_MT_1KG))
+        first_mt = mt.filter_rows(mt.locus.position % 2 == 0)
+
+        with patch.object(HailVEPDummyRunner, 'run', autospec=True, side_effect=HailVEPDummyRunner.run) as mock_run:
+            vep_mt = HailMatrixTableTask.run_vep(first_mt, '37', 'DUMMY', vep_cache_path=vep_cache_path)
+            self.assertEqual(vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))),
+                             first_mt.count_rows())
+
+            vep_mt = HailMatrixTableTask.run_vep(mt, '37', 'DUMMY', vep_cache_path=vep_cache_path)
+            self.assertEqual(vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))), mt.count_rows())
+            self.assertEqual(mock_run.call_args[0][1].count_rows(), mt.count_rows() - first_mt.count_rows())
+
+            HailMatrixTableTask.run_vep(mt, '37', 'DUMMY', vep_cache_path=vep_cache_path)
+            self.assertEqual(mock_run.call_count, 2)
+
+        version_path = HailVEPCacheRunner(HailVEPDummyRunner(), vep_cache_path).get_cache_version_path('37')
+        generation, cache_ht_path = HailVEPCacheRunner.get_latest_cache_generation(version_path)
+        self.assertEqual(generation, 1)
+        self.assertEqual(hl.read_table(cache_ht_path).count(), mt.count_rows())
+
+    def test_run_vep_cache_concurrent_writes(self):
+        # Runs that start from the same cache generation write the next generation to separate tables
+        vep_cache_path = os.path.join(self.test_dir, 'vep_cache')
+        mt = hl.split_multi_hts(hl.import_vcf(TEST_DATA_MT_1KG))
+        first_mt = mt.filter_rows(mt.locus.position % 2 == 0)
+        second_mt = mt.filter_rows(mt.locus.position % 2 == 1)
+
+        with patch.object(HailVEPCacheRunner, 'get_latest_cache_generation', return_value=(-1, None)):
+            HailMatrixTableTask.run_vep(first_mt, '37', 'DUMMY', vep_cache_path=vep_cache_path)
+            vep_mt = HailMatrixTableTask.run_vep(second_mt, '37', 'DUMMY', vep_cache_path=vep_cache_path)
+            self.assertEqual(vep_mt.aggregate_rows(hl.agg.count_where(hl.is_defined(vep_mt.vep))),
+                             second_mt.count_rows())
+
+        version_path = HailVEPCacheRunner(HailVEPDummyRunner(), vep_cache_path).get_cache_version_path('37')
+        cache_ht_paths = sorted(file_info['path'] for file_info in hl.hadoop_ls(version_path))
+        self.assertEqual(len(cache_ht_paths), 2)
+        generation, cache_ht_path = HailVEPCacheRunner.get_latest_cache_generation(version_path)
+        self.assertEqual(generation, 0)
+        self.assertEqual(os.path.basename(cache_ht_path), os.path.basename(cache_ht_paths[-1].rstrip('/')))
+
+    def test_run_vep_cache_retention(self):
+        # Each new generation holds all earlier annotations, so only the last keep_generations are kept
+        vep_cache_path = os.path.join(self.test_dir, 'vep_cache')
+        mt = hl.split_multi_hts(hl.import_vcf(TEST_DATA_MT_1KG))
+        for i in range(4):
+            HailMatrixTableTask.run_vep(mt.filter_rows(mt.locus.position % 4 <= i), '37', 'DUMMY',
+                                        vep_cache_path=vep_cache_path)
+
+        version_path = HailVEPCacheRunner(HailVEPDummyRunner(), vep_cache_path).get_cache_version_path('37')
+        generations = sorted(HailVEPCacheRunner.list_cache_generations(version_path))
+        self.assertListEqual([generation for generation, _ in generations], [2, 3])
+        generation, cache_ht_path = HailVEPCacheRunner.get_latest_cache_generation(version_path)
+        self.assertEqual(generation, 3)
+        self.assertEqual(hl.read_table(cache_ht_path).count(), mt.count_rows())
+
+        # a table left by a failed write of an old generation is deleted too
+        os.makedirs(os.path.join(version_path, '00001_0123456789ab.ht'))
+        runner = HailVEPCacheRunner(HailVEPDummyRunner(), vep_cache_path, keep_generations=1)
+        deleted_paths = runner.prune_cache_generations(version_path, generation)
+        self.assertListEqual([os.path.basename(path) for path in deleted_paths],
+                             ['00001_0123456789ab.ht', generations[0][1]])
+        self.assertListEqual(HailVEPCacheRunner.list_cache_generations(version_path), [generations[1]])
+
     @patch.object(IndicesClient, 'put_settings',)
     def test_route_index_to_temp_es_cluster_true(self, mock_es_client_class):
         index = 'idx'
@@ -1,20 +1,143 @@
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch
 
-from seqr_loading import SeqrVCFToMTTask, SeqrValidationError
+import hail as hl
+import luigi
+
+from lib.hail_vep_runners import HailVEPDummyRunner
+from lib.model.seqr_mt_schema import SeqrVariantsAndGenotypesSchema
+from seqr_loading import SeqrVCFToMTTask, SeqrVCFToSitesHTTask, SeqrVCFToSplitMTTask, SeqrValidationError
 from tests.data.sample_vep import VEP_DATA, DERIVED_DATA
 
 TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
 
 
+# Reference data fields joined by SeqrVariantSchema
+REFERENCE_DATA_FIELDS = [
+    'cadd', 'dbnsfp', 'eigen', 'exac', 'g1k', 'geno2mp', 'gnomad_exome_coverage', 'gnomad_exomes',
+    'gnomad_genome_coverage', 'gnomad_genomes', 'mpc', 'primate_ai', 'splice_ai', 'topmed',
+]
+
+
 class TestSeqrLoadingTasks(unittest.TestCase):
 
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _create_reference_data(self):
+        # Small reference data and clinvar tables with the fields used by SeqrVariantSchema
+        rows = hl.split_multi_hts(hl.import_vcf(TEST_DATA_MT_1KG)).rows()
+        reference_ht_path = os.path.join(self.test_dir, 'reference.ht')
+        rows.select(**{field: hl.struct(score=rows.locus.position) for field in REFERENCE_DATA_FIELDS}).write(
+            reference_ht_path)
+        clinvar_ht_path = os.path.join(self.test_dir, 'clinvar.ht')
+        rows.select(info=hl.struct(ALLELEID=rows.locus.position, CLNSIG=['Benign']), gold_stars=1).write(
+            clinvar_ht_path)
+        return reference_ht_path, clinvar_ht_path
+
+    def _seqr_vcf_to_mt_task(self, **kwargs):
+        reference_ht_path, clinvar_ht_path = self._create_reference_data()
+        return SeqrVCFToMTTask(**dict(dict(
+            source_paths=TEST_DATA_MT_1KG, dest_path=os.path.join(self.test_dir, 'test.mt'), genome_version='37',
+            reference_ht_path=reference_ht_path, clinvar_ht_path=clinvar_ht_path, sample_type='WES',
+            dont_validate=True, vep_runner='DUMMY'), **kwargs))
+
     def _sample_type_stats_return_value(self, nc_match_count, nc_total_count, nc_match, c_match_count, c_total_count, c_match):
         return {
             'noncoding': {'matched_count': nc_match_count, 'total_count': nc_total_count, 'match': nc_match},
             'coding': {'matched_count': c_match_count, 'total_count': c_total_count, 'match': c_match}
         }
 
+    def test_seqr_loading_checkpoint_tasks(self):
+        # The annotated MT requires the sites table, which requires the split MT, all written next to dest_path.
+        task = SeqrVCFToMTTask(source_paths=TEST_DATA_MT_1KG, dest_path='tests/output/test.mt', genome_version='37',
+                               reference_ht_path='ref.ht', clinvar_ht_path='clinvar.ht', sample_type='WES')
+        sites_task = task.requires()[0]
+        self.assertIsInstance(sites_task, SeqrVCFToSitesHTTask)
+        self.assertEqual(sites_task.output().path, 'tests/output/test_sites.ht')
+        self.assertEqual(sites_task.source_paths, [TEST_DATA_MT_1KG])
+
+        split_task = sites_task.requires()[0]
+        self.assertIsInstance(split_task, SeqrVCFToSplitMTTask)
+        self.assertEqual(split_task.output().path, 'tests/output/test_split.mt')
+        self.assertEqual([vcf_task.filename for vcf_task in split_task.requires()], [TEST_DATA_MT_1KG])
+
+    @patch.object(HailVEPDummyRunner, 'run', autospec=True)
+    def test_seqr_loading_sites_annotations(self, mock_run):
+        # Annotating the sites and joining them back gives the same rows as annotating the full MT
+        mock_run.side_effect = lambda runner, mt, genome_version, vep_config_json_path=None: mt.annotate_rows(
+            vep=HailVEPDummyRunner.MOCK_VEP_DATA).annotate_globals(gencodeVersion='19')
+        task = self._seqr_vcf_to_mt_task()
+        self.assertTrue(luigi.build([task], local_scheduler=True))
+        mt = hl.read_matrix_table(task.dest_path)
+
+        expected_mt = task.annotate_old_and_split_multi_hts(hl.import_vcf(TEST_DATA_MT_1KG))
+        expected_mt = HailVEPDummyRunner().run(expected_mt, '37')
+        expected_mt = SeqrVariantsAndGenotypesSchema(
+            expected_mt, ref_data=hl.read_table(task.reference_ht_path),
+            clinvar_data=hl.read_table(task.clinvar_ht_path),
+        ).annotate_all(overwrite=True).select_annotated_mt()
+
+        self.assertSetEqual(set(mt.row.dtype.fields), set(expected_mt.row.dtype.fields))
+        rows = {(row.locus, tuple(row.alleles)): row for row in mt.rows().collect()}
+        expected_rows = {(row.locus, tuple(row.alleles)): row for row in expected_mt.rows().collect()}
+        self.assertEqual(rows.keys(), expected_rows.keys())
+        for key, expected_row in expected_rows.items():
+            for field in expected_row:
+                self.assertEqual(rows[key][field], expected_row[field], f'{key} {field}')
+
+        mt_globals = hl.eval(mt.globals)
+        self.assertEqual(mt_globals.gencodeVersion, hl.eval(expected_mt.globals.gencodeVersion))
+        self.assertEqual(mt_globals.sourceFilePath, TEST_DATA_MT_1KG)
+
+    def test_seqr_loading_stale_checkpoints(self):
+        # Checkpoints written for other inputs are not reused
+        task = self._seqr_vcf_to_mt_task()
+        self.assertTrue(luigi.build([task], local_scheduler=True))
+        split_task = task.clone_checkpoint_task(SeqrVCFToSplitMTTask)
+        sites_task = task.clone_checkpoint_task(SeqrVCFToSitesHTTask)
+        self.assertTrue(split_task.complete())
+        self.assertTrue(sites_task.complete())
+
+        vep_task = task.clone(vep_runner='VEP', source_paths=task.param_kwargs['source_paths'])
+        self.assertTrue(vep_task.clone_checkpoint_task(SeqrVCFToSplitMTTask).complete())
+        self.assertFalse(vep_task.clone_checkpoint_task(SeqrVCFToSitesHTTask).complete())
+
+        # a checkpoint that was not validated is not reused by a load that validates
+        validate_task = task.clone(dont_validate=False, source_paths=task.param_kwargs['source_paths'])
+        self.assertTrue(validate_task.clone_checkpoint_task(SeqrVCFToSplitMTTask).complete())
+        self.assertFalse(validate_task.clone_checkpoint_task(SeqrVCFToSitesHTTask).complete())
+
+        grch38_task = task.clone(genome_version='38', source_paths=task.param_kwargs['source_paths'])
+        self.assertFalse(grch38_task.clone_checkpoint_task(SeqrVCFToSplitMTTask).complete())
+        self.assertFalse(grch38_task.clone_checkpoint_task(SeqrVCFToSitesHTTask).complete())
+
+    def test_seqr_loading_subset_sites(self):
+        # Only the variants of the subset samples are annotated, and the split MT is reused for another subset
+        task = self._seqr_vcf_to_mt_task()
+        self.assertTrue(luigi.build([task.clone_checkpoint_task(SeqrVCFToSitesHTTask)], local_scheduler=True))
+
+        subset_path = os.path.join(self.test_dir, 'subset.tsv')
+        hl.import_vcf(TEST_DATA_MT_1KG).cols().head(1).export(subset_path, header=True)
+        subset_task = task.clone(subset_path=subset_path, dest_path=task.dest_path,
+                                 source_paths=task.param_kwargs['source_paths'])
+        self.assertTrue(subset_task.clone_checkpoint_task(SeqrVCFToSplitMTTask).complete())
+        self.assertFalse(subset_task.clone_checkpoint_task(SeqrVCFToSitesHTTask).complete())
+        self.assertTrue(luigi.build([subset_task], local_scheduler=True))
+
+        mt = hl.read_matrix_table(subset_task.dest_path)
+        self.assertEqual(mt.count_cols(), 1)
+        self.assertEqual(mt.aggregate_rows(hl.agg.count_where(hl.is_missing(mt.vep))), 0)
+        num_sites = hl.read_table(subset_task.sites_ht_path).count()
+        self.assertEqual(num_sites, mt.count_rows())
+        self.assertLess(num_sites, hl.read_matrix_table(task.split_mt_path).count_rows())
+
     @patch('lib.hail_tasks.HailMatrixTableTask.sample_type_stats')
     def test_seqr_loading_validate_match_none(self, mock_sample_type_stats):
         # Matched none should fail.
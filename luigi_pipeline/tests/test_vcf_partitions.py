@@ -0,0 +1,43 @@
+import gzip
+import struct
+import unittest
+
+from lib.vcf_partitions import get_vcf_num_samples, get_tabix_num_records, get_vcf_min_partitions, TABIX_PSEUDO_BIN
+
+TEST_DATA_MT_1KG = 'tests/data/1kg_30variants.vcf.bgz'
+
+
+def _tabix_index(contig_num_records):
+    # Builds a minimal .tbi with one regular bin and, when the count is known, the pseudo-bin per contig.
+    names = b''.join(contig.encode() + b'\0' for contig in contig_num_records)
+    data = b'TBI\x01' + struct.pack('<8i', len(contig_num_records), 2, 1, 2, 0, ord('#'), 0, len(names)) + names
+    for num_records in contig_num_records.values():
+        bins = struct.pack('<Ii', 4681, 1) + struct.pack('<QQ', 0, 100)
+        if num_records is not None:
+            bins += struct.pack('<Ii', TABIX_PSEUDO_BIN, 2) + struct.pack('<QQQQ', 0, 100, num_records, 0)
+        data += struct.pack('<i', 2 if num_records is not None else 1) + bins
+        data += struct.pack('<i', 1) + struct.pack('<Q', 0)
+    return gzip.compress(data)
+
+
+class TestVcfPartitions(unittest.TestCase):
+
+    def test_get_vcf_num_samples(self):
+        with gzip.open(TEST_DATA_MT_1KG, 'rt') as f:
+            self.assertEqual(get_vcf_num_samples(f), 16)
+        self.assertEqual(get_vcf_num_samples(['##fileformat=VCFv4.2\n', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']), 0)
+        self.assertRaises(ValueError, get_vcf_num_samples, ['##fileformat=VCFv4.2\n', '1\t100\n'])
+
+    def test_get_tabix_num_records(self):
+        self.assertEqual(get_tabix_num_records(_tabix_index({'1': 1000, '2': 500, 'X': 20})), 1520)
+        self.assertIsNone(get_tabix_num_records(_tabix_index({'1': 1000, '2': None})))
+
+    def test_get_vcf_min_partitions(self):
+        # a small WES callset gets a few partitions
+        self.assertEqual(get_vcf_min_partitions(2 * 1024 ** 3, 1000), 32)
+        self.assertEqual(get_vcf_min_partitions(2 * 1024 ** 3, 1000, num_records=500000), 32)
+        # a 100k sample WGS callset is split by genotype count
+        self.assertEqual(get_vcf_min_partitions(5 * 1024 ** 4, 100000, num_records=30 * 10 ** 6), 150000)
+        self.assertEqual(get_vcf_min_partitions(10 * 1024 ** 2, 16, num_cores=8), 8)
+        self.assertEqual(get_vcf_min_partitions(2 * 1024 ** 3, 1000, num_cores=24), 48)
+        self.assertEqual(get_vcf_min_partitions(0, 16), 1)
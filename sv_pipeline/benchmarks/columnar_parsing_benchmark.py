@@ -0,0 +1,54 @@
+"""Compares the rows/sec of the row-based and columnar SV BED readers.
+
+Run from the repository root:
+
+    python -m sv_pipeline.benchmarks.columnar_parsing_benchmark --num-rows 100000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sv_pipeline.load_data import subset_and_group_svs, pd
+from sv_pipeline.load_data_tests import BED_HEADER, BED_ROWS
+
+
+def write_benchmark_bed(file_path, num_rows, samples_per_sv=50):
+    with open(file_path, 'w') as f:
+        f.write(BED_HEADER)
+        for i in range(num_rows):
+            row = BED_ROWS[i % len(BED_ROWS)]
+            f.write(row.replace('suffix_', 'suffix_{}_'.format(i // samples_per_sv)).replace(
+                'SAMPLE-', 'SAMPLE-{}-'.format(i % samples_per_sv)))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--num-rows', type=int, default=100000)
+    args = p.parse_args()
+
+    if pd is None:
+        p.error('pandas is required for the columnar reader')
+
+    test_dir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(test_dir, 'benchmark.bed')
+        write_benchmark_bed(file_path, args.num_rows)
+
+        parsed_svs = []
+        for columnar in [False, True]:
+            start = time.time()
+            parsed_svs.append(subset_and_group_svs(
+                file_path, None, sample_remap=None, sample_type='WES', ignore_missing_samples=False, columnar=columnar))
+            print('{}: {:.0f} rows/sec'.format(
+                'columnar' if columnar else 'row-based', args.num_rows / (time.time() - start)))
+
+        if parsed_svs[1] != parsed_svs[0]:
+            raise ValueError('Columnar reader parsed different SVs than the row-based reader')
+    finally:
+        shutil.rmtree(test_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,35 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import io
 import logging
 import os
 import re
 import subprocess
+import sys
+import tempfile
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from datetime import datetime
-from elasticsearch import helpers as es_helpers
+from functools import lru_cache
+from itertools import groupby, islice
 from getpass import getpass
 from tqdm import tqdm
 
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
+
 from hail_scripts.shared.elasticsearch_client_v7 import ElasticsearchClient
-from hail_scripts.shared.elasticsearch_utils import ELASTICSEARCH_INDEX
+from hail_scripts.shared.elasticsearch_utils import (
+    ELASTICSEARCH_INDEX, ROUTING_SCHEMES, ROUTING_XPOS_BIN_SIZE, get_routing_key, get_routing_meta,
+    get_routing_partition_size,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -54,6 +71,14 @@ SAMPLE_TYPE_MAP = {
     'WGS': 'Genome',
 }
 
+SAMPLE_ID_REGEXES = {
+    sample_type: re.compile(r'(\d+)_(?P<sample_id>.+)_v\d_{}_GCP'.format(sample_type_name))
+    for sample_type, sample_type_name in SAMPLE_TYPE_MAP.items()
+}
+
+SAMPLE_ID_CACHE_SIZE = 100000
+
+
 def _get_seqr_sample_id(raw_sample_id, sample_type='WES'):
     """
     Extract the seqr sample ID from the raw dataset sample id
@@ -62,36 +87,173 @@ def _get_seqr_sample_id(raw_sample_id, sample_type='WES'):
     :param sample_type: sample type (WES/WGS)
     :return: seqr sample id
     """
-    if sample_type not in SAMPLE_TYPE_MAP:
+    if sample_type not in SAMPLE_ID_REGEXES:
         raise Exception('Unsupported sample type {}'.format(sample_type))
-    sample_id_regex = '(\d+)_(?P<sample_id>.+)_v\d_{sample_type}_GCP'.format(sample_type=SAMPLE_TYPE_MAP[sample_type])
-    return re.search(sample_id_regex, raw_sample_id).group('sample_id')
+    return SAMPLE_ID_REGEXES[sample_type].search(raw_sample_id).group('sample_id')
+
+
+class SampleIdResolver:
+    """
+    Resolves raw dataset sample ids to seqr sample ids with any remapping applied, and checks them against the sample
+    subset. A sample id repeats for every one of its calls in a file, so results are memoized in a bounded cache keyed
+    by the raw sample id and each row only needs a single cache lookup
+    """
+
+    def __init__(self, sample_type, sample_remap=None, sample_subset=None, max_cache_size=SAMPLE_ID_CACHE_SIZE):
+        """
+        :param sample_type: sample type (WES/WGS)
+        :param sample_remap: optional mapping of raw sample ids to seqr sample ids
+        :param sample_subset: optional list of samples to subset to
+        :param max_cache_size: maximum number of raw sample ids to cache
+        """
+        if sample_type not in SAMPLE_ID_REGEXES:
+            raise Exception('Unsupported sample type {}'.format(sample_type))
+        self._sample_id_regex = SAMPLE_ID_REGEXES[sample_type]
+        self._sample_remap = sample_remap or {}
+        self._sample_subset = sample_subset
+        self.found_samples = set()
+        self.skipped_samples = set()
+        self.get_included_sample_id = lru_cache(maxsize=max_cache_size)(self._get_included_sample_id)
+        self._shard_cache_hits = 0
+        self._shard_cache_misses = 0
+
+    def _get_included_sample_id(self, raw_sample_id):
+        """
+        Get the seqr sample id for the given raw sample id, if it is in the sample subset
+
+        :param raw_sample_id: dataset sample id
+        :return: seqr sample id, or None if the sample is not in the subset
+        """
+        sample_id = self._sample_id_regex.search(raw_sample_id).group('sample_id')
+        sample_id = self._sample_remap.get(sample_id, sample_id)
+        if self._sample_subset is None or sample_id in self._sample_subset:
+            self.found_samples.add(sample_id)
+            return sample_id
+        self.skipped_samples.add(sample_id)
+        return None
+
+    @property
+    def cache_hits(self):
+        return self.get_included_sample_id.cache_info().hits + self._shard_cache_hits
+
+    @property
+    def cache_misses(self):
+        return self.get_included_sample_id.cache_info().misses + self._shard_cache_misses
+
+    def add_shard_results(self, found_samples, skipped_samples, cache_hits, cache_misses):
+        """
+        Add the results from a resolver used to parse a shard of the dataset in another process
+
+        :param found_samples: set of samples found in the shard
+        :param skipped_samples: set of samples skipped in the shard
+        :param cache_hits: number of sample id cache hits in the shard
+        :param cache_misses: number of sample id cache misses in the shard
+        :return: none
+        """
+        self.found_samples.update(found_samples)
+        self.skipped_samples.update(skipped_samples)
+        self._shard_cache_hits += cache_hits
+        self._shard_cache_misses += cache_misses
+
+    def validate_found_samples(self, ignore_missing_samples):
+        """
+        Validate that all samples in the subset were found in the dataset
+
+        :param ignore_missing_samples: whether or not to fail if samples in the subset have no raw data
+        :return: none
+        """
+        logger.info('Found {} sample ids ({} sample id cache hits, {} misses)'.format(
+            len(self.found_samples), self.cache_hits, self.cache_misses))
+        if self._sample_subset:
+            if len(self.found_samples) != len(self._sample_subset):
+                missed_samples = self._sample_subset - self.found_samples
+                missing_sample_error = 'Missing the following {} samples:\n{}'.format(
+                    len(missed_samples), ', '.join(sorted(missed_samples))
+                )
+                if ignore_missing_samples:
+                    logger.info(missing_sample_error)
+                else:
+                    logger.info('Samples in callset but skipped:\n{}'.format(', '.join(sorted(self.skipped_samples))))
+                    raise Exception(missing_sample_error)
+
+
+def _format_unique_values(format_column):
+    """
+    Wrap a column formatter so each distinct value in the column is only formatted once. Raw values such as sample ids
+    and gene lists repeat many times in a BED file, so this avoids most of the formatting work
+
+    :param format_column: function to format a pandas Series of raw values
+    :return: wrapped function
+    """
+    def _format(col, **kwargs):
+        codes, uniques = pd.factorize(col)
+        formatted_uniques = np.empty(len(uniques), dtype=object)
+        formatted_uniques[:] = format_column(pd.Series(uniques), **kwargs).tolist()
+        return pd.Series(formatted_uniques[codes], index=col.index)
+    return _format
+
+
+@_format_unique_values
+def _map_bool_column(col):
+    mapped = col.map(BOOL_MAP)
+    if mapped.isna().any():
+        raise KeyError(col[mapped.isna()].iloc[0])
+    return mapped
+
+
+@_format_unique_values
+def _format_genes_column(genes):
+    gene_lists = genes.str.replace(r'\.[^,]*', '', regex=True).str.split(',')
+    no_genes = genes == 'None'
+    gene_lists[no_genes] = gene_lists[no_genes].map(lambda _: [])
+    return gene_lists
 
 
 COL_CONFIGS = {
-    CHR_COL: {'field_name': CHROM_FIELD, 'format': lambda val: val.lstrip('chr')},
-    SC_COL: {'field_name': SC_FIELD, 'format': int},
-    SF_COL: {'field_name': SF_FIELD, 'format': float},
-    VAR_NAME_COL: {'field_name': VARIANT_ID_FIELD, 'format': lambda val, call='any': '{}_{}'.format(val, call)},
+    CHR_COL: {
+        'field_name': CHROM_FIELD,
+        'format': lambda val: val.lstrip('chr'),
+        'format_column': _format_unique_values(lambda col: col.str.lstrip('chr')),
+    },
+    SC_COL: {'field_name': SC_FIELD, 'format': int, 'format_column': lambda col: col.astype('int64')},
+    SF_COL: {'field_name': SF_FIELD, 'format': float, 'format_column': lambda col: col.astype('float64')},
+    VAR_NAME_COL: {
+        'field_name': VARIANT_ID_FIELD,
+        'format': lambda val, call='any': '{}_{}'.format(val, call),
+        'format_column': lambda col, call='any': col + '_' + call,
+    },
     CALL_COL: {'field_name': CALL_FIELD},
-    START_COL: {'format': int},
-    END_COL: {'format': int},
-    QS_COL: {'field_name': QS_FIELD, 'format': int},
-    CN_COL: {'field_name': CN_FIELD, 'format': int},
-    NUM_EXON_COL: {'field_name': NUM_EXON_FIELD, 'format': lambda val: 0 if val == 'NA' else int(val)},
-    DEFRAGGED_COL: {'field_name': DEFRAGGED_FIELD, 'format': lambda val: BOOL_MAP[val]},
+    START_COL: {'format': int, 'format_column': lambda col: col.astype('int64')},
+    END_COL: {'format': int, 'format_column': lambda col: col.astype('int64')},
+    QS_COL: {'field_name': QS_FIELD, 'format': int, 'format_column': lambda col: col.astype('int64')},
+    CN_COL: {'field_name': CN_FIELD, 'format': int, 'format_column': lambda col: col.astype('int64')},
+    NUM_EXON_COL: {
+        'field_name': NUM_EXON_FIELD,
+        'format': lambda val: 0 if val == 'NA' else int(val),
+        'format_column': lambda col: col.mask(col == 'NA', '0').astype('int64'),
+    },
+    DEFRAGGED_COL: {
+        'field_name': DEFRAGGED_FIELD,
+        'format': lambda val: BOOL_MAP[val],
+        'format_column': _map_bool_column,
+    },
     IN_SILICO_COL: {
         'field_name': 'StrVCTVRE_score',
         'format': lambda val: None if val == 'not_exonic' else float(val),
+        'format_column': lambda col: col.mask(col == 'not_exonic').astype('float64').astype(object).where(
+            col != 'not_exonic', None),
         'allow_missing': True,
     },
     SAMPLE_COL: {
         'field_name': SAMPLE_ID_FIELD,
         'format': _get_seqr_sample_id,
+        'format_column': _format_unique_values(
+            lambda col, sample_type='WES': col.map(lambda val: _get_seqr_sample_id(val, sample_type))),
     },
     GENES_COL: {
         'field_name': GENES_FIELD,
         'format': lambda genes: [] if genes == 'None' else [gene.split('.')[0] for gene in genes.split(',')],
+        'format_column': _format_genes_column,
     },
 }
 
@@ -102,6 +264,100 @@ COLUMNS = CORE_COLUMNS + SAMPLE_COLUMNS + [SAMPLE_COL, VAR_NAME_COL]
 IN_SILICO_COLS = [VAR_NAME_COL, CALL_COL, IN_SILICO_COL]
 
 QS_BIN_SIZE = 10
+QS_MAX_BINNED = 1000
+CN_MAX_BINNED = 4
+
+# Sample list fields for each integer-coded CN/QS bin
+CN_BIN_FIELDS = ['samples_cn_{}'.format(cn) for cn in range(CN_MAX_BINNED)] + ['samples_cn_gte_{}'.format(CN_MAX_BINNED)]
+QS_BIN_FIELDS = [
+    'samples_qs_{}_to_{}'.format(qs_bin * QS_BIN_SIZE, (qs_bin + 1) * QS_BIN_SIZE)
+    for qs_bin in range(QS_MAX_BINNED // QS_BIN_SIZE + 1)
+] + ['samples_qs_gt_{}'.format(QS_MAX_BINNED)]
+
+
+class SvGenotype:
+    """
+    Compact record of a single sample's call for an SV. Large callsets have many millions of calls, so these are stored
+    with __slots__ and interned sample ids rather than as dicts, and only converted to the exported JSON shape by
+    format_sv
+    """
+    __slots__ = (START_COL, END_COL, QS_FIELD, CN_FIELD, NUM_EXON_FIELD, DEFRAGGED_FIELD, SAMPLE_ID_FIELD)
+
+    def __init__(self, start, end, qs, cn, num_exon, defragged, sample_id):
+        """
+        Arguments are in the same order as SAMPLE_COLUMNS followed by the sample id
+        """
+        self.start = start
+        self.end = end
+        self.qs = qs
+        self.cn = cn
+        self.num_exon = num_exon
+        self.defragged = defragged
+        self.sample_id = sys.intern(sample_id)
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        # Re-intern sample ids when genotypes are passed back from worker processes
+        self.__init__(*state)
+
+    def __eq__(self, other):
+        return isinstance(other, SvGenotype) and self.__getstate__() == other.__getstate__()
+
+    def __repr__(self):
+        return 'SvGenotype({})'.format(', '.join(
+            '{}={!r}'.format(field, getattr(self, field)) for field in self.__slots__))
+
+    @property
+    def cn_bin(self):
+        """Integer code for the CN bin, used as an index into CN_BIN_FIELDS"""
+        if self.cn < 0:
+            raise Exception('Invalid negative CN {} for sample {}'.format(self.cn, self.sample_id))
+        return min(self.cn, CN_MAX_BINNED)
+
+    @property
+    def qs_bin(self):
+        """Integer code for the QS bin, used as an index into QS_BIN_FIELDS"""
+        if self.qs < 0:
+            raise Exception('Invalid negative QS {} for sample {}'.format(self.qs, self.sample_id))
+        return len(QS_BIN_FIELDS) - 1 if self.qs > QS_MAX_BINNED else self.qs // QS_BIN_SIZE
+
+    @property
+    def bin_fields(self):
+        """Names of the CN and QS bin sample list fields the sample is added to"""
+        return CN_BIN_FIELDS[self.cn_bin], QS_BIN_FIELDS[self.qs_bin]
+
+    def get_exported_fields(self, sv_start, sv_end, sv_num_exon):
+        """
+        Get the names of the fields in the exported JSON shape of the genotype. Coordinates and exon counts are only
+        included if they differ from the merged SV
+
+        :param sv_start: start of the merged SV
+        :param sv_end: end of the merged SV
+        :param sv_num_exon: exon count of the merged SV
+        :return: list of genotype field names
+        """
+        fields = [QS_FIELD, CN_FIELD, DEFRAGGED_FIELD, SAMPLE_ID_FIELD]
+        if self.start != sv_start or self.end != sv_end:
+            fields += [START_COL, END_COL]
+        if self.num_exon != sv_num_exon:
+            fields.append(NUM_EXON_FIELD)
+        return fields
+
+    def to_dict(self, sv_start, sv_end, sv_num_exon):
+        """
+        Get the exported JSON shape of the genotype (see get_exported_fields)
+
+        :param sv_start: start of the merged SV
+        :param sv_end: end of the merged SV
+        :param sv_num_exon: exon count of the merged SV
+        :return: dictionary of genotype fields
+        """
+        return {field: getattr(self, field) for field in self.get_exported_fields(sv_start, sv_end, sv_num_exon)}
+
+
+COLUMNAR_CHUNK_SIZE = 100000
 
 CHROMOSOMES = [
     '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21',
@@ -183,7 +439,7 @@ def get_field_val(row, col, header_indices, format_kwargs=None):
     :return: parsed value
     """
     index = header_indices[col]
-    if index > len(row):
+    if index >= len(row):
         if COL_CONFIGS[col].get('allow_missing'):
             return None
         raise IndexError('Column "{}" is missing from row {}'.format(col, row))
@@ -219,6 +475,56 @@ def get_parsed_column_values(row, header_indices, columns):
     return {COL_CONFIGS[col].get('field_name', col): get_field_val(row, col, header_indices) for col in columns}
 
 
+def get_column_values(chunk, col, format_kwargs=None):
+    """
+    Get the parsed output values of a field for all rows in a chunk of raw data, formatting the whole column at once
+
+    :param chunk: pandas DataFrame of raw string values, with a column for each column identifier
+    :param col: string identifier for the column
+    :param format_kwargs: optional arguments to pass to the column formatter
+    :return: list of parsed values
+    """
+    vals = chunk[col]
+    missing = vals == ''
+    if missing.any():
+        if not COL_CONFIGS[col].get('allow_missing'):
+            raise IndexError('Column "{}" is missing from row {}'.format(col, chunk[missing].iloc[0].tolist()))
+        parsed_vals = pd.Series([None] * len(vals), index=vals.index, dtype=object)
+        if not missing.all():
+            parsed_vals[~missing] = get_column_values(chunk[~missing], col, format_kwargs)
+        return parsed_vals.tolist()
+
+    format_func = COL_CONFIGS[col].get('format_column')
+    if format_func:
+        vals = format_func(vals, **format_kwargs) if format_kwargs else format_func(vals)
+    return vals.tolist()
+
+
+def get_variant_ids(chunk):
+    """
+    Get the variant ids associated with all rows in the given chunk
+
+    :param chunk: pandas DataFrame of raw string values
+    :return: list of variant ids
+    """
+    return get_column_values(chunk, VAR_NAME_COL, format_kwargs={'call': chunk[CALL_COL]})
+
+
+def _new_parsed_sv(variant_id, core_values):
+    sv = core_values
+    sv[COL_CONFIGS[VAR_NAME_COL]['field_name']] = variant_id
+    sv[GENOTYPES_FIELD] = []
+    return sv
+
+
+def _add_sv_genotype(sv, genotype):
+    sv[GENOTYPES_FIELD].append(genotype)
+    # Use the largest coordinates for the merged SV
+    sv[START_COL] = min(sv.get(START_COL, float('inf')), genotype.start)
+    sv[END_COL] = max(sv.get(END_COL, 0), genotype.end)
+    sv[NUM_EXON_FIELD] = max(sv.get(NUM_EXON_FIELD, 0), genotype.num_exon)
+
+
 def parse_sv_row(row, parsed_svs_by_id, header_indices, sample_id):
     """
     Parse the given row into the desired SV output format and add it to the dictionary of parsed SVs
@@ -231,22 +537,108 @@ def parse_sv_row(row, parsed_svs_by_id, header_indices, sample_id):
     """
     variant_id = get_variant_id(row, header_indices)
     if variant_id not in parsed_svs_by_id:
-        parsed_svs_by_id[variant_id] = get_parsed_column_values(row, header_indices, CORE_COLUMNS)
-        parsed_svs_by_id[variant_id][COL_CONFIGS[VAR_NAME_COL]['field_name']] = variant_id
-        parsed_svs_by_id[variant_id][GENOTYPES_FIELD] = []
+        parsed_svs_by_id[variant_id] = _new_parsed_sv(
+            variant_id, get_parsed_column_values(row, header_indices, CORE_COLUMNS))
 
     sample_info = get_parsed_column_values(row, header_indices, SAMPLE_COLUMNS)
-    sample_info[SAMPLE_ID_FIELD] = sample_id
 
-    sv = parsed_svs_by_id[variant_id]
-    sv[GENOTYPES_FIELD].append(sample_info)
+    _add_sv_genotype(parsed_svs_by_id[variant_id], SvGenotype(sample_id=sample_id, **sample_info))
+
+
+def parse_sv_chunk(chunk, parsed_svs_by_id, sample_ids):
+    """
+    Parse all rows in the given chunk into the desired SV output format and add them to the dictionary of parsed SVs
+
+    :param chunk: pandas DataFrame of raw string values
+    :param parsed_svs_by_id: dictionary of parsed SVs keyed by ID
+    :param sample_ids: list of the sample ids for each row in the chunk
+    :return: none
+    """
+    variant_ids = get_variant_ids(chunk)
+
+    sample_fields = [COL_CONFIGS[col].get('field_name', col) for col in SAMPLE_COLUMNS]
+    sample_columns = {field: get_column_values(chunk, col) for field, col in zip(sample_fields, SAMPLE_COLUMNS)}
+
+    # Rows are grouped by variant using integer codes, numbered in order of each variant's first row in the chunk
+    variant_codes, unique_variant_ids = pd.factorize(np.array(variant_ids, dtype=object))
+    _, first_indices = np.unique(variant_codes, return_index=True)
+
     # Use the largest coordinates for the merged SV
-    sv[START_COL] = min(sv.get(START_COL, float('inf')), sample_info[START_COL])
-    sv[END_COL] = max(sv.get(END_COL, 0), sample_info[END_COL])
-    sv[NUM_EXON_FIELD] = max(sv.get(NUM_EXON_FIELD, 0), sample_info[NUM_EXON_FIELD])
+    coordinates = pd.DataFrame({
+        field: sample_columns[field] for field in [START_COL, END_COL, NUM_EXON_FIELD]
+    }).groupby(variant_codes).agg({START_COL: 'min', END_COL: 'max', NUM_EXON_FIELD: 'max'})
+
+    core_fields = [COL_CONFIGS[col].get('field_name', col) for col in CORE_COLUMNS]
+    core_columns = [get_column_values(chunk, col) for col in CORE_COLUMNS]
+    for variant_id, i, start, end, num_exon in zip(
+            unique_variant_ids.tolist(), first_indices.tolist(), coordinates[START_COL].tolist(),
+            coordinates[END_COL].tolist(), coordinates[NUM_EXON_FIELD].tolist()):
+        if variant_id not in parsed_svs_by_id:
+            parsed_svs_by_id[variant_id] = _new_parsed_sv(
+                variant_id, {field: vals[i] for field, vals in zip(core_fields, core_columns)})
+        sv = parsed_svs_by_id[variant_id]
+        sv[START_COL] = min(sv.get(START_COL, float('inf')), start)
+        sv[END_COL] = max(sv.get(END_COL, 0), end)
+        sv[NUM_EXON_FIELD] = max(sv.get(NUM_EXON_FIELD, 0), num_exon)
+
+    for variant_id, sample_vals in zip(variant_ids, zip(*sample_columns.values(), sample_ids)):
+        parsed_svs_by_id[variant_id][GENOTYPES_FIELD].append(SvGenotype(*sample_vals))
+
+
+def _get_header_indices(header, columns=None):
+    """
+    Get the column indices from a file header and validate that all expected columns are present
+
+    :param header: header line of the file
+    :param columns: expected columns in the input file
+    :return: mapping of column identifiers to row indices
+    """
+    header_indices = {col.lower(): i for i, col in enumerate(header.split())}
+    missing_cols = [col for col in columns or COLUMNS if col not in header_indices]
+    if missing_cols:
+        raise Exception('Missing expected columns: {}'.format(', '.join(missing_cols)))
+    return header_indices
+
+
+def _iter_lines_in_byte_range(file_path, byte_range):
+    """
+    Iterate over all lines in the given file which start within the given byte range
+
+    :param file_path: path to the file
+    :param byte_range: tuple of the start (inclusive) and end (exclusive) byte offsets
+    :return: generator of lines
+    """
+    start, end = byte_range
+    with open(file_path, 'rb') as f:
+        # Skip the end of any line that starts before the range, it is parsed with the previous range
+        f.seek(start - 1)
+        f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+
+def get_file_byte_ranges(file_path, num_ranges):
+    """
+    Split the rows of the given file into byte ranges of roughly equal size, which can be parsed independently
+
+    :param file_path: path to the file
+    :param num_ranges: number of byte ranges
+    :return: list of tuples of the start (inclusive) and end (exclusive) byte offsets, excluding the header line
+    """
+    with open(file_path, 'rb') as f:
+        header_size = len(f.readline())
+    file_size = os.path.getsize(file_path)
+    range_size = max((file_size - header_size) // num_ranges, 1)
+    starts = list(range(header_size, file_size, range_size))[:num_ranges] or [header_size]
+    return list(zip(starts, starts[1:] + [file_size]))
 
 
-def load_file(file_path, parse_row, out_file_path=None, columns=None):
+def load_file(file_path, parse_row, out_file_path=None, columns=None, byte_range=None):
     """
     Validate and parse the given file using the given parse functionality
 
@@ -254,6 +646,7 @@ def load_file(file_path, parse_row, out_file_path=None, columns=None):
     :param parse_row: function to run on each row in the file, returns a boolean indicator if parsing was successful
     :param out_file_path: optional path to a file to write out the raw rows that were successfully parsed
     :param columns: expected columns in the input file
+    :param byte_range: optional tuple of start and end byte offsets, to only parse rows in that part of the file
     :return: none
     """
     out_file = None
@@ -262,14 +655,12 @@ def load_file(file_path, parse_row, out_file_path=None, columns=None):
 
     with open(file_path, 'r') as f:
         header = f.readline()
-        header_indices = {col.lower(): i for i, col in enumerate(header.split())}
-        missing_cols = [col for col in columns or COLUMNS if col not in header_indices]
-        if missing_cols:
-            raise Exception('Missing expected columns: {}'.format(', '.join(missing_cols)))
+        header_indices = _get_header_indices(header, columns)
         if out_file:
             out_file.write(header)
 
-        for line in tqdm(f, unit=' rows'):
+        lines = f if byte_range is None else _iter_lines_in_byte_range(file_path, byte_range)
+        for line in tqdm(lines, unit=' rows'):
             row = line.split()
             parsed = parse_row(row, header_indices)
             if parsed and out_file:
@@ -279,7 +670,97 @@ def load_file(file_path, parse_row, out_file_path=None, columns=None):
         out_file.close()
 
 
-def subset_and_group_svs(input_dataset, sample_subset, sample_remap, sample_type, ignore_missing_samples, write_subsetted_bed=False):
+def load_file_columnar(file_path, parse_chunk, out_file_path=None, columns=None, byte_range=None,
+                       chunk_size=COLUMNAR_CHUNK_SIZE):
+    """
+    Validate and parse the given file in fixed-size chunks of rows, loaded into pandas DataFrames so each column can be
+    formatted at once instead of value by value
+
+    :param file_path: path to the file for parsing
+    :param parse_chunk: function to run on each chunk DataFrame, returns a list of boolean indicators for whether each
+        row was parsed successfully
+    :param out_file_path: optional path to a file to write out the raw rows that were successfully parsed
+    :param columns: expected columns in the input file
+    :param byte_range: optional tuple of start and end byte offsets, to only parse rows in that part of the file
+    :param chunk_size: number of rows to parse at once
+    :return: none
+    """
+    if pd is None:
+        raise Exception('pandas must be installed to use columnar parsing')
+
+    out_file = None
+    if out_file_path:
+        out_file = open(out_file_path, 'w')
+
+    with open(file_path, 'r') as f:
+        header = f.readline()
+        _get_header_indices(header, columns)
+        header_cols = [col.lower() for col in header.split()]
+        if out_file:
+            out_file.write(header)
+
+        lines_iter = f if byte_range is None else _iter_lines_in_byte_range(file_path, byte_range)
+        with tqdm(unit=' rows') as progress:
+            lines = list(islice(lines_iter, chunk_size))
+            while lines:
+                chunk = pd.read_csv(
+                    io.StringIO(''.join(lines)), sep=r'\s+', header=None, names=header_cols, dtype=str,
+                    na_filter=False, skip_blank_lines=False,
+                )
+                parsed = parse_chunk(chunk)
+                if parsed and out_file:
+                    out_file.writelines(line for line, is_parsed in zip(lines, parsed) if is_parsed)
+                progress.update(len(lines))
+                lines = list(islice(lines_iter, chunk_size))
+
+    if out_file:
+        out_file.close()
+
+
+def _get_subsetted_bed_path(input_dataset):
+    file_name = 'subset_{}'.format(os.path.basename(input_dataset))
+    return os.path.join(os.path.dirname(input_dataset), file_name)
+
+
+def _parse_sv_file(input_dataset, sample_id_resolver, out_file_path=None, columnar=False, byte_range=None):
+    """
+    Parses raw SV calls from the input file into the desired SV output format for samples included by the resolver
+
+    :param input_dataset: file path for the raw SV calls
+    :param sample_id_resolver: SampleIdResolver for the dataset
+    :param out_file_path: optional path to a file to write out the rows for the included samples
+    :param columnar: whether to parse the file in chunks of columns using pandas instead of row by row
+    :param byte_range: optional tuple of start and end byte offsets, to only parse rows in that part of the file
+    :return: dictionary of parsed SVs keyed by ID
+    """
+    parsed_svs_by_name = {}
+
+    def _parse_row(row, header_indices):
+        sample_id = sample_id_resolver.get_included_sample_id(row[header_indices[SAMPLE_COL]])
+        if sample_id is not None:
+            parse_sv_row(row, parsed_svs_by_name, header_indices, sample_id)
+            return True
+        return False
+
+    def _parse_chunk(chunk):
+        raw_sample_id_codes, raw_sample_ids = pd.factorize(chunk[SAMPLE_COL])
+        sample_ids = np.array(
+            [sample_id_resolver.get_included_sample_id(raw_sample_id) for raw_sample_id in raw_sample_ids], dtype=object,
+        )[raw_sample_id_codes]
+        parsed = pd.notnull(sample_ids)
+        parse_sv_chunk(chunk[parsed], parsed_svs_by_name, sample_ids[parsed].tolist())
+        return parsed.tolist()
+
+    if columnar:
+        load_file_columnar(input_dataset, _parse_chunk, out_file_path=out_file_path, byte_range=byte_range)
+    else:
+        load_file(input_dataset, _parse_row, out_file_path=out_file_path, byte_range=byte_range)
+
+    return parsed_svs_by_name
+
+
+def subset_and_group_svs(input_dataset, sample_subset, sample_remap, sample_type, ignore_missing_samples, write_subsetted_bed=False,
+                         columnar=False):
     """
     Parses raw SV calls from the input file into the desired SV output format for samples in the given subset
 
@@ -289,52 +770,218 @@ def subset_and_group_svs(input_dataset, sample_subset, sample_remap, sample_type
     :param sample_type: sample type (WES/WGS)
     :param ignore_missing_samples: whether or not to fail if samples in the subset have no raw data
     :param write_subsetted_bed: whether or not to write a bed file with only the subsetted samples
+    :param columnar: whether to parse the file in chunks of columns using pandas instead of row by row
     :return: dictionary of parsed SVs keyed by ID
     """
-    parsed_svs_by_name = {}
-    found_samples = set()
-    skipped_samples = set()
-    out_file_path = None
-    if write_subsetted_bed:
-        file_name = 'subset_{}'.format(os.path.basename(input_dataset))
-        out_file_path = os.path.join(os.path.dirname(input_dataset), file_name)
+    sample_id_resolver = SampleIdResolver(sample_type, sample_remap, sample_subset)
+    out_file_path = _get_subsetted_bed_path(input_dataset) if write_subsetted_bed else None
 
-    def _parse_row(row, header_indices):
-        sample_id = get_field_val(row, SAMPLE_COL, header_indices, format_kwargs={'sample_type': sample_type})
-        if sample_remap and sample_id in sample_remap:
-            sample_id = sample_remap[sample_id]
-        if sample_subset is None or sample_id in sample_subset:
-            parse_sv_row(row, parsed_svs_by_name, header_indices, sample_id)
-            found_samples.add(sample_id)
-            return True
-        else:
-            skipped_samples.add(sample_id)
-            return False
-
-    load_file(input_dataset, _parse_row, out_file_path=out_file_path)
-
-    logger.info('Found {} sample ids'.format(len(found_samples)))
-    if sample_subset:
-        if len(found_samples) != len(sample_subset):
-            missed_samples = sample_subset - found_samples
-            missing_sample_error = 'Missing the following {} samples:\n{}'.format(
-                len(missed_samples), ', '.join(sorted(missed_samples))
-            )
-            if ignore_missing_samples:
-                logger.info(missing_sample_error)
-            else:
-                logger.info('Samples in callset but skipped:\n{}'.format(', '.join(sorted(skipped_samples))))
-                raise Exception(missing_sample_error)
+    parsed_svs_by_name = _parse_sv_file(input_dataset, sample_id_resolver, out_file_path=out_file_path, columnar=columnar)
+
+    sample_id_resolver.validate_found_samples(ignore_missing_samples)
+
+    return parsed_svs_by_name
+
+
+def _parse_sv_shard(input_dataset, byte_range, sample_subset, sample_remap, sample_type, write_subsetted_bed, columnar):
+    """
+    Parses one shard of SV calls in a worker process
+
+    :return: tuple of the parsed SVs keyed by ID, and the found samples, skipped samples, sample id cache hits and
+        sample id cache misses for the shard
+    """
+    sample_id_resolver = SampleIdResolver(sample_type, sample_remap, sample_subset)
+    out_file_path = _get_subsetted_bed_path(input_dataset) if write_subsetted_bed else None
+    parsed_svs_by_name = _parse_sv_file(
+        input_dataset, sample_id_resolver, out_file_path=out_file_path, columnar=columnar, byte_range=byte_range)
+    return (
+        parsed_svs_by_name, sample_id_resolver.found_samples, sample_id_resolver.skipped_samples,
+        sample_id_resolver.cache_hits, sample_id_resolver.cache_misses,
+    )
+
+
+def merge_parsed_svs(parsed_svs_by_id, shard_parsed_svs_by_id):
+    """
+    Merge SVs parsed from a shard of the raw SV calls into the dictionary of parsed SVs, using the same rules for
+    combining calls as parse_sv_row
+
+    :param parsed_svs_by_id: dictionary of parsed SVs keyed by ID
+    :param shard_parsed_svs_by_id: dictionary of SVs parsed from a shard keyed by ID
+    :return: none
+    """
+    for variant_id, shard_sv in shard_parsed_svs_by_id.items():
+        if variant_id not in parsed_svs_by_id:
+            parsed_svs_by_id[variant_id] = shard_sv
+            continue
+
+        sv = parsed_svs_by_id[variant_id]
+        sv[GENOTYPES_FIELD] += shard_sv[GENOTYPES_FIELD]
+        # Use the largest coordinates for the merged SV
+        sv[START_COL] = min(sv[START_COL], shard_sv[START_COL])
+        sv[END_COL] = max(sv[END_COL], shard_sv[END_COL])
+        sv[NUM_EXON_FIELD] = max(sv[NUM_EXON_FIELD], shard_sv[NUM_EXON_FIELD])
+
+
+def subset_and_group_sv_files(input_datasets, sample_subset, sample_remap, sample_type, ignore_missing_samples,
+                              num_workers=1, write_subsetted_bed=False, columnar=False):
+    """
+    Parses raw SV calls from multiple input files into the desired SV output format for samples in the given subset.
+    Files are parsed in parallel in a pool of worker processes. If there are fewer files than workers, files are split
+    into byte range shards so all workers are used. Shards are merged in file order, so the output is identical to
+    parsing the files sequentially
+
+    :param input_datasets: file paths for the raw SV calls
+    :param sample_subset: optional list of samples to subset to
+    :param sample_remap: optional mapping of raw sample ids to seqr sample ids
+    :param sample_type: sample type (WES/WGS)
+    :param ignore_missing_samples: whether or not to fail if samples in the subset have no raw data
+    :param num_workers: number of worker processes
+    :param write_subsetted_bed: whether or not to write a bed file per input file with only the subsetted samples
+    :param columnar: whether to parse the files in chunks of columns using pandas instead of row by row
+    :return: dictionary of parsed SVs keyed by ID
+    """
+    if len(input_datasets) == 1 and num_workers == 1:
+        return subset_and_group_svs(
+            input_datasets[0], sample_subset, sample_remap, sample_type, ignore_missing_samples,
+            write_subsetted_bed=write_subsetted_bed, columnar=columnar,
+        )
+
+    # Each subsetted bed file is written by a single worker, so files are not split into shards
+    shards_per_file = 1 if write_subsetted_bed else -(-num_workers // len(input_datasets))
+    shards = [
+        (input_dataset, byte_range) for input_dataset in input_datasets
+        for byte_range in get_file_byte_ranges(input_dataset, shards_per_file)
+    ]
+    logger.info('Parsing {} files in {} shards with {} workers'.format(len(input_datasets), len(shards), num_workers))
+
+    parsed_svs_by_name = {}
+    sample_id_resolver = SampleIdResolver(sample_type, sample_remap, sample_subset)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                _parse_sv_shard, input_dataset, byte_range, sample_subset, sample_remap, sample_type,
+                write_subsetted_bed, columnar,
+            ) for input_dataset, byte_range in shards
+        ]
+        for i, future in enumerate(futures):
+            shard_parsed_svs_by_name, found_samples, skipped_samples, cache_hits, cache_misses = future.result()
+            futures[i] = None
+            merge_parsed_svs(parsed_svs_by_name, shard_parsed_svs_by_name)
+            sample_id_resolver.add_shard_results(found_samples, skipped_samples, cache_hits, cache_misses)
+
+    sample_id_resolver.validate_found_samples(ignore_missing_samples)
 
     return parsed_svs_by_name
 
 
-def add_in_silico(svs_by_variant_id, file_path):
+def sort_by_variant_name(input_dataset, tmp_dir=None):
+    """
+    Externally sort the raw SV calls by variant name and call, keeping the header as the first line. Uses the system
+    sort so the file never needs to fit in memory. The sorted calls are written to a new temporary file, which the
+    caller should remove once it is done with it
+
+    :param input_dataset: file path for the raw SV calls
+    :param tmp_dir: directory for the sorted file and the temporary files of the sort. Defaults to the system
+        temporary directory
+    :return: file path for the sorted SV calls
+    """
+    with open(input_dataset, 'r') as f:
+        header = f.readline()
+    header_indices = _get_header_indices(header)
+    sort_command = ['sort', '-s'] + [
+        '-k{col},{col}'.format(col=header_indices[col] + 1) for col in [VAR_NAME_COL, CALL_COL]
+    ]
+    if tmp_dir:
+        sort_command += ['-T', tmp_dir]
+
+    fd, out_file_path = tempfile.mkstemp(prefix='sorted_', suffix='_{}'.format(os.path.basename(input_dataset)),
+                                         dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'w') as out_file:
+            out_file.write(header)
+            out_file.flush()
+            tail = subprocess.Popen(['tail', '-n', '+2', input_dataset], stdout=subprocess.PIPE)
+            sort_returncode = subprocess.call(
+                sort_command, stdin=tail.stdout, stdout=out_file, env=dict(os.environ, LC_ALL='C'))
+            tail.stdout.close()
+            if tail.wait() != 0 or sort_returncode != 0:
+                raise Exception('Unable to sort {}'.format(input_dataset))
+    except Exception:
+        os.remove(out_file_path)
+        raise
+    return out_file_path
+
+
+def stream_grouped_svs(input_dataset, sample_subset, sample_remap, sample_type, ignore_missing_samples,
+                       in_silico_by_variant_id=None, write_subsetted_bed=False, subsetted_bed_path=None):
+    """
+    Lazily parses raw SV calls from the input file into formatted SVs for samples in the given subset. The input must
+    be sorted by variant name and call (see sort_by_variant_name), so only a single SV is held in memory at a time
+
+    :param input_dataset: file path for the raw SV calls, sorted by variant name
+    :param sample_subset: optional list of samples to subset to
+    :param sample_remap: optional mapping of raw sample ids to seqr sample ids
+    :param sample_type: sample type (WES/WGS)
+    :param ignore_missing_samples: whether or not to fail if samples in the subset have no raw data
+    :param in_silico_by_variant_id: optional mapping of variant ID to parsed in silico predictors
+    :param write_subsetted_bed: whether or not to write a bed file with only the subsetted samples
+    :param subsetted_bed_path: path to write the subsetted bed file to. Defaults to next to the input file
+    :return: generator of formatted SVs. Files are closed when the generator is exhausted or closed, so callers that
+        may stop early should close it (e.g. with contextlib.closing)
+    """
+    sample_id_resolver = SampleIdResolver(sample_type, sample_remap, sample_subset)
+    out_file = open(subsetted_bed_path or _get_subsetted_bed_path(input_dataset), 'w') if write_subsetted_bed else None
+
+    def _iter_sample_rows(f, header_indices):
+        for line in tqdm(f, unit=' rows'):
+            row = line.split()
+            sample_id = sample_id_resolver.get_included_sample_id(row[header_indices[SAMPLE_COL]])
+            if sample_id is not None:
+                if out_file:
+                    out_file.write(line)
+                sort_key = (row[header_indices[VAR_NAME_COL]], row[header_indices[CALL_COL]])
+                yield sort_key, row, sample_id
+
+    try:
+        with open(input_dataset, 'r') as f:
+            header = f.readline()
+            header_indices = _get_header_indices(header)
+            if out_file:
+                out_file.write(header)
+
+            prev_sort_key = None
+            for sort_key, sample_rows in groupby(
+                    _iter_sample_rows(f, header_indices), key=lambda sample_row: sample_row[0]):
+                if prev_sort_key is not None and sort_key < prev_sort_key:
+                    raise Exception('Input file is not sorted by variant name: found {} after {}'.format(
+                        ' '.join(sort_key), ' '.join(prev_sort_key)))
+                prev_sort_key = sort_key
+
+                parsed_svs_by_id = {}
+                for _, row, sample_id in sample_rows:
+                    parse_sv_row(row, parsed_svs_by_id, header_indices, sample_id)
+                if len(parsed_svs_by_id) > 1:
+                    raise Exception('Multiple variant IDs found for variant name {}'.format(' '.join(sort_key)))
+
+                sv = next(iter(parsed_svs_by_id.values()))
+                if in_silico_by_variant_id is not None:
+                    sv.update(in_silico_by_variant_id.get(sv[VARIANT_ID_FIELD], {}))
+                format_sv(sv)
+                yield sv
+    finally:
+        if out_file:
+            out_file.close()
+
+    sample_id_resolver.validate_found_samples(ignore_missing_samples)
+
+
+def add_in_silico(svs_by_variant_id, file_path, columnar=False):
     """
     Add in silico predictors to the parsed SVs
 
     :param svs_by_variant_id: dictionary of parsed SVs keyed by ID
     :param file_path: path to the file with in silico predictors
+    :param columnar: whether to parse the file in chunks of columns using pandas instead of row by row
     :return: none
     """
     def _parse_row(row, header_indices):
@@ -342,7 +989,33 @@ def add_in_silico(svs_by_variant_id, file_path):
         if variant_id in svs_by_variant_id:
             svs_by_variant_id[variant_id].update(get_parsed_column_values(row, header_indices, [IN_SILICO_COL]))
 
+    def _parse_chunk(chunk):
+        field_name = COL_CONFIGS[IN_SILICO_COL]['field_name']
+        for variant_id, val in zip(get_variant_ids(chunk), get_column_values(chunk, IN_SILICO_COL)):
+            if variant_id in svs_by_variant_id:
+                svs_by_variant_id[variant_id][field_name] = val
+
+    if columnar:
+        load_file_columnar(file_path, _parse_chunk, columns=IN_SILICO_COLS)
+    else:
+        load_file(file_path, _parse_row, columns=IN_SILICO_COLS)
+
+
+def load_in_silico(file_path):
+    """
+    Load the in silico predictors for all variants, for use when the parsed SVs are streamed
+
+    :param file_path: path to the file with in silico predictors
+    :return: dictionary of parsed in silico predictors keyed by variant ID
+    """
+    in_silico_by_variant_id = {}
+
+    def _parse_row(row, header_indices):
+        in_silico_by_variant_id[get_variant_id(row, header_indices)] = get_parsed_column_values(
+            row, header_indices, [IN_SILICO_COL])
+
     load_file(file_path, _parse_row, columns=IN_SILICO_COLS)
+    return in_silico_by_variant_id
 
 
 def format_sv(sv):
@@ -361,49 +1034,161 @@ def format_sv(sv):
     sv['xstart'] = sv['xpos']
     sv['xstop'] = CHROM_TO_XPOS_OFFSET[sv[CHROM_FIELD]] + sv[END_COL]
     sv['samples'] = []
+    genotypes = []
     for genotype in sv[GENOTYPES_FIELD]:
-        sample_id = genotype['sample_id']
+        sample_id = genotype.sample_id
         sv['samples'].append(sample_id)
 
-        cn_key = 'samples_cn_{}'.format(genotype['cn']) if genotype['cn'] < 4 else 'samples_cn_gte_4'
-        if cn_key not in sv:
-            sv[cn_key] = []
-        sv[cn_key].append(sample_id)
+        for bin_key in genotype.bin_fields:
+            if bin_key not in sv:
+                sv[bin_key] = []
+            sv[bin_key].append(sample_id)
 
-        if genotype[QS_FIELD] > 1000:
-            qs_key = 'samples_qs_gt_1000'
-        else:
-            qs_bin = genotype[QS_FIELD] // QS_BIN_SIZE
-            qs_key = 'samples_qs_{}_to_{}'.format(qs_bin * 10, (qs_bin + 1) * 10)
-        if qs_key not in sv:
-            sv[qs_key] = []
-        sv[qs_key].append(sample_id)
+        genotypes.append(genotype.to_dict(sv[START_COL], sv[END_COL], sv[NUM_EXON_FIELD]))
+    sv[GENOTYPES_FIELD] = genotypes
 
-        if sv[START_COL] == genotype[START_COL] and sv[END_COL] == genotype[END_COL]:
-            genotype.pop(START_COL)
-            genotype.pop(END_COL)
 
-        if sv[NUM_EXON_FIELD] == genotype[NUM_EXON_FIELD]:
-            genotype.pop(NUM_EXON_FIELD)
+def iter_formatted_svs(parsed_svs):
+    """
+    Format SVs for export without modifying the parsed SVs, so the callset only needs to be held in memory in its
+    compact parsed form and the exported docs can be generated more than once
+
+    :param parsed_svs: iterable of parsed SVs
+    :return: generator of formatted SVs
+    """
+    for sv in parsed_svs:
+        formatted_sv = dict(sv)
+        format_sv(formatted_sv)
+        yield formatted_sv
 
 
-def get_es_schema(all_fields, nested_fields):
+def _get_es_type(key, field_types):
     """
-    Get the elasticsearch schema based on the given fields
+    Get the elasticsearch type for a field from the set of python types observed for it
 
-    :param all_fields: mapping of top-level field names to example value
-    :param nested_fields: mapping of nested field name to example value dictionary
+    :param key: field name
+    :param field_types: set of python types observed for the field
+    :return: elasticsearch type
+    """
+    if key in ES_FIELD_TYPE_MAP:
+        return ES_FIELD_TYPE_MAP[key]
+    if field_types == {int, float}:
+        return ES_TYPE_MAP[float]
+    return ES_TYPE_MAP[next(iter(field_types))]
+
+
+def get_es_schema(all_field_types, nested_field_types):
+    """
+    Get the elasticsearch schema based on the given field types
+
+    :param all_field_types: mapping of top-level field names to the set of python types observed for the field
+    :param nested_field_types: mapping of nested field name to a mapping of field names to observed python types
     :return: elasticsearch schema
     """
     schema = {
-        key: {'type': ES_FIELD_TYPE_MAP.get(key) or ES_TYPE_MAP[type(val[0]) if isinstance(val, list) else type(val)]}
-        for key, val in all_fields.items() if key not in nested_fields
+        key: {'type': _get_es_type(key, field_types)}
+        for key, field_types in all_field_types.items() if key not in nested_field_types
     }
-    for key, val_dict in nested_fields.items():
-        schema[key] = {'type': 'nested', 'properties': get_es_schema(val_dict, {})}
+    for key, field_types_dict in nested_field_types.items():
+        schema[key] = {'type': 'nested', 'properties': get_es_schema(field_types_dict, {})}
     return schema
 
 
+class EsSchemaAccumulator:
+    """
+    Incrementally collects the types of all fields in formatted SVs, so the elasticsearch schema can be computed while
+    the SVs are parsed instead of from the full set of rows
+    """
+
+    def __init__(self, nested_fields=(GENOTYPES_FIELD, TRANSCRIPTS_FIELD)):
+        self.all_field_types = {}
+        self.nested_field_types = {field: {} for field in nested_fields}
+
+    def add_row(self, row):
+        """
+        Add the field types from the given formatted SV
+
+        :param row: formatted SV
+        :return: none
+        """
+        for key, val in row.items():
+            if key in self.nested_field_types:
+                field_types = self.nested_field_types[key]
+                for nested_row in val or []:
+                    for nested_key, nested_val in nested_row.items():
+                        if nested_val is not None:
+                            self._add_type(field_types, nested_key, nested_val)
+            elif val:
+                self._add_type(self.all_field_types, key, val)
+
+    def add_parsed_sv(self, sv):
+        """
+        Add the field types that format_sv exports for the given parsed SV, without formatting its genotypes. This lets
+        the schema be computed from parsed SVs held in memory, so they are only formatted once, for the export
+
+        :param sv: parsed SV
+        :return: none
+        """
+        genotypes = sv[GENOTYPES_FIELD]
+        formatted_sv = dict(sv)
+        formatted_sv[GENOTYPES_FIELD] = []
+        format_sv(formatted_sv)
+        self.add_row(formatted_sv)
+        if not genotypes:
+            return
+
+        sample_list_fields = {'samples'}
+        genotype_field_types = self.nested_field_types.get(GENOTYPES_FIELD)
+        for genotype in genotypes:
+            sample_list_fields.update(genotype.bin_fields)
+            if genotype_field_types is None:
+                continue
+            for field in genotype.get_exported_fields(sv[START_COL], sv[END_COL], sv[NUM_EXON_FIELD]):
+                val = getattr(genotype, field)
+                if val is not None:
+                    self._add_type(genotype_field_types, field, val)
+        for field in sample_list_fields:
+            self._add_type(self.all_field_types, field, genotypes[0].sample_id)
+
+    @staticmethod
+    def _add_type(field_types, key, val):
+        val_type = type(val[0]) if isinstance(val, list) else type(val)
+        if key not in field_types:
+            field_types[key] = {val_type}
+        elif val_type not in field_types[key]:
+            field_types[key].add(val_type)
+
+    def get_type_conflicts(self):
+        """
+        Get all fields which have been observed with more than one type
+
+        :return: mapping of field name to sorted list of observed type names. Nested fields are named "parent.field"
+        """
+        conflicts = {key: types for key, types in self.all_field_types.items() if len(types) > 1}
+        for nested_field, field_types in self.nested_field_types.items():
+            conflicts.update({
+                '{}.{}'.format(nested_field, key): types for key, types in field_types.items() if len(types) > 1
+            })
+        return {key: sorted(val_type.__name__ for val_type in types) for key, types in conflicts.items()}
+
+    def get_es_schema(self):
+        """
+        Get the elasticsearch schema for all rows added so far. Fields with both integer and float values are mapped as
+        floats, any other type conflicts raise an error
+
+        :return: elasticsearch schema
+        """
+        conflicts = self.get_type_conflicts()
+        if conflicts:
+            conflict_summary = ', '.join('{} ({})'.format(key, '/'.join(types)) for key, types in sorted(conflicts.items()))
+            unresolved_conflicts = [key for key, types in conflicts.items() if types != ['float', 'int']]
+            if unresolved_conflicts:
+                raise Exception('Found conflicting types for fields: {}'.format(conflict_summary))
+            logger.warning('Found conflicting types for fields, exporting as floats: {}'.format(conflict_summary))
+
+        return get_es_schema(self.all_field_types, self.nested_field_types)
+
+
 def get_es_index_name(project, meta):
     """
     Get the name for the output ES index
@@ -420,57 +1205,88 @@ def get_es_index_name(project, meta):
     ).lower()
 
 
-def export_to_elasticsearch(es_host, es_port, rows, index_name, meta, es_password, num_shards=6):
+def get_es_schema_for_rows(rows):
+    """
+    Get the elasticsearch schema for the given rows. Rows are only iterated once, so this can be run over a generator
+
+    :param rows: formatted SV rows
+    :return: elasticsearch schema
+    """
+    schema_accumulator = EsSchemaAccumulator()
+    for row in rows:
+        schema_accumulator.add_row(row)
+    return schema_accumulator.get_es_schema()
+
+
+def export_to_elasticsearch(es_host, es_port, rows, index_name, meta, es_password, num_shards=6, elasticsearch_schema=None,
+                            num_workers=4, chunk_size=1000, max_chunk_bytes=10 * 1024 * 1024, compress_level=None,
+                            routing_scheme=None, routing_bin_size=ROUTING_XPOS_BIN_SIZE):
     """
     Export SV data to elasticsearch
 
     :param es_host: elasticsearch server host
     :param es_port: elasticsearch server port
-    :param rows: parsed SV rows to export
+    :param rows: parsed SV rows to export, can be a generator if elasticsearch_schema is provided
     :param index_name: elasticsearch index name
     :param meta: index metadata
     :param num_shards: number of shards for the index
+    :param elasticsearch_schema: optional precomputed elasticsearch schema. If not provided it is computed from the rows
+    :param num_workers: number of bulk requests to send in parallel
+    :param chunk_size: maximum number of documents per bulk request
+    :param max_chunk_bytes: maximum size in bytes of a bulk request body
+    :param compress_level: optional gzip compression level for bulk requests. The repeated sample lists in SV docs
+        compress very well, so this greatly reduces the bytes sent to elasticsearch
+    :param routing_scheme: optional scheme to route SVs to shards by their xpos, so region queries can be routed to a
+        subset of shards. The scheme is recorded in the index _meta
+    :param routing_bin_size: size in base pairs of the xpos bins when routing by xpos bin
     :return: none
     """
-    es_client = ElasticsearchClient(host=es_host, port=es_port, es_password=es_password)
+    # keep a connection open for each export worker
+    es_client = ElasticsearchClient.get_shared_client(
+        host=es_host, port=es_port, es_password=es_password, pool_size=max(num_workers, 10))
 
-    all_fields = {}
-    nested_fields = {GENOTYPES_FIELD: {}, TRANSCRIPTS_FIELD: {}}
-    for row in rows:
-        all_fields.update({k: v for k, v in row.items() if v})
-        for col, val in nested_fields.items():
-            if row[col]:
-                val.update(row[col][0])
-    elasticsearch_schema = get_es_schema(all_fields, nested_fields)
+    if elasticsearch_schema is None:
+        elasticsearch_schema = get_es_schema_for_rows(rows)
 
     if es_client.es.indices.exists(index=index_name):
         logger.info('Deleting existing index')
         es_client.es.indices.delete(index=index_name)
 
+    if routing_scheme:
+        meta = dict(meta, routing=get_routing_meta(routing_scheme, bin_size=routing_bin_size))
+
     logger.info('Setting up index')
-    es_client.create_index(index_name, elasticsearch_schema, num_shards=num_shards, _meta=meta)
+    es_client.create_index(index_name, elasticsearch_schema, num_shards=num_shards, _meta=meta,
+                           routing_partition_size=get_routing_partition_size(routing_scheme, num_shards))
 
     es_client.route_index_to_temp_es_cluster(index_name)
 
-    es_actions = [{
-        '_index': index_name,
-        '_op_type': ELASTICSEARCH_INDEX,
-        '_id': row[VARIANT_ID_FIELD],
-        '_source': row,
-    } for row in rows]
+    def _get_action(row):
+        action = {
+            '_index': index_name,
+            '_op_type': ELASTICSEARCH_INDEX,
+            '_id': row[VARIANT_ID_FIELD],
+            '_source': row,
+        }
+        if routing_scheme:
+            action['_routing'] = get_routing_key(row['xpos'], routing_scheme, bin_size=routing_bin_size)
+        return action
 
-    logger.info('Starting bulk export')
-    success_count, _ = es_helpers.bulk(es_client.es, es_actions, chunk_size=1000)
-    logger.info('Successfully created {} records'.format(success_count))
+    es_actions = (_get_action(row) for row in rows)
 
-    es_client.es.indices.forcemerge(index=index_name)
+    logger.info('Starting bulk export')
+    with es_client.bulk_load(index_name):
+        success_count, _, _ = es_client.bulk_export(
+            es_actions, num_workers=num_workers, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+            compress_level=compress_level)
+        logger.info('Successfully created {} records'.format(success_count))
 
     es_client.route_index_off_temp_es_cluster(index_name)
 
 
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument('input_dataset', help='input BAM file')
+    p.add_argument('input_dataset', nargs='+', help='input BED file(s) or glob(s)')
     p.add_argument('--skip-sample-subset', action='store_true')
     p.add_argument('--write-subsetted-bed', action='store_true')
     p.add_argument('--ignore-missing-samples', action='store_true')
@@ -480,9 +1296,27 @@ def main():
     p.add_argument('--es-host', default='localhost')
     p.add_argument('--es-port', default='9200')
     p.add_argument('--num-shards', default=6)
+    p.add_argument('--streaming', action='store_true', help='Stream SVs to elasticsearch instead of loading the full '
+                   'callset into memory. Requires the input to be sorted by variant name, or --sort-input')
+    p.add_argument('--sort-input', action='store_true', help='Externally sort the input by variant name before streaming')
+    p.add_argument('--sort-tmp-dir', help='Directory for the sorted copy of the input, which is removed once it is '
+                   'loaded. Defaults to the system temporary directory')
+    p.add_argument('--columnar', action='store_true', help='Parse the BED file in chunks of columns using pandas')
+    p.add_argument('--num-parse-workers', type=int, default=1, help='Number of processes to parse BED files with')
+    p.add_argument('--num-export-workers', type=int, default=4, help='Number of bulk requests to send to ES in parallel')
+    p.add_argument('--routing-scheme', choices=sorted(ROUTING_SCHEMES), help='Route SVs to shards by contig or by xpos '
+                   'bin instead of by ID, so region queries only need to search a few shards')
+    p.add_argument('--export-chunk-size', type=int, default=1000, help='Maximum number of docs per bulk request')
+    p.add_argument('--export-chunk-bytes', type=int, default=10 * 1024 * 1024, help='Maximum bytes per bulk request')
+    p.add_argument('--export-compress-level', type=int, choices=range(1, 10), metavar='[1-9]',
+                   help='Gzip bulk requests with this compression level')
 
     args = p.parse_args()
 
+    input_datasets = [
+        file_path for input_dataset in args.input_dataset for file_path in (sorted(glob.glob(input_dataset)) or [input_dataset])
+    ]
+
     es_password = os.environ.get('PIPELINE_ES_PASSWORD')
     if not es_password:
         es_password = getpass(prompt='Enter ES password: ')
@@ -497,35 +1331,94 @@ def main():
             message += ' (remapping {} samples)'.format(len(sample_remap))
         logger.info(message)
 
-    logger.info('Parsing BED file')
-    parsed_svs_by_name = subset_and_group_svs(
-        args.input_dataset,
+    meta = {
+      'genomeVersion': '38',
+      'sampleType': args.sample_type,
+      'datasetType': 'SV',
+      'sourceFilePath': ','.join(input_datasets),
+    }
+    index_name = get_es_index_name(args.project_guid, meta)
+    export_kwargs = {
+        'num_workers': args.num_export_workers,
+        'chunk_size': args.export_chunk_size,
+        'max_chunk_bytes': args.export_chunk_bytes,
+        'compress_level': args.export_compress_level,
+        'routing_scheme': args.routing_scheme,
+    }
+
+    if args.streaming:
+        if len(input_datasets) > 1:
+            raise Exception('Streaming mode only supports a single input file, found {}'.format(len(input_datasets)))
+        input_dataset = input_datasets[0]
+        sorted_input_dataset = None
+        if args.sort_input:
+            logger.info('Sorting BED file by variant name')
+            input_dataset = sorted_input_dataset = sort_by_variant_name(input_dataset, tmp_dir=args.sort_tmp_dir)
+
+        try:
+            in_silico_by_variant_id = None
+            if args.in_silico:
+                logger.info('Loading in silico predictors')
+                in_silico_by_variant_id = load_in_silico(args.in_silico)
+
+            def _stream_svs(write_subsetted_bed=False):
+                return stream_grouped_svs(
+                    input_dataset,
+                    sample_subset,
+                    sample_remap,
+                    args.sample_type,
+                    ignore_missing_samples=args.ignore_missing_samples,
+                    in_silico_by_variant_id=in_silico_by_variant_id,
+                    write_subsetted_bed=write_subsetted_bed,
+                    # next to the original input rather than the sorted copy, which is removed
+                    subsetted_bed_path=_get_subsetted_bed_path(input_datasets[0]),
+                )
+
+            # the streams are closed even if the export fails part way, before the sorted copy is removed
+            logger.info('Parsing BED file to compute ES schema')
+            with closing(_stream_svs(write_subsetted_bed=args.write_subsetted_bed)) as streamed_svs:
+                elasticsearch_schema = get_es_schema_for_rows(streamed_svs)
+
+            logger.info('Streaming docs to ES index {}'.format(index_name))
+            with closing(_stream_svs()) as streamed_svs:
+                export_to_elasticsearch(
+                    args.es_host, args.es_port, streamed_svs, index_name, meta, es_password,
+                    num_shards=args.num_shards, elasticsearch_schema=elasticsearch_schema, **export_kwargs
+                )
+
+            logger.info('DONE')
+            return
+        finally:
+            if sorted_input_dataset:
+                os.remove(sorted_input_dataset)
+
+    logger.info('Parsing {} BED file(s)'.format(len(input_datasets)))
+    parsed_svs_by_name = subset_and_group_sv_files(
+        input_datasets,
         sample_subset,
         sample_remap,
         args.sample_type,
         ignore_missing_samples=args.ignore_missing_samples,
-        write_subsetted_bed=args.write_subsetted_bed
+        num_workers=args.num_parse_workers,
+        write_subsetted_bed=args.write_subsetted_bed,
+        columnar=args.columnar,
     )
     logger.info('Found {} SVs'.format(len(parsed_svs_by_name)))
 
     logger.info('Adding in silico predictors')
-    add_in_silico(parsed_svs_by_name, args.in_silico)
+    add_in_silico(parsed_svs_by_name, args.in_silico, columnar=args.columnar)
 
     parsed_svs = parsed_svs_by_name.values()
 
-    logger.info('\nFormatting for ES export')
+    logger.info('\nComputing ES schema')
+    schema_accumulator = EsSchemaAccumulator()
     for sv in tqdm(parsed_svs, unit=' sv records'):
-        format_sv(sv)
+        schema_accumulator.add_parsed_sv(sv)
+    elasticsearch_schema = schema_accumulator.get_es_schema()
 
-    meta = {
-      'genomeVersion': '38',
-      'sampleType': args.sample_type,
-      'datasetType': 'SV',
-      'sourceFilePath': args.input_dataset,
-    }
-    index_name = get_es_index_name(args.project_guid, meta)
     logger.info('Exporting {} docs to ES index {}'.format(len(parsed_svs), index_name))
-    export_to_elasticsearch(args.es_host, args.es_port, parsed_svs, index_name, meta, es_password, num_shards=args.num_shards)
+    export_to_elasticsearch(args.es_host, args.es_port, iter_formatted_svs(parsed_svs), index_name, meta, es_password,
+                            num_shards=args.num_shards, elasticsearch_schema=elasticsearch_schema, **export_kwargs)
 
     logger.info('DONE')
 
@@ -0,0 +1,364 @@
+import os
+import pickle
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+from contextlib import closing
+from unittest import mock
+
+from hail_scripts.shared.elasticsearch_client_v7_tests import FakeElasticsearchServer
+from sv_pipeline.load_data import subset_and_group_svs, stream_grouped_svs, sort_by_variant_name, format_sv, \
+    get_es_schema_for_rows, export_to_elasticsearch, EsSchemaAccumulator, add_in_silico, pd, \
+    SampleIdResolver, subset_and_group_sv_files, get_file_byte_ranges, SvGenotype, iter_formatted_svs
+
+BED_HEADER = 'chr\tstart\tend\tname\tsample\tsvtype\tdefragmented\tvac\tvaf\tgenes_any_overlap_totalexons\t' \
+             'genes_any_overlap_ensemble_id\tqs\tcn\n'
+BED_ROWS = [
+    'chr1\t100\t1000\tsuffix_1\t1_SAMPLE-1_v1_Exome_GCP\tDEL\tFALSE\t2\t0.5\t2\tENSG00000186092.4\t33\t1\n',
+    'chr1\t150\t1200\tsuffix_1\t1_SAMPLE-2_v1_Exome_GCP\tDEL\tTRUE\t2\t0.5\t3\tENSG00000186092.4\t1200\t0\n',
+    'chr2\t500\t900\tsuffix_2\t1_SAMPLE-1_v1_Exome_GCP\tDUP\tFALSE\t1\t0.25\tNA\tNone\t80\t3\n',
+    'chrX\t10\t20\tsuffix_3\t1_SAMPLE-3_v1_Exome_GCP\tDUP\tFALSE\t1\t0.25\t1\tENSG00000227232.5,ENSG00000268903.1\t5\t5\n',
+    'chr1\t110\t1000\tsuffix_1\t1_SAMPLE-3_v1_Exome_GCP\tDEL\tFALSE\t2\t0.5\t2\tENSG00000186092.4\t50\t1\n',
+]
+IN_SILICO_ROWS = [
+    'name\tsvtype\tpath\n',
+    'suffix_1\tDEL\t0.75\n',
+    'suffix_2\tDUP\tnot_exonic\n',
+    'suffix_3\tDUP\n',
+    'suffix_4\tDUP\t0.1\n',
+]
+
+EXPECTED_SCHEMA = {
+    'contig': {'type': 'keyword'},
+    'end': {'type': 'integer'},
+    'geneIds': {'type': 'keyword'},
+    'genotypes': {'type': 'nested', 'properties': {
+        'cn': {'type': 'integer'},
+        'defragged': {'type': 'boolean'},
+        'end': {'type': 'integer'},
+        'num_exon': {'type': 'integer'},
+        'qs': {'type': 'integer'},
+        'sample_id': {'type': 'keyword'},
+        'start': {'type': 'integer'},
+    }},
+    'num_exon': {'type': 'integer'},
+    'pos': {'type': 'integer'},
+    'samples': {'type': 'keyword'},
+    'samples_cn_0': {'type': 'keyword'},
+    'samples_cn_1': {'type': 'keyword'},
+    'samples_cn_3': {'type': 'keyword'},
+    'samples_cn_gte_4': {'type': 'keyword'},
+    'samples_qs_0_to_10': {'type': 'keyword'},
+    'samples_qs_30_to_40': {'type': 'keyword'},
+    'samples_qs_50_to_60': {'type': 'keyword'},
+    'samples_qs_80_to_90': {'type': 'keyword'},
+    'samples_qs_gt_1000': {'type': 'keyword'},
+    'sc': {'type': 'integer'},
+    'sf': {'type': 'double'},
+    'sn': {'type': 'integer'},
+    'sortedTranscriptConsequences': {'type': 'nested', 'properties': {'gene_id': {'type': 'keyword'}}},
+    'start': {'type': 'integer'},
+    'svType': {'type': 'keyword'},
+    'transcriptConsequenceTerms': {'type': 'keyword'},
+    'variantId': {'type': 'keyword'},
+    'xpos': {'type': 'long'},
+    'xstart': {'type': 'long'},
+    'xstop': {'type': 'long'},
+}
+
+
+class LoadDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write_bed(self, rows, file_name='test.bed'):
+        file_path = os.path.join(self.test_dir, file_name)
+        with open(file_path, 'w') as f:
+            f.write(BED_HEADER)
+            f.writelines(rows)
+        return file_path
+
+    def _grouped_svs(self, file_path, sample_subset=None, **kwargs):
+        parsed_svs_by_name = subset_and_group_svs(
+            file_path, sample_subset, sample_remap=None, sample_type='WES', ignore_missing_samples=False, **kwargs)
+        for sv in parsed_svs_by_name.values():
+            format_sv(sv)
+        return parsed_svs_by_name
+
+    def test_stream_grouped_svs(self):
+        file_path = self._write_bed(BED_ROWS)
+        expected_svs = self._grouped_svs(file_path)
+
+        sorted_file_path = sort_by_variant_name(file_path, tmp_dir=self.test_dir)
+        streamed_svs = list(stream_grouped_svs(
+            sorted_file_path, sample_subset=None, sample_remap=None, sample_type='WES', ignore_missing_samples=False))
+
+        self.assertListEqual([sv['variantId'] for sv in streamed_svs], ['suffix_1_DEL', 'suffix_2_DUP', 'suffix_3_DUP'])
+        self.assertDictEqual({sv['variantId']: sv for sv in streamed_svs}, expected_svs)
+        self.assertDictEqual(get_es_schema_for_rows(streamed_svs), get_es_schema_for_rows(expected_svs.values()))
+
+        sample_subset = {'SAMPLE-1', 'SAMPLE-2'}
+        streamed_svs = list(stream_grouped_svs(
+            sorted_file_path, sample_subset, sample_remap=None, sample_type='WES', ignore_missing_samples=False))
+        self.assertDictEqual(
+            {sv['variantId']: sv for sv in streamed_svs}, self._grouped_svs(file_path, sample_subset=sample_subset))
+
+    def test_stream_grouped_svs_closes_files(self):
+        # files are closed when a caller stops reading early, not only once all SVs are streamed
+        sorted_file_path = sort_by_variant_name(self._write_bed(BED_ROWS), tmp_dir=self.test_dir)
+        opened_files = []
+
+        def _open(*args, **kwargs):
+            opened_files.append(open(*args, **kwargs))
+            return opened_files[-1]
+
+        with mock.patch('sv_pipeline.load_data.open', side_effect=_open, create=True):
+            with closing(stream_grouped_svs(
+                    sorted_file_path, sample_subset=None, sample_remap=None, sample_type='WES',
+                    ignore_missing_samples=False, write_subsetted_bed=True,
+                    subsetted_bed_path=os.path.join(self.test_dir, 'subset.bed'))) as streamed_svs:
+                self.assertEqual(next(streamed_svs)['variantId'], 'suffix_1_DEL')
+                self.assertEqual(len(opened_files), 2)
+                self.assertFalse(any(f.closed for f in opened_files))
+        self.assertTrue(all(f.closed for f in opened_files))
+
+    def test_sort_by_variant_name(self):
+        # file names are passed to the sort as arguments, not through a shell
+        input_dir = os.path.join(self.test_dir, 'input')
+        sort_dir = os.path.join(self.test_dir, 'sort')
+        os.makedirs(input_dir)
+        os.makedirs(sort_dir)
+        file_path = os.path.join(input_dir, "calls $(touch x) 'a'.bed")
+        with open(file_path, 'w') as f:
+            f.write(BED_HEADER)
+            f.writelines(BED_ROWS)
+
+        sorted_file_path = sort_by_variant_name(file_path, tmp_dir=sort_dir)
+        self.assertEqual(os.path.dirname(sorted_file_path), sort_dir)
+        self.assertListEqual(os.listdir(input_dir), [os.path.basename(file_path)])
+        with open(sorted_file_path) as f:
+            self.assertListEqual(f.readlines(), [BED_HEADER] + [BED_ROWS[i] for i in [0, 1, 4, 2, 3]])
+
+        with self.assertRaises(Exception):
+            sort_by_variant_name(os.path.join(input_dir, 'missing.bed'), tmp_dir=sort_dir)
+        self.assertListEqual(os.listdir(sort_dir), [os.path.basename(sorted_file_path)])
+
+    @unittest.skipIf(pd is None, 'pandas is not installed')
+    def test_columnar_parsing(self):
+        file_path = self._write_bed(BED_ROWS)
+        in_silico_path = os.path.join(self.test_dir, 'in_silico.tsv')
+        with open(in_silico_path, 'w') as f:
+            f.writelines(IN_SILICO_ROWS)
+
+        sample_remap = {'SAMPLE-2': 'REMAPPED-2'}
+        for sample_subset in [None, {'SAMPLE-1', 'REMAPPED-2'}]:
+            parsed_svs = [
+                subset_and_group_svs(
+                    file_path, sample_subset, sample_remap, sample_type='WES', ignore_missing_samples=False,
+                    columnar=columnar)
+                for columnar in [False, True]
+            ]
+            for svs, columnar in zip(parsed_svs, [False, True]):
+                add_in_silico(svs, in_silico_path, columnar=columnar)
+            self.assertDictEqual(parsed_svs[1], parsed_svs[0])
+        self.assertEqual(parsed_svs[1]['suffix_1_DEL']['genotypes'][1].sample_id, 'REMAPPED-2')
+        self.assertEqual(parsed_svs[1]['suffix_1_DEL']['StrVCTVRE_score'], 0.75)
+        self.assertIsNone(parsed_svs[1]['suffix_2_DUP']['StrVCTVRE_score'])
+
+        with self.assertRaises(KeyError):
+            self._grouped_svs(self._write_bed([BED_ROWS[0].replace('FALSE', 'NA')], 'invalid.bed'), columnar=True)
+
+    @unittest.skipIf(pd is None, 'pandas is not installed')
+    def test_columnar_parsing_matches_row_based(self):
+        num_rows = 5000
+        with open(os.path.join(self.test_dir, 'many_rows.bed'), 'w') as f:
+            f.write(BED_HEADER)
+            for i in range(num_rows):
+                row = BED_ROWS[i % len(BED_ROWS)]
+                f.write(row.replace('suffix_', 'suffix_{}_'.format(i // 50)).replace('SAMPLE-', 'SAMPLE-{}-'.format(i % 50)))
+
+        parsed_svs = []
+        for columnar in [False, True]:
+            parsed_svs.append(self._grouped_svs(f.name, columnar=columnar))
+        self.assertDictEqual(parsed_svs[1], parsed_svs[0])
+
+    def test_subset_and_group_sv_files(self):
+        file_path = self._write_bed(BED_ROWS)
+        expected_svs = subset_and_group_svs(
+            file_path, sample_subset=None, sample_remap=None, sample_type='WES', ignore_missing_samples=False)
+
+        byte_ranges = get_file_byte_ranges(file_path, 3)
+        self.assertEqual(len(byte_ranges), 3)
+        self.assertEqual(byte_ranges[0][0], len(BED_HEADER))
+        self.assertEqual(byte_ranges[-1][1], os.path.getsize(file_path))
+
+        split_file_paths = [self._write_bed(BED_ROWS[:2], 'test_1.bed'), self._write_bed(BED_ROWS[2:], 'test_2.bed')]
+        columnar_options = [False, True] if pd is not None else [False]
+        for file_paths, num_workers in [([file_path], 3), ([file_path], 10), (split_file_paths, 2), (split_file_paths, 4)]:
+            for columnar in columnar_options:
+                parsed_svs = subset_and_group_sv_files(
+                    file_paths, sample_subset=None, sample_remap=None, sample_type='WES', ignore_missing_samples=False,
+                    num_workers=num_workers, columnar=columnar)
+                self.assertDictEqual(parsed_svs, expected_svs)
+
+        parsed_svs = subset_and_group_sv_files(
+            split_file_paths, sample_subset={'SAMPLE-1', 'SAMPLE-3'}, sample_remap=None, sample_type='WES',
+            ignore_missing_samples=False, num_workers=2)
+        self.assertListEqual(
+            [gen.sample_id for gen in parsed_svs['suffix_1_DEL']['genotypes']], ['SAMPLE-1', 'SAMPLE-3'])
+        self.assertEqual(parsed_svs['suffix_1_DEL']['start'], 100)
+
+        with self.assertRaises(Exception) as ee:
+            subset_and_group_sv_files(
+                split_file_paths, sample_subset={'SAMPLE-1', 'SAMPLE-4'}, sample_remap=None, sample_type='WES',
+                ignore_missing_samples=False, num_workers=2)
+        self.assertEqual(str(ee.exception), 'Missing the following 1 samples:\nSAMPLE-4')
+
+    def test_sv_genotype(self):
+        genotype = SvGenotype(start=100, end=1000, qs=1200, cn=5, num_exon=2, defragged=False, sample_id='SAMPLE-1')
+        self.assertEqual(genotype.cn_bin, 4)
+        self.assertEqual(genotype.qs_bin, 101)
+
+        # negative values would otherwise index the last bin
+        with self.assertRaises(Exception) as ee:
+            SvGenotype(100, 1000, 33, -1, 2, False, 'SAMPLE-1').cn_bin
+        self.assertEqual(str(ee.exception), 'Invalid negative CN -1 for sample SAMPLE-1')
+        with self.assertRaises(Exception) as ee:
+            format_sv({'genotypes': [SvGenotype(100, 1000, -5, 1, 2, False, 'SAMPLE-1')], 'geneIds': [],
+                       'svType': 'DEL', 'sc': 1, 'sf': 0.5, 'contig': '1', 'start': 100, 'end': 1000, 'num_exon': 2})
+        self.assertEqual(str(ee.exception), 'Invalid negative QS -5 for sample SAMPLE-1')
+        self.assertDictEqual(genotype.to_dict(100, 1000, 2), {
+            'qs': 1200, 'cn': 5, 'defragged': False, 'sample_id': 'SAMPLE-1',
+        })
+        self.assertDictEqual(genotype.to_dict(50, 1000, 3), {
+            'qs': 1200, 'cn': 5, 'defragged': False, 'sample_id': 'SAMPLE-1', 'start': 100, 'end': 1000, 'num_exon': 2,
+        })
+
+        unpickled_genotype = pickle.loads(pickle.dumps(genotype))
+        self.assertEqual(unpickled_genotype, genotype)
+        self.assertIs(unpickled_genotype.sample_id, genotype.sample_id)
+
+        # Formatting for export does not modify the parsed SVs
+        parsed_svs = subset_and_group_svs(
+            self._write_bed(BED_ROWS), sample_subset=None, sample_remap=None, sample_type='WES',
+            ignore_missing_samples=False)
+        formatted_svs = list(iter_formatted_svs(parsed_svs.values()))
+        self.assertIsInstance(parsed_svs['suffix_1_DEL']['genotypes'][0], SvGenotype)
+        self.assertListEqual(formatted_svs, list(iter_formatted_svs(parsed_svs.values())))
+        self.assertDictEqual(get_es_schema_for_rows(formatted_svs), EXPECTED_SCHEMA)
+
+    def test_sv_genotype_memory(self):
+        num_genotypes = 100000
+
+        def _get_memory(create_genotype):
+            tracemalloc.start()
+            genotypes = [create_genotype(i) for i in range(num_genotypes)]
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            self.assertEqual(len(genotypes), num_genotypes)
+            return memory
+
+        dict_memory = _get_memory(lambda i: {
+            'start': 100 + i, 'end': 1000 + i, 'qs': i % 1000, 'cn': i % 5, 'num_exon': 2, 'defragged': False,
+            'sample_id': ''.join(['SAMPLE-', str(i % 100)]),
+        })
+        compact_memory = _get_memory(lambda i: SvGenotype(
+            100 + i, 1000 + i, i % 1000, i % 5, 2, False, ''.join(['SAMPLE-', str(i % 100)])))
+        self.assertLess(compact_memory * 2, dict_memory)
+
+    def test_sample_id_resolver(self):
+        sample_id_resolver = SampleIdResolver(
+            'WES', sample_remap={'SAMPLE-2': 'REMAPPED-2'}, sample_subset={'SAMPLE-1', 'REMAPPED-2'})
+        raw_sample_ids = ['1_SAMPLE-1_v1_Exome_GCP', '1_SAMPLE-2_v1_Exome_GCP', '2_SAMPLE-3_v2_Exome_GCP'] * 3
+        self.assertListEqual(
+            [sample_id_resolver.get_included_sample_id(raw_sample_id) for raw_sample_id in raw_sample_ids],
+            ['SAMPLE-1', 'REMAPPED-2', None] * 3,
+        )
+        self.assertEqual(sample_id_resolver.cache_hits, 6)
+        self.assertEqual(sample_id_resolver.cache_misses, 3)
+        self.assertSetEqual(sample_id_resolver.found_samples, {'SAMPLE-1', 'REMAPPED-2'})
+        self.assertSetEqual(sample_id_resolver.skipped_samples, {'SAMPLE-3'})
+
+        sample_id_resolver = SampleIdResolver('WGS', max_cache_size=1)
+        self.assertEqual(sample_id_resolver.get_included_sample_id('1_SAMPLE-1_v1_Genome_GCP'), 'SAMPLE-1')
+        self.assertEqual(sample_id_resolver.get_included_sample_id('1_SAMPLE-2_v1_Genome_GCP'), 'SAMPLE-2')
+        self.assertEqual(sample_id_resolver.get_included_sample_id('1_SAMPLE-1_v1_Genome_GCP'), 'SAMPLE-1')
+        self.assertEqual(sample_id_resolver.cache_misses, 3)
+        with self.assertRaises(AttributeError):
+            sample_id_resolver.get_included_sample_id('1_SAMPLE-1_v1_Exome_GCP')
+
+        with self.assertRaises(Exception) as ee:
+            SampleIdResolver('WXS')
+        self.assertEqual(str(ee.exception), 'Unsupported sample type WXS')
+
+    def test_es_schema_accumulator(self):
+        parsed_svs = self._grouped_svs(self._write_bed(BED_ROWS)).values()
+        self.assertDictEqual(get_es_schema_for_rows(parsed_svs), EXPECTED_SCHEMA)
+
+        # the schema is the same when computed from the parsed SVs without formatting them
+        parsed_svs = subset_and_group_svs(
+            self._write_bed(BED_ROWS), sample_subset=None, sample_remap=None, sample_type='WES',
+            ignore_missing_samples=False).values()
+        schema_accumulator = EsSchemaAccumulator()
+        for sv in parsed_svs:
+            schema_accumulator.add_parsed_sv(sv)
+        self.assertDictEqual(schema_accumulator.get_es_schema(), EXPECTED_SCHEMA)
+        self.assertIsInstance(next(iter(parsed_svs))['genotypes'][0], SvGenotype)
+
+        schema_accumulator = EsSchemaAccumulator()
+        schema_accumulator.add_row({'sc': 2, 'sf': 1, 'genotypes': [{'qs': 3}], 'sortedTranscriptConsequences': []})
+        schema_accumulator.add_row({'sc': 1, 'sf': 0.5, 'genotypes': [{'qs': 0.5}], 'sortedTranscriptConsequences': []})
+        self.assertDictEqual(schema_accumulator.get_type_conflicts(), {'sf': ['float', 'int'], 'genotypes.qs': ['float', 'int']})
+        self.assertDictEqual(schema_accumulator.get_es_schema(), {
+            'sc': {'type': 'integer'},
+            'sf': {'type': 'double'},
+            'genotypes': {'type': 'nested', 'properties': {'qs': {'type': 'double'}}},
+            'sortedTranscriptConsequences': {'type': 'nested', 'properties': {}},
+        })
+
+        schema_accumulator.add_row({'sc': 'NA', 'genotypes': [], 'sortedTranscriptConsequences': []})
+        with self.assertRaises(Exception) as ee:
+            schema_accumulator.get_es_schema()
+        self.assertEqual(
+            str(ee.exception),
+            'Found conflicting types for fields: genotypes.qs (float/int), sc (int/str), sf (float/int)')
+
+    def test_stream_grouped_svs_errors(self):
+        file_path = self._write_bed(BED_ROWS)
+        with self.assertRaises(Exception) as ee:
+            list(stream_grouped_svs(
+                file_path, sample_subset=None, sample_remap=None, sample_type='WES', ignore_missing_samples=False))
+        self.assertEqual(str(ee.exception), 'Input file is not sorted by variant name: found suffix_1 DEL after suffix_3 DUP')
+
+        with self.assertRaises(Exception) as ee:
+            list(stream_grouped_svs(
+                sort_by_variant_name(file_path, tmp_dir=self.test_dir), sample_subset={'SAMPLE-1', 'SAMPLE-4'},
+                sample_remap=None,
+                sample_type='WES', ignore_missing_samples=False))
+        self.assertEqual(str(ee.exception), 'Missing the following 1 samples:\nSAMPLE-4')
+
+    def test_export_to_elasticsearch(self):
+        sorted_file_path = sort_by_variant_name(self._write_bed(BED_ROWS), tmp_dir=self.test_dir)
+        for compress_level, routing_scheme in [(None, None), (6, 'xpos_bin')]:
+            rows = stream_grouped_svs(
+                sorted_file_path, sample_subset=None, sample_remap=None, sample_type='WES', ignore_missing_samples=False)
+            with FakeElasticsearchServer(reject_bulk_requests=1) as server:
+                export_to_elasticsearch(
+                    'localhost', server.port, rows, 'test_sv_index', meta={'datasetType': 'SV'}, es_password=None,
+                    elasticsearch_schema={}, num_workers=2, chunk_size=2, compress_level=compress_level,
+                    routing_scheme=routing_scheme,
+                )
+                self.assertSetEqual(set(server.docs['test_sv_index']), {'suffix_1_DEL', 'suffix_2_DUP', 'suffix_3_DUP'})
+                self.assertListEqual(
+                    server.docs['test_sv_index']['suffix_1_DEL']['samples'], ['SAMPLE-1', 'SAMPLE-2', 'SAMPLE-3'])
+                if routing_scheme:
+                    self.assertDictEqual(server.meta['test_sv_index']['routing'], {
+                        'scheme': 'xpos_bin', 'field': 'xpos', 'bin_size': 10000000})
+
+if __name__ == '__main__':
+    unittest.main()